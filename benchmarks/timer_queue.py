@@ -0,0 +1,71 @@
+"""Compares the timer wheel EventQueue with the binary heap it replaced"""
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "server"))
+from services.queue_service import EventQueue
+
+
+class HeapEventQueue:
+    """The previous heap based EventQueue, cancellation marks entries dead and leaves them in the heap"""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+
+    def push(self, execute_tick, event, data):
+        entry = [execute_tick, self.counter, event, data, True]
+        self.counter += 1
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[4] = False
+
+    def pop_ready(self, current_tick):
+        ready = []
+        while self.heap and self.heap[0][0] <= current_tick:
+            entry = heapq.heappop(self.heap)
+            if entry[4]:
+                ready.append((entry[0], entry[2], entry[3]))
+        return ready
+
+
+def run(queue, ticks, horizon):
+    """Pushes one timer per tick offset, cancels a third of them and then drains the queue tick by tick"""
+    timings = {}
+    start = time.perf_counter()
+    handles = [queue.push(tick, 1, index) for index, tick in enumerate(ticks)]
+    timings["push"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for handle in handles[::3]:
+        queue.cancel(handle)
+    timings["cancel"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fired = 0
+    for tick in range(horizon + 1):
+        fired += len(queue.pop_ready(tick))
+    timings["drain"] = time.perf_counter() - start
+    return timings, fired
+
+
+def main():
+    random.seed(1)
+    for count in (10_000, 1_000_000):
+        # Bomb and explosion timers are 90 to 120 ticks out, with some long ones mixed in
+        horizon = max(count // 50, 200)
+        ticks = [random.choice((random.randint(1, 120), random.randint(1, horizon))) for _ in range(count)]
+        print(f"{count} pending timers over {horizon} ticks")
+        for name, queue in (("heap", HeapEventQueue()), ("wheel", EventQueue())):
+            timings, fired = run(queue, ticks, horizon)
+            per_op = ", ".join(f"{step} {seconds / count * 1e6:.2f} us/op" for step, seconds in timings.items())
+            print(f"  {name:5} fired {fired}: {per_op}")
+
+
+if __name__ == "__main__":
+    main()
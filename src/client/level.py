@@ -1,26 +1,23 @@
 import pygame
 from sprites.player import Player
 from objects.playerObject import PlayerObject
-from sprites.floor import Floor
-from sprites.wall import Wall
 from objects.bombObject import BombObject
 from objects.explosionObject import ExplosionObject
 from sprites.bomb import Bomb
 from sprites.explosion import Explosion
+from sprites.chunk import Chunk
+from sprites import textures
+from services.grid import GridState
+from services.entity_store import EntityStore
 import time
 
 class Level:
-    def __init__(self, level_map, player_map, bomb_map, explosion_map, cell_size, event_queue, comms):
+    def __init__(self, level_map, player_map, bomb_map, explosion_map, cell_size, event_queue, comms, chunk_cells=4):
         self.cell_size = cell_size
-        self.players = {}
-        self.bombs = {}
-        self.explosions = {}
-        self.level_map = level_map
-        self.player_map = player_map
-        self.bomb_map = bomb_map
-        self.explosion_map = explosion_map
-        self.walls = pygame.sprite.Group()
-        self.floors = pygame.sprite.Group()
+        self.players = EntityStore()
+        self.bombs = EntityStore()
+        self.explosions = EntityStore()
+        self.grid = GridState.from_rows(level_map, bomb_map, player_map, explosion_map)
         self.event_queue = event_queue
         
         self.comms = comms
@@ -29,33 +26,30 @@ class Level:
         self.local_tick = 0
         self.max_clock_drift = 5
 
-        self.global_explosion_id = 1
+        # Own moves are applied right away and kept until the server acks their input seq
+        self.move_ticks = 20
+        self.input_seq = 0
+        self.pending_inputs = []
 
-        self.static_sprites = pygame.sprite.Group()
+        # Walls and floors never change. They are drawn once per chunk of the map when it comes into view and dropped when it leaves,
+        # and the screen is only redrawn where something moved until the camera does
+        self.chunk_cells = chunk_cells
+        self.chunks = {}
+        self.camera = (0, 0)
+        self.drawn = {}
+        self.full_redraw = True
 
-        self._initialize_sprites(level_map)
+        textures.preload(self.cell_size)
+        self._initialize_sprites()
 
-    def _initialize_sprites(self, level_map):
-        """initializes the sprites and objects according to the level maps"""
-        height = len(level_map)
-        width = len(level_map[0])
+    def _initialize_sprites(self):
+        """initializes the player objects according to the player map, tiles are only created once they come into view"""
+        height = self.grid.height
+        width = self.grid.width
 
         for y in range(height):
             for x in range(width):
-                cell = level_map[y][x]
-                normalized_x = x*self.cell_size
-                normalized_y = y*self.cell_size
-
-                if cell == 0:
-                    self.floors.add(Floor(normalized_x, normalized_y, self.cell_size))
-                elif cell == 1:
-                    self.walls.add(Wall(normalized_x, normalized_y, self.cell_size))
-
-        self.static_sprites.add(self.walls, self.floors)
-
-        for y in range(height):
-            for x in range(width):
-                cell = self.player_map[y][x]
+                cell = self.grid.player_at(x, y)
                 normalized_x = x*self.cell_size
                 normalized_y = y*self.cell_size
 
@@ -75,6 +69,8 @@ class Level:
             if msg["type"] == "update":
                 for event in msg["data"]:
                     self.handle_event(event["event_type"], event["data"])
+            elif msg["type"] == "input_ack":
+                self.reconcile(msg["seq"])
             elif msg["type"] == "clock":
                 server_tick = msg["data"]["server_tick"]
                 latency = (time.perf_counter() - msg["data"]["timestamp"]) / 2
@@ -88,20 +84,86 @@ class Level:
         self.local_tick += 1
 
     def render(self, screen):
-        """renders all graphics"""
-        self.static_sprites.draw(screen)
-
-        for player in self.players.values():
-            player.render(screen)
-
-        for bomb in self.bombs.values():
-            bomb.render(screen)
-
+        """renders the part of the map the camera shows and returns the screen areas that need updating. While the camera stays put only what changed is redrawn"""
+        view = pygame.Rect(self._camera(screen), screen.get_size())
+        sprites = []
+        for sprite in self._dynamic_sprites():
+            sprite.rect.topleft = (sprite.pixel_x, sprite.pixel_y)
+            if sprite.rect.colliderect(view):
+                sprites.append(sprite)
+
+        if self.full_redraw or view.topleft != self.camera:
+            self.camera = view.topleft
+            self._draw_area(screen, view, view, sprites)
+            self.drawn = {sprite: sprite.rect.topleft for sprite in sprites}
+            self.full_redraw = False
+            self._evict_chunks(view)
+            return [screen.get_rect()]
+
+        drawn = {}
+        dirty = []
+        for sprite in sprites:
+            position = sprite.rect.topleft
+            drawn[sprite] = position
+            last = self.drawn.pop(sprite, None)
+            if last != position:
+                dirty.append(sprite.rect.copy() if last is None else sprite.rect.union(pygame.Rect(last, sprite.rect.size)))
+        # Sprites drawn last frame that are gone or out of view now leave their area to be cleared
+        for sprite, last in self.drawn.items():
+            dirty.append(pygame.Rect(last, sprite.rect.size))
+        self.drawn = drawn
+
+        areas = []
+        for rect in dirty:
+            area = rect.clip(view)
+            if area.width and area.height:
+                self._draw_area(screen, view, area, sprites)
+                areas.append(area.move(-view.x, -view.y))
+        return areas
+
+    def _camera(self, screen):
+        """returns the map pixel at the top left of the screen, keeping the own player in the middle without showing past the map edges"""
+        player = self.players.get(self.comms.player_id)
+        if player is None:
+            return self.camera
+        width, height = screen.get_size()
+        x = player.sprite.pixel_x + self.cell_size // 2 - width // 2
+        y = player.sprite.pixel_y + self.cell_size // 2 - height // 2
+        x = max(0, min(x, self.grid.width * self.cell_size - width))
+        y = max(0, min(y, self.grid.height * self.cell_size - height))
+        return (x, y)
+
+    def _draw_area(self, screen, view, area, sprites):
+        """redraws an area given in map pixels: the chunks of tiles under it, then every sprite overlapping it, clipped so nothing outside of it is covered"""
+        screen.set_clip(area.move(-view.x, -view.y))
+        size = self.chunk_cells * self.cell_size
+        for chunk_y in range(area.top // size, (area.bottom - 1) // size + 1):
+            for chunk_x in range(area.left // size, (area.right - 1) // size + 1):
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is None:
+                    chunk = Chunk(self.grid.level, chunk_x, chunk_y, self.chunk_cells, self.cell_size)
+                    self.chunks[(chunk_x, chunk_y)] = chunk
+                screen.blit(chunk.image, (chunk.rect.x - view.x, chunk.rect.y - view.y))
+        for sprite in sprites:
+            if sprite.rect.colliderect(area):
+                screen.blit(sprite.image, (sprite.rect.x - view.x, sprite.rect.y - view.y))
+        screen.set_clip(None)
+
+    def _evict_chunks(self, view):
+        """drops the chunks the camera moved away from"""
+        for key in [key for key, chunk in self.chunks.items() if not chunk.rect.colliderect(view)]:
+            del self.chunks[key]
+
+    def _dynamic_sprites(self):
+        """returns the sprites of the players, bombs and explosions in the order they are drawn"""
+        sprites = [player.sprite for player in self.players.values()]
+        sprites += [bomb.sprite for bomb in self.bombs.values()]
         for explosion in self.explosions.values():
-            explosion.render(screen)
+            sprites += explosion.sprites
+        return sprites
 
     def move_player(self, id, x, y):
-        """checks if player can move, and sends event to server if so"""
+        """checks if player can move, sends event to server if so and moves the player right away without waiting for it"""
         
         player_x = self.players[id].x
         player_y = self.players[id].y
@@ -112,33 +174,69 @@ class Level:
             return
 
 
-        if (0 <= new_x < len(self.level_map[0])) and (0 <= new_y < len(self.level_map)):
-            if self.level_map[new_y][new_x] != 0:
-                return
-            elif self.player_map[new_y][new_x] != 0:
-                return
-            elif self.bomb_map[new_y][new_x] != 0:
+        if self.grid.in_bounds(new_x, new_y):
+            if self.grid.is_blocked(new_x, new_y):
                 return
             else:
                 print(f"[CLIENT] Sending Move Request: {x}, {y}", flush=True)
-                self.comms.send_event(2, [id, x, y, new_x, new_y])
+                seq = self.input_seq + 1
+                if not self.comms.send_event(2, [id, x, y, new_x, new_y], seq):
+                    return
+                self.input_seq = seq
+                self.pending_inputs.append((seq, x, y, self.comms.connection_count))
+                self.grid.move_player(player_x, player_y, new_x, new_y, id)
+                self.players[id].move(x, y)
+                # The server lets the player move again after the same number of ticks
+                self.event_queue.push(self.local_tick + self.move_ticks, 9, [id])
                 return
 
         else:
             return
         
     def handle_moving(self, data):
-        """Moves the player object"""
+        """Moves the player object. Own moves were already predicted, only the committed position is kept for reconciling"""
         player_id, x, y, new_x, new_y = data
 
-        self.player_map[new_y-y][new_x-x] = 0
-        self.player_map[new_y][new_x] = player_id
+        if player_id == self.comms.player_id:
+            self.players[player_id].server_x = new_x
+            self.players[player_id].server_y = new_y
+            return
+        self.grid.move_player(new_x - x, new_y - y, new_x, new_y, player_id)
         self.players[player_id].move(x, y)
+        self.players[player_id].server_x = new_x
+        self.players[player_id].server_y = new_y
 
     def handle_moving_stop(self, data):
-        """Sets the player moving variable to false, and allows the player move again"""
+        """Sets the player moving variable to false, and allows the player move again. Own moves end on the local timer"""
         player_id = data[0]
+        if player_id == self.comms.player_id:
+            return
         self.players[player_id].moving = False
+
+    def finish_predicted_move(self, data):
+        """Allows the own player to move again once its predicted move is over"""
+        player = self.players.get(data[0])
+        if player is not None:
+            player.moving = False
+
+    def reconcile(self, acked_seq):
+        """Drops the acked inputs and replays the rest on top of the committed position, correcting the player if the prediction was off"""
+        self.pending_inputs = [pending for pending in self.pending_inputs if pending[0] > acked_seq]
+        player = self.players.get(self.comms.player_id)
+        if player is None:
+            return
+
+        # Replay without the predicted player in the grid, it must not block its own path
+        if self.grid.player_at(player.x, player.y) == player.id:
+            self.grid.set_player(player.x, player.y, 0)
+        x, y = player.server_x, player.server_y
+        for _, dx, dy, _ in self.pending_inputs:
+            if self.grid.in_bounds(x + dx, y + dy) and not self.grid.is_blocked(x + dx, y + dy):
+                x, y = x + dx, y + dy
+        if (x, y) != (player.x, player.y):
+            print(f"[CLIENT] Prediction off after input {acked_seq}, correcting ({player.x}, {player.y}) -> ({x}, {y})", flush=True)
+            player.place(x, y)
+        self.grid.set_player(x, y, player.id)
         
     def lay_bomb(self, id):
         """Sends a bomb spawning event to the server"""
@@ -147,69 +245,97 @@ class Level:
         self.comms.send_event(0, [player.x, player.y, id])
 
     def spawn_bomb(self, x, y, id, owner, explosion_tick):
-        """Spawns a bomb object, and adds the explosion timing to the event queue"""
-        self.bomb_map[y][x] = id
-        self.bombs[id] = BombObject(id, x, y, owner, 120, Bomb(x*self.cell_size, y*self.cell_size, self.cell_size))
-        self.event_queue.push(explosion_tick, 1, (id, x, y, owner))
-
-    def explode_bomb(self, data):
-        """removes the bomb object and spawns explosion objects"""
-        if self.bombs.get(data[0]) is None:
-            return
-        self.bomb_map[data[2]][data[1]] = 0
-        del self.bombs[data[0]]
-
-        self.spawn_explosion(data[1], data[2], data[3])
-
-        for direction in [(1,0), (-1,0), (0,1), (0,-1)]:
-            nx = data[1] + direction[0]
-            ny = data[2] + direction[1]
-            if nx < 0 or nx > len(self.level_map[0]) - 1 or ny < 0 or ny > len(self.level_map) - 1:
-                continue
-            
-            if self.level_map[ny][nx] != 0:
-                continue
-            self.spawn_explosion(nx, ny, data[3])
-
-            if self.bomb_map[ny][nx] != 0:
-                bomb_id = self.bomb_map[ny][nx]
-                other_bomb = self.bombs[bomb_id]
-                other_bomb.timer = 0
-                continue
-
-    def spawn_explosion(self, x, y, owner):
-        """spawns new explosion object on given coordinates"""
-        new_explosion = ExplosionObject(x, y, owner, 90, Explosion(x * self.cell_size, y * self.cell_size, self.cell_size))
-        self.explosion_map[y][x] += 1
-        self.explosions[self.global_explosion_id] = new_explosion
-        self.event_queue.push(self.local_tick + 90, 3, (self.global_explosion_id, x, y))
-        self.global_explosion_id += 1
+        """Spawns a bomb object, the server says when it explodes"""
+        self.grid.set_bomb(x, y, id)
+        self.bombs[id] = BombObject(id, x, y, owner, explosion_tick - self.local_tick, Bomb(x*self.cell_size, y*self.cell_size, self.cell_size))
+
+    def apply_blast(self, data):
+        """removes the exploded bombs and shows the burning cells of an explosion set until its expire tick"""
+        expire_tick, bomb_ids, cells = data
+        for bomb_id in bomb_ids:
+            bomb = self.bombs.pop(bomb_id, None)
+            if bomb is not None:
+                self.grid.set_bomb(bomb.x, bomb.y, 0)
+
+        sprites = []
+        for offset in range(0, len(cells), 2):
+            x, y = cells[offset], cells[offset + 1]
+            self.grid.ignite(x, y, expire_tick)
+            sprites.append(Explosion(x * self.cell_size, y * self.cell_size, self.cell_size))
+
+        # The server sends no removal, the whole blast is dropped locally when it burns out
+        explosion_id = self.explosions.allocate()
+        self.explosions[explosion_id] = ExplosionObject(cells, expire_tick, sprites)
+        self.event_queue.push(expire_tick, 3, explosion_id)
 
     def remove_explosion(self, id):
-        """removes given explosion object"""
-        if id in self.explosions:
-            explosion = self.explosions[id]
-            self.explosion_map[explosion.y][explosion.x] -= 1
-            del self.explosions[id]
+        """removes the explosion object of a burnt out blast"""
+        self.explosions.pop(id, None)
+
+    def player_enters(self, data):
+        """Shows a player that came into view where the server says it is, or puts a known one there"""
+        player_id, x, y = data
+        player = self.players.get(player_id)
+        if player is None:
+            self.players[player_id] = PlayerObject(player_id, x, y, Player(x*self.cell_size, y*self.cell_size, self.cell_size))
+            self.grid.set_player(x, y, player_id)
+            return
+        player.server_x, player.server_y = x, y
+        if player_id == self.comms.player_id:
+            # Sent on joining a server. Inputs sent to an earlier one are not coming back, the ones sent to this one are replayed
+            connection = self.comms.connection_count
+            self.pending_inputs = [pending for pending in self.pending_inputs if pending[3] == connection]
+            self.reconcile(0)
+            return
+        if self.grid.player_at(player.x, player.y) == player_id:
+            self.grid.set_player(player.x, player.y, 0)
+        player.place(x, y)
+        self.grid.set_player(x, y, player_id)
+
+    def player_leaves(self, data):
+        """Drops a player that went out of view"""
+        player = self.players.pop(data[0], None)
+        if player is not None and self.grid.player_at(player.x, player.y) == player.id:
+            self.grid.set_player(player.x, player.y, 0)
+
+    def bomb_leaves(self, data):
+        """Drops a bomb that went out of view"""
+        bomb = self.bombs.pop(data[0], None)
+        if bomb is not None:
+            self.grid.set_bomb(bomb.x, bomb.y, 0)
 
     def handle_event(self, event_type, data):
         """Calls appropriate event handler according to given type"""
-        # 0 = bomb spawn,
-        #  1 = bomb explode,
+        # 0 = bomb spawn, also sent for bombs coming into view,
         #  2 = player moves,
-        #  3 = remove explosion,
-        #  4 = player stops moving
+        #  3 = blast burnt out, only from the local event queue,
+        #  4 = player stops moving,
+        #  5 = explosion set,
+        #  6 = player comes into view,
+        #  7 = player goes out of view,
+        #  8 = bomb goes out of view,
+        #  9 = own predicted move over, only from the local event queue
         match event_type:
             case 0:
+                if data[2] in self.bombs:
+                    return
                 self.spawn_bomb(data[0], data[1], data[2], data[3], data[4])
-            case 1:
-                self.explode_bomb(data)
             case 2:
                 self.handle_moving(data)
             case 3:
-                self.remove_explosion(data[0])
+                self.remove_explosion(data)
             case 4:
                 self.handle_moving_stop(data)
+            case 5:
+                self.apply_blast(data)
+            case 6:
+                self.player_enters(data)
+            case 7:
+                self.player_leaves(data)
+            case 8:
+                self.bomb_leaves(data)
+            case 9:
+                self.finish_predicted_move(data)
 
     def sync_local_tick(self, server_tick):
         """Syncs local tick according to given server tick"""
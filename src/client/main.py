@@ -1,3 +1,4 @@
+import sys
 import pygame
 from level import Level
 from services.queue_service import EventQueue
@@ -34,21 +35,31 @@ EXPLOSION_MAP = [[0, 0, 0, 0, 0],
             [0, 0, 0, 0, 0],]
 
 CELL_SIZE = 100
+# The window shows at most this many cells each way, the camera follows the player over bigger maps
+VIEWPORT_CELLS = 9
+PLAYER_ID = 1
 
 def main():
-    comms = ServerComms(SERVERS_LIST)
+    room = 0
+    if len(sys.argv) > 1:
+        try:
+            room = int(sys.argv[1])
+        except ValueError:
+            print("Invalid room, defaulting to 0")
+
+    comms = ServerComms(SERVERS_LIST, room, PLAYER_ID)
     
     height = len(LEVEL_MAP)
     width = len(LEVEL_MAP[0])
-    display_height = height * CELL_SIZE
-    display_width = width * CELL_SIZE
+    display_height = min(height, VIEWPORT_CELLS) * CELL_SIZE
+    display_width = min(width, VIEWPORT_CELLS) * CELL_SIZE
 
     display = pygame.display.set_mode((display_width, display_height))
 
     pygame.display.set_caption("DisSysBomberman Client")
     event_queue = EventQueue()
     level = Level(LEVEL_MAP, PLAYER_MAP, BOMB_MAP, EXPLOSION_MAP, CELL_SIZE, event_queue, comms)
-    game_loop = GameLoop(level, CELL_SIZE, display, 1)
+    game_loop = GameLoop(level, CELL_SIZE, display, PLAYER_ID)
 
     pygame.init()
     game_loop.start()
@@ -87,8 +98,9 @@ class GameLoop:
 
     def _render(self):
         self._level.update(5)
-        self._level.render(self._display)
-        pygame.display.update()
+        dirty = self._level.render(self._display)
+        if dirty:
+            pygame.display.update(dirty)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,8 @@
 
 
 class BombObject:
+    __slots__ = ("id", "x", "y", "owner", "timer", "sprite")
+
     def __init__(self, id, x, y, owner, timer, sprite):
         self.id = id
         self.x = x
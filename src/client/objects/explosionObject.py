@@ -1,14 +1,11 @@
 class ExplosionObject:
-    def __init__(self, x, y, owner, timer, sprite):
-        self.x = x
-        self.y = y
-        self.owner = owner
-        self.timer = timer
-        self.sprite = sprite
+    __slots__ = ("cells", "expire_tick", "sprites")
 
-
-    def update(self):
-        self.timer -= 1
+    def __init__(self, cells, expire_tick, sprites):
+        self.cells = cells
+        self.expire_tick = expire_tick
+        self.sprites = sprites
 
     def render(self, screen):
-        self.sprite.render(screen)
\ No newline at end of file
+        for sprite in self.sprites:
+            sprite.render(screen)
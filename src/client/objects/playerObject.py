@@ -1,10 +1,15 @@
 
 
 class PlayerObject:
+    __slots__ = ("id", "x", "y", "server_x", "server_y", "moving", "alive", "sprite")
+
     def __init__(self, id, x, y, sprite):
         self.id = id
         self.x = x
         self.y = y
+        # Last position the server committed, x and y run ahead of it while own moves are predicted
+        self.server_x = x
+        self.server_y = y
         self.moving = False
         self.alive = True
         self.sprite = sprite
@@ -14,6 +19,13 @@ class PlayerObject:
         self.y += y
         self.moving = True
 
+    def place(self, x, y):
+        """Puts the player straight at a cell, without animating there"""
+        self.x = x
+        self.y = y
+        self.sprite.pixel_x = x * self.sprite.cell_size
+        self.sprite.pixel_y = y * self.sprite.cell_size
+
 
     def update(self, dt):
         if self.moving:
@@ -0,0 +1,141 @@
+import struct
+
+# Binary payloads start with a message tag, JSON payloads always start with "{"
+JSON_START = ord("{")
+
+SUPPORTED_ENCODINGS = ["binary", "json"]
+
+MESSAGE_TAGS = {
+    "update": 1,
+    "event": 2,
+    "clock": 4,
+    "heartbeat": 5,
+    "curr_state": 6,
+    "state_chunk": 7,
+    "input_ack": 8,
+}
+MESSAGE_TYPES = {tag: msg_type for msg_type, tag in MESSAGE_TAGS.items()}
+
+BATCH_HEADER = struct.Struct("!BIIH")          # tag, seq, tick, event count
+REPLICATE_HEADER = struct.Struct("!BHIIIIH")   # tag, room id, seq, tick, commit index, leader tick, event count
+CLOCK_LAYOUT = struct.Struct("!BIId")          # tag, tick, server tick, timestamp
+HEARTBEAT_LAYOUT = struct.Struct("!BHHII")     # tag, leader id, room id, tick, commit index of the room
+STATE_HEADER = struct.Struct("!BHH")      # tag, sender id, room id, followed by the state transfer
+CHUNK_HEADER = struct.Struct("!BHIII")    # tag, sender id, transfer id, chunk index, chunk count, followed by the chunk
+INPUT_ACK_LAYOUT = struct.Struct("!BII")  # tag, last processed input seq of the client, tick
+
+EVENT_TYPE = struct.Struct("!B")
+EVENT_LAYOUTS = {
+    0: struct.Struct("!HHIHI"),  # bomb spawn: x, y, bomb id, owner, explode tick
+    1: struct.Struct("!IHHH"),   # bomb explode: bomb id, x, y, owner
+    2: struct.Struct("!HbbHH"),  # player moves: player id, dx, dy, new x, new y
+    4: struct.Struct("!H"),      # player stops moving: player id
+    6: struct.Struct("!HHH"),    # player comes into view: player id, x, y
+    7: struct.Struct("!H"),      # player goes out of view: player id
+    8: struct.Struct("!I"),      # bomb goes out of view: bomb id
+}
+
+# Explosion set: expire tick, bomb count, cell count,
+# followed by the exploded bomb ids and an x, y pair per burning cell
+BLAST_EVENT = 5
+BLAST_HEADER = struct.Struct("!IHH")
+
+
+def negotiate(offered):
+    """Picks the first offered encoding this node supports"""
+    for encoding in offered or []:
+        if encoding in SUPPORTED_ENCODINGS:
+            return encoding
+    return "json"
+
+
+def is_binary(payload):
+    """Checks whether the payload is binary encoded"""
+    return len(payload) > 0 and payload[0] != JSON_START
+
+
+def encode_events(events, out):
+    """Appends the binary form of the events to the given bytearray"""
+    for event in events:
+        event_type = event["event_type"]
+        out += EVENT_TYPE.pack(event_type)
+        if event_type == BLAST_EVENT:
+            expire_tick, bomb_ids, cells = event["data"]
+            out += BLAST_HEADER.pack(expire_tick, len(bomb_ids), len(cells) // 2)
+            out += struct.pack(f"!{len(bomb_ids)}I{len(cells)}H", *bomb_ids, *cells)
+            continue
+        out += EVENT_LAYOUTS[event_type].pack(*event["data"])
+
+
+def decode_events(payload, offset, count):
+    """Decodes count events starting at offset, returns the events and the offset after them"""
+    events = []
+    for _ in range(count):
+        (event_type,) = EVENT_TYPE.unpack_from(payload, offset)
+        offset += EVENT_TYPE.size
+        if event_type == BLAST_EVENT:
+            expire_tick, bomb_count, cell_count = BLAST_HEADER.unpack_from(payload, offset)
+            offset += BLAST_HEADER.size
+            body = struct.Struct(f"!{bomb_count}I{cell_count * 2}H")
+            values = body.unpack_from(payload, offset)
+            offset += body.size
+            events.append({"event_type": event_type, "data": [expire_tick, list(values[:bomb_count]), list(values[bomb_count:])]})
+            continue
+        layout = EVENT_LAYOUTS[event_type]
+        data = list(layout.unpack_from(payload, offset))
+        events.append({"event_type": event_type, "data": data})
+        offset += layout.size
+    return events, offset
+
+
+def encode_message(msg):
+    """Encodes the message with its fixed binary layout. Returns None for message types without one"""
+    msg_type = msg.get("type")
+    tag = MESSAGE_TAGS.get(msg_type)
+    if tag is None:
+        return None
+    if msg_type == "update":
+        out = bytearray(BATCH_HEADER.pack(tag, msg.get("seq", 0), msg["tick"], len(msg["data"])))
+        encode_events(msg["data"], out)
+        return bytes(out)
+    if msg_type == "event":
+        out = bytearray(REPLICATE_HEADER.pack(tag, msg["room"], msg["seq"], msg["tick"], msg["commit"], msg["leader_tick"], len(msg["data"])))
+        encode_events(msg["data"], out)
+        return bytes(out)
+    if msg_type == "clock":
+        data = msg["data"]
+        return CLOCK_LAYOUT.pack(tag, msg["tick"], data["server_tick"], data["timestamp"])
+    if msg_type == "curr_state":
+        return STATE_HEADER.pack(tag, msg["from"], msg["room"]) + msg["transfer"]
+    if msg_type == "state_chunk":
+        return CHUNK_HEADER.pack(tag, msg["from"], msg["transfer_id"], msg["index"], msg["total"]) + msg["data"]
+    if msg_type == "input_ack":
+        return INPUT_ACK_LAYOUT.pack(tag, msg["seq"], msg["tick"])
+    return HEARTBEAT_LAYOUT.pack(tag, msg["leader_id"], msg["room"], msg["tick"], msg["commit"])
+
+
+def decode_message(payload):
+    """Decodes a binary payload into the same dict a JSON message would produce"""
+    msg_type = MESSAGE_TYPES[payload[0]]
+    if msg_type == "update":
+        _, seq, tick, count = BATCH_HEADER.unpack_from(payload, 0)
+        events, _ = decode_events(payload, BATCH_HEADER.size, count)
+        return {"type": msg_type, "seq": seq, "tick": tick, "data": events}
+    if msg_type == "event":
+        _, room, seq, tick, commit, leader_tick, count = REPLICATE_HEADER.unpack_from(payload, 0)
+        events, _ = decode_events(payload, REPLICATE_HEADER.size, count)
+        return {"type": msg_type, "room": room, "seq": seq, "tick": tick, "commit": commit, "leader_tick": leader_tick, "data": events}
+    if msg_type == "clock":
+        _, tick, server_tick, timestamp = CLOCK_LAYOUT.unpack_from(payload, 0)
+        return {"type": msg_type, "tick": tick, "data": {"server_tick": server_tick, "timestamp": timestamp}}
+    if msg_type == "curr_state":
+        _, sender, room = STATE_HEADER.unpack_from(payload, 0)
+        return {"type": msg_type, "from": sender, "room": room, "transfer": bytes(payload[STATE_HEADER.size:])}
+    if msg_type == "state_chunk":
+        _, sender, transfer_id, index, total = CHUNK_HEADER.unpack_from(payload, 0)
+        return {"type": msg_type, "from": sender, "transfer_id": transfer_id, "index": index, "total": total, "data": bytes(payload[CHUNK_HEADER.size:])}
+    if msg_type == "input_ack":
+        _, seq, tick = INPUT_ACK_LAYOUT.unpack_from(payload, 0)
+        return {"type": msg_type, "seq": seq, "tick": tick}
+    _, leader_id, room, tick, commit = HEARTBEAT_LAYOUT.unpack_from(payload, 0)
+    return {"type": msg_type, "leader_id": leader_id, "room": room, "tick": tick, "commit": commit}
@@ -1,31 +1,46 @@
 import socket
-import json
 import threading
 import time
 from queue import Queue
+from services.framing import FrameReader, encode_message
+from services.codec import SUPPORTED_ENCODINGS
 
 class ServerComms():
-    def __init__(self, servers_list):
+    def __init__(self, servers_list, room=0, player_id=None, radius=None):
         self.servers_list = servers_list
+        self.room = room
+        # The server only sends what is within radius cells of this player, its default radius if None
+        self.player_id = player_id
+        self.radius = radius
+        # Server that leads the room, as told by the server we connected to
+        self.redirect = None
         self.current_server_index = 0
         self.sock = None
+        self.reader = None
         self.connected = False
+        # Counts successful connections, inputs sent on an earlier one are never acked
+        self.connection_count = 0
+        self.encoding = "json"
         
         self.recv_queue = Queue()
 
         self.thread = threading.Thread(target=self._connection_manager, daemon=True)
         self.thread.start()
         
-    def send_event(self, event_type, data):
+    def send_event(self, event_type, data, seq=None):
+        """Sends an input to the server, tagged with its input sequence number if given. Returns whether it was sent"""
         if not self.connected or not self.sock:
-            return
+            return False
         try:
             message = {"event_type": event_type, "data": data}
-            message = json.dumps(message).encode("utf-8")
-            self.sock.send(message)
+            if seq is not None:
+                message["seq"] = seq
+            self.sock.sendall(encode_message(message))
+            return True
         except Exception:
             print("[NET] Send failed, waiting for reconnect...", flush=True)
             self.connected = False
+            return False
 
     def _connection_manager(self):
         """Manages connecting and reconnecting to available servers"""
@@ -34,14 +49,18 @@ class ServerComms():
                 self._try_connect()
             else:
                 self._recv_loop()
-            time.sleep(1)
+            # Follow a redirect right away, the room may still be moving between servers so not in a tight loop
+            time.sleep(1 if self.redirect is None else 0.05)
 
     def _try_connect(self):
-        """Attempts to connect to the leader by going through possible servers"""
-        for i in range(len(self.servers_list)):
-            index = (self.current_server_index + i) % len(self.servers_list)
-            target = self.servers_list[index]
-            
+        """Attempts to connect to the leader of the room, first where the last server pointed to, then by going through possible servers"""
+        count = len(self.servers_list)
+        targets = [self.servers_list[(self.current_server_index + i) % count] for i in range(count)]
+        if self.redirect is not None:
+            targets.insert(0, self.redirect)
+            self.redirect = None
+        for target in targets:
+
             try:
                 print(f"[NET] Attempting to connect to {target}...", flush=True)
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -50,12 +69,20 @@ class ServerComms():
                 self.sock.settimeout(None)
 
                 handshake = {
-                    "type": "client_hello"
+                    "type": "client_hello",
+                    "room": self.room,
+                    "player": self.player_id,
+                    "encodings": SUPPORTED_ENCODINGS
                 }
-                self.sock.send((json.dumps(handshake)).encode("utf-8"))
+                if self.radius is not None:
+                    handshake["radius"] = self.radius
+                self.sock.sendall(encode_message(handshake))
                 
+                self.reader = FrameReader()
+                self.connection_count += 1
                 self.connected = True
-                self.current_server_index = index
+                if target in self.servers_list:
+                    self.current_server_index = self.servers_list.index(target)
                 print(f"[NET] Connected to {target}!", flush=True)
 
 
@@ -76,19 +103,21 @@ class ServerComms():
         """Loop to receive messages from the server"""
         while self.connected:
             try:
-                data = self.sock.recv(4096).decode("utf-8")
-                if not data:
+                if self.reader.recv_from(self.sock) == 0:
                     print("[NET] Connection closed by server", flush=True)
                     self.connected = False
                     break
 
-                if "}{" in data:
-                    parts = data.replace("}{", "}|{").split("|")
-                    for part in parts:
-                        msg = json.loads(part)
-                        self.recv_queue.put(msg)
-                else:
-                    msg = json.loads(data)
+                for msg in self.reader.messages():
+                    if msg["type"] == "hello_ack":
+                        self.encoding = msg["encoding"]
+                        print(f"[NET] Server uses {self.encoding} encoding", flush=True)
+                        continue
+                    if msg["type"] == "redirect":
+                        self.redirect = (msg["host"], msg["port"])
+                        print(f"[NET] Room {msg['room']} is led by {self.redirect}, reconnecting", flush=True)
+                        self.connected = False
+                        break
                     self.recv_queue.put(msg)
             except Exception as e:
                 print(f"[NET] Network error during recv: {e}", flush=True)
@@ -0,0 +1,144 @@
+import sys
+from array import array
+
+# Occupancy bits, a cell with any of them set blocks movement
+WALL = 1
+BOMB = 2
+PLAYER = 4
+
+# Maps every non-zero byte to the occupancy bit
+_BIT_TABLES = {bit: bytes([0] + [bit] * 255) for bit in (WALL, BOMB, PLAYER)}
+
+
+def _occupancy_mask(grid, bit):
+    """Returns an int whose bytes are the bit for every non-zero cell of the grid, computed without a per-cell loop"""
+    raw = grid.cells.tobytes().translate(_BIT_TABLES[bit])
+    mask = 0
+    for lane in range(grid.cells.itemsize):
+        mask |= int.from_bytes(raw[lane::grid.cells.itemsize], "little")
+    return mask
+
+
+class Grid:
+    """Fixed-size grid of ints stored row by row in one contiguous array"""
+
+    def __init__(self, width, height, cells=None):
+        self.width = width
+        self.height = height
+        self.cells = cells if cells is not None else array("i", bytes(4 * width * height))
+
+    @classmethod
+    def from_rows(cls, rows):
+        cells = array("i")
+        for row in rows:
+            cells.extend(row)
+        return cls(len(rows[0]), len(rows), cells)
+
+    @classmethod
+    def frombytes(cls, width, height, data):
+        """Builds a grid from little-endian int32 cells"""
+        cells = array("i")
+        cells.frombytes(data)
+        if sys.byteorder == "big":
+            cells.byteswap()
+        return cls(width, height, cells)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, x, y):
+        return self.cells[y * self.width + x]
+
+    def set(self, x, y, value):
+        self.cells[y * self.width + x] = value
+
+    def copy(self):
+        return Grid(self.width, self.height, array("i", self.cells))
+
+    def tobytes(self):
+        """Returns the cells as little-endian int32, the layout used by snapshots"""
+        if sys.byteorder == "big":
+            cells = array("i", self.cells)
+            cells.byteswap()
+            return cells.tobytes()
+        return self.cells.tobytes()
+
+    def rows(self):
+        return [self.cells[y * self.width:(y + 1) * self.width].tolist() for y in range(self.height)]
+
+
+class GridState:
+    """The level, bomb, player and explosion grids of a map, with an occupancy bitmask kept in step for collision checks.
+    An explosion cell holds the tick it burns until and is never cleared, it simply stops burning when the clock passes it"""
+
+    def __init__(self, level, bombs, players, explosions, occupancy=None):
+        self.width = level.width
+        self.height = level.height
+        self.level = level
+        self.bombs = bombs
+        self.players = players
+        self.explosions = explosions
+        self.occupancy = occupancy
+        if occupancy is None:
+            self.rebuild_occupancy()
+
+    @classmethod
+    def from_rows(cls, level_map, bomb_map, player_map, explosion_map):
+        return cls(Grid.from_rows(level_map), Grid.from_rows(bomb_map), Grid.from_rows(player_map), Grid.from_rows(explosion_map))
+
+    def grids(self):
+        """Returns the grids in snapshot order"""
+        return (self.level, self.bombs, self.players, self.explosions)
+
+    def rebuild_occupancy(self):
+        """Recomputes the whole occupancy bitmask from the grids"""
+        mask = _occupancy_mask(self.level, WALL) | _occupancy_mask(self.bombs, BOMB) | _occupancy_mask(self.players, PLAYER)
+        self.occupancy = bytearray(mask.to_bytes(self.width * self.height, "little"))
+
+    def _mark(self, index, bit, present):
+        if present:
+            self.occupancy[index] |= bit
+        else:
+            self.occupancy[index] &= ~bit
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def is_blocked(self, x, y):
+        """Checks whether a wall, bomb or player is in the cell"""
+        return self.occupancy[y * self.width + x] != 0
+
+    def is_wall(self, x, y):
+        return self.occupancy[y * self.width + x] & WALL != 0
+
+    def bomb_at(self, x, y):
+        return self.bombs.cells[y * self.width + x]
+
+    def player_at(self, x, y):
+        return self.players.cells[y * self.width + x]
+
+    def set_bomb(self, x, y, bomb_id):
+        index = y * self.width + x
+        self.bombs.cells[index] = bomb_id
+        self._mark(index, BOMB, bomb_id)
+
+    def set_player(self, x, y, player_id):
+        index = y * self.width + x
+        self.players.cells[index] = player_id
+        self._mark(index, PLAYER, player_id)
+
+    def move_player(self, x, y, new_x, new_y, player_id):
+        self.set_player(x, y, 0)
+        self.set_player(new_x, new_y, player_id)
+
+    def ignite(self, x, y, expire_tick):
+        """Sets the cell burning until expire_tick, overlapping blasts keep the later tick"""
+        index = y * self.width + x
+        if self.explosions.cells[index] < expire_tick:
+            self.explosions.cells[index] = expire_tick
+
+    def is_burning(self, x, y, tick):
+        return self.explosions.cells[y * self.width + x] > tick
+
+    def copy(self):
+        return GridState(self.level.copy(), self.bombs.copy(), self.players.copy(), self.explosions.copy(), bytearray(self.occupancy))
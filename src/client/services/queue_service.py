@@ -1,14 +1,146 @@
-import heapq
+class TimerHandle:
+    """A pending timer, returned by push and accepted by cancel"""
+    __slots__ = ("tick", "seq", "event", "data", "bucket", "level")
+
+    def __init__(self, tick, seq, event, data):
+        self.tick = tick
+        self.seq = seq
+        self.event = event
+        self.data = data
+        self.bucket = None
+        self.level = None
+
 
 class EventQueue:
-    def __init__(self):
-        self.heap = []
+    """Hierarchical timer wheel keyed by tick. Level 0 has one bucket per tick, each higher level covers slots times
+    the range of the one below and is cascaded down as the clock reaches it. Insert and cancel are O(1)"""
+
+    def __init__(self, current_tick=0, slots=64, levels=4):
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.level_counts = [0] * levels
+        # Timers beyond the range of the top level
+        self.overflow = {}
+        self.cursor = current_tick
+        self.count = 0
+        self.pushed = 0
+
+    def __len__(self):
+        return self.count
 
     def push(self, execute_tick, event, data):
-        heapq.heappush(self.heap, (execute_tick, event, data))
+        """Schedules an event, returns a handle that can be cancelled"""
+        handle = TimerHandle(execute_tick, self.pushed, event, data)
+        self._place(handle)
+        self.count += 1
+        self.pushed += 1
+        return handle
+
+    def cancel(self, handle):
+        """Cancels a pending timer, returns False if it already fired or was cancelled"""
+        if handle is None or handle.bucket is None:
+            return False
+        del handle.bucket[handle]
+        if handle.level < self.levels:
+            self.level_counts[handle.level] -= 1
+        self.count -= 1
+        handle.bucket = None
+        return True
 
     def pop_ready(self, current_tick):
+        """Returns the (tick, event, data) of every timer due by current_tick, in tick order and in push order within a tick"""
         ready = []
-        while self.heap and self.heap[0][0] <= current_tick:
-            ready.append(heapq.heappop(self.heap))
-        return ready
\ No newline at end of file
+        if current_tick < self.cursor - 1:
+            # The clock went back, timers are due by their ticks against the new clock rather than the cursor left ahead
+            self._rebase(current_tick)
+        while self.cursor <= current_tick:
+            if self.count == 0:
+                self.cursor = current_tick + 1
+                break
+            self._cascade()
+
+            bucket = self.wheels[0][self.cursor % self.slots]
+            if bucket:
+                for handle in bucket:
+                    handle.bucket = None
+                    ready.append(handle)
+                self.level_counts[0] -= len(bucket)
+                self.count -= len(bucket)
+                bucket.clear()
+            self.cursor += 1
+
+            # Jump over ranges in which nothing can fire
+            level = self._lowest_pending_level()
+            if level == self.levels and self.overflow:
+                # Only far-off timers left, go straight to the top level boundary before the earliest one
+                span = self.spans[level]
+                earliest = min(handle.tick for handle in self.overflow)
+                self.cursor = max(self.cursor, min(earliest // span * span, current_tick + 1))
+            elif level > 0:
+                span = self.spans[level]
+                boundary = (self.cursor // span + 1) * span if self.cursor % span else self.cursor
+                self.cursor = min(boundary, current_tick + 1)
+        # Cascading and timers pushed for past ticks can leave a bucket out of push order
+        ready.sort(key=lambda handle: (handle.tick, handle.seq))
+        return [(handle.tick, handle.event, handle.data) for handle in ready]
+
+    def _place(self, handle):
+        delta = handle.tick - self.cursor
+        if delta < 0:
+            # Already due, fires on the next pop
+            level = 0
+            bucket = self.wheels[0][self.cursor % self.slots]
+        else:
+            for level in range(self.levels):
+                if delta < self.spans[level + 1]:
+                    bucket = self.wheels[level][(handle.tick // self.spans[level]) % self.slots]
+                    break
+            else:
+                level = self.levels
+                bucket = self.overflow
+        if level < self.levels:
+            self.level_counts[level] += 1
+        bucket[handle] = None
+        handle.bucket = bucket
+        handle.level = level
+
+    def _cascade(self):
+        """Moves the timers of every higher level slot that starts at the cursor down to the lower levels"""
+        if self.cursor % self.slots:
+            return
+        if self.overflow and self.cursor % self.spans[self.levels] == 0:
+            self._replace(self.overflow, self.levels)
+        for level in range(self.levels - 1, 0, -1):
+            if self.cursor % self.spans[level] == 0:
+                bucket = self.wheels[level][(self.cursor // self.spans[level]) % self.slots]
+                if bucket:
+                    self._replace(bucket, level)
+
+    def _replace(self, bucket, level):
+        handles = list(bucket)
+        bucket.clear()
+        if level < self.levels:
+            self.level_counts[level] -= len(handles)
+        for handle in handles:
+            self._place(handle)
+
+    def _rebase(self, tick):
+        """Moves the cursor to the given tick and places every pending timer again relative to it"""
+        handles = [handle for wheel in self.wheels for bucket in wheel for handle in bucket]
+        handles += list(self.overflow)
+        for wheel in self.wheels:
+            for bucket in wheel:
+                bucket.clear()
+        self.overflow.clear()
+        self.level_counts = [0] * self.levels
+        self.cursor = tick
+        for handle in handles:
+            self._place(handle)
+
+    def _lowest_pending_level(self):
+        for level in range(self.levels):
+            if self.level_counts[level]:
+                return level
+        return self.levels
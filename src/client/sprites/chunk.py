@@ -0,0 +1,26 @@
+import pygame
+from sprites.floor import Floor
+from sprites.wall import Wall
+
+class Chunk:
+    """Square block of map tiles drawn once into a surface of its own. Its tiles are positioned within the chunk, rect is where it lies on the map"""
+    def __init__(self, level_grid, chunk_x, chunk_y, chunk_cells, cell_size):
+        size = chunk_cells * cell_size
+        self.rect = pygame.Rect(chunk_x * size, chunk_y * size, size, size)
+        self.tiles = pygame.sprite.Group()
+
+        first_x = chunk_x * chunk_cells
+        first_y = chunk_y * chunk_cells
+        for y in range(first_y, min(first_y + chunk_cells, level_grid.height)):
+            for x in range(first_x, min(first_x + chunk_cells, level_grid.width)):
+                cell = level_grid.get(x, y)
+                normalized_x = (x - first_x) * cell_size
+                normalized_y = (y - first_y) * cell_size
+
+                if cell == 0:
+                    self.tiles.add(Floor(normalized_x, normalized_y, cell_size))
+                elif cell == 1:
+                    self.tiles.add(Wall(normalized_x, normalized_y, cell_size))
+
+        self.image = pygame.Surface((size, size)).convert()
+        self.tiles.draw(self.image)
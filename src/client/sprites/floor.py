@@ -1,7 +1,5 @@
 import pygame
-import os
-
-dirname = os.path.dirname(__file__)
+from sprites.textures import texture
 
 class Floor(pygame.sprite.Sprite):
     def __init__(self, x, y, cell_size):
@@ -9,9 +7,6 @@ class Floor(pygame.sprite.Sprite):
         self.pixel_x = x
         self.pixel_y = y
 
-        original = pygame.image.load(
-            os.path.join(dirname, "..", "assets", "Floor.png")
-        ).convert_alpha()
-        self.image = pygame.transform.scale(original, (cell_size, cell_size))
+        self.image = texture("Floor.png", cell_size)
 
         self.rect = self.image.get_rect(topleft=(x, y))
\ No newline at end of file
@@ -1,7 +1,5 @@
 import pygame
-import os
-
-dirname = os.path.dirname(__file__)
+from sprites.textures import texture
 
 class Player(pygame.sprite.Sprite):
     def __init__(self, x, y, cell_size):
@@ -10,10 +8,7 @@ class Player(pygame.sprite.Sprite):
         self.pixel_y = y
         self.cell_size = cell_size
 
-        original = pygame.image.load(
-            os.path.join(dirname, "..", "assets", "Player.png")
-        ).convert_alpha()
-        self.image = pygame.transform.scale(original, (self.cell_size, self.cell_size))
+        self.image = texture("Player.png", self.cell_size)
 
         self.rect = self.image.get_rect(topleft=(x, y))
 
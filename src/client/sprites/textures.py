@@ -0,0 +1,28 @@
+import pygame
+import os
+
+dirname = os.path.dirname(__file__)
+
+ASSETS = ("Bomb.png", "Explosion.png", "Floor.png", "Player.png", "Wall.png")
+
+# Shared by every sprite of the process: images as loaded by file name, and scaled by file name and cell size
+_originals = {}
+_scaled = {}
+
+def texture(name, cell_size):
+    """Returns the asset scaled to the cell size, loaded and scaled only the first time. Sprites share the surface and must not draw on it"""
+    key = (name, cell_size)
+    surface = _scaled.get(key)
+    if surface is None:
+        original = _originals.get(name)
+        if original is None:
+            original = pygame.image.load(os.path.join(dirname, "..", "assets", name)).convert_alpha()
+            _originals[name] = original
+        surface = pygame.transform.scale(original, (cell_size, cell_size))
+        _scaled[key] = surface
+    return surface
+
+def preload(cell_size):
+    """Loads every asset at the cell size up front, so sprites spawned mid-game never wait on the disk"""
+    for name in ASSETS:
+        texture(name, cell_size)
@@ -1,194 +1,253 @@
+import random
+import threading
 import time
 from queue import Queue
 from services.follower_comms import FollowerComms
-from services.queue_service import EventQueue
+from services.snapshot import Snapshot
+from services.failure_detector import PhiAccrualDetector
+from services import state_transfer
 from objects.bomb import BombObject
-from objects.explosion import ExplosionObject
 
 class Follower:
-    def __init__(self, server_loop):
+    """Follows the rooms one peer leads: keeps a connection to it, applies its committed batches and watches it for failure"""
+
+    def __init__(self, server_loop, peer_id, retry_min=0.05, retry_max=2.0):
         self.leader_queue = Queue()
         self.server_loop = server_loop
+        self.peer_id = peer_id
 
         self.comms = None
+        self.detector = None
+        # Set once the peer told us which rooms it leads, until then this node claims no rooms
+        self.synced = False
+        self.connecting = False
+        # Settled after the first connection attempt either way, so a node does not claim rooms of peers still being dialed
+        self.settled = False
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.retry_delay = retry_min
+        self.next_attempt = 0.0
+
+        # Batches and base snapshots are kept per room, each room has its own sequence numbers
+        self.pending_batches = {}
+        self.base_snapshots = {}
+
+    @property
+    def alive(self):
+        return self.comms is not None and self.comms.connected
+
+    def step(self):
+        """Processes what the peer sent since the last tick, drops the connection if the peer failed and redials it when due"""
+        if self.comms is not None:
+            if not self.comms.connected:
+                self.disconnect("Leader closed connection")
+            elif self.detector.is_suspected():
+                self.disconnect(f"Leader suspected after {self.detector.silence() * 1000:.0f} ms of silence (phi {self.detector.phi():.1f})")
+            else:
+                self.process_follower_messages()
+        if self.comms is None and not self.connecting and time.perf_counter() >= self.next_attempt:
+            self.connect()
 
-        self.event_queue = EventQueue()
-
-        self.last_tick = time.perf_counter()
-
-    def run(self):
-        """Runs the follower clock loop"""
-
+    def connect(self):
+        """Dials the peer off the tick thread, with a hello that tells it how far every room is"""
+        if self.server_loop.peer_addr(self.peer_id) is None:
+            return
+        self.connecting = True
+        self.pending_batches = {}
+        # The leader diffs a snapshot it has to send against the state we had when connecting
+        self.base_snapshots = {
+            room_id: Snapshot(room.encode_snapshot(self.server_loop.global_tick))
+            for room_id, room in self.server_loop.rooms.items()
+        }
+        rooms = [
+            [room_id, self.server_loop.rooms[room_id].last_applied_seq, state_transfer.digest(base)]
+            for room_id, base in self.base_snapshots.items()
+        ]
+        heartbeat_interval = self.server_loop.heartbeat_interval * self.server_loop.tick_interval
+        # The leader sends something at least every heartbeat interval, busier links do not mean shorter expected gaps
+        detector = PhiAccrualDetector(
+            self.server_loop.failure_threshold,
+            heartbeat_interval,
+            min_std=self.server_loop.failure_min_std_ms / 1000,
+            acceptable_pause=self.server_loop.failure_acceptable_pause_ms / 1000,
+            min_interval=heartbeat_interval
+        )
+        thread = threading.Thread(target=self._dial, args=(rooms, detector), daemon=True)
+        thread.start()
+
+    def _dial(self, rooms, detector):
         try:
-            self.comms = FollowerComms(self.server_loop.leader_addr, self.server_loop.server_id, self.leader_queue)
-
-            self.comms.connect_to_leader()
-            self.server_loop.last_heartbeat_tick = self.server_loop.global_tick
-            
-            self.last_tick = time.perf_counter()
-        
-            while True:
-                now = time.perf_counter()
-
-                while not self.server_loop.peer_queue.empty():
-                    msg = self.server_loop.peer_queue.get()
-                    if msg["type"] == "leader_announce":
-                        if msg["from"] < self.server_loop.leader_id:
-                            self.server_loop.has_leader = True
-                            self.server_loop.leader_id = msg["from"]
-                            self.server_loop.leader_addr = (self.server_loop.peers_config[msg["from"] - 1][1], self.server_loop.peers_config[msg["from"] - 1][2])
-                            return "LEADER_SWITCH"
-                        else:
-                            pass
-                    elif msg["type"] == "bully_ok":
-                        pass
-                    elif msg["type"] == "bully":
-                        self.server_loop.peer_queue.put(msg)
-                        return "NEED_ELECTION"
-                    elif msg["type"] == "state_request":
-                        self.server_loop.send_current_state(msg["from"])
-
-                if now - self.last_tick >= self.server_loop.tick_interval:
-                    self.server_loop.global_tick += 1
-                    self.last_tick += self.server_loop.tick_interval
-
-                    self.process_follower_messages()
-
-                time.sleep(0.0005)
-
-                if self.server_loop.global_tick - self.server_loop.last_heartbeat_tick > self.server_loop.heartbeat_timeout:
-                    print(self.server_loop.global_tick, self.server_loop.last_heartbeat_tick)
-                    print("[FOLLOWER] Leader timed out, starting election.")
-                    raise Exception
-
-        except Exception as e:
-            print(f"[FOLLOWER] Connection to Leader lost: {e}", flush=True)
-            #self.comms.close_socket()
-            return "NEED_ELECTION"
-        
+            self.leader_queue = Queue()
+            comms = FollowerComms(self.server_loop.peer_addr(self.peer_id), self.server_loop.server_id, self.leader_queue, rooms, detector)
+            self.detector = detector
+            self.retry_delay = self.retry_min
+            self.comms = comms
+        except Exception:
+            self.next_attempt = time.perf_counter() + self.retry_delay * random.uniform(0.5, 1.0)
+            self.retry_delay = min(self.retry_delay * 2, self.retry_max)
+            self.settled = True
+        self.connecting = False
+
+    def disconnect(self, reason):
+        """Forgets the peer as the leader of its rooms and schedules a redial"""
+        print(f"[FOLLOWER] Connection to server {self.peer_id} lost: {reason}", flush=True)
+        self.comms.close_socket()
+        self.comms = None
+        self.synced = False
+        self.settled = True
+        # Batches the peer sent but had not told us are committed are kept for whoever takes over its rooms
+        self.server_loop.forget_leader(self.peer_id)
+        self.next_attempt = time.perf_counter() + self.retry_delay
+
     def process_follower_messages(self):
         """Processes messages from leader in message queue"""
         while not self.leader_queue.empty():
                 msg = self.leader_queue.get()
-                print(f"[INPUT] Received {msg['type']} from leader", flush=True)
+                print(f"[INPUT] Received {msg['type']} from server {self.peer_id}", flush=True)
                 self.process_follower_message(msg)
 
     def process_follower_message(self, message):
         """Parses the given message"""
+        if message["type"] == "leading":
+            for room_id in message["rooms"]:
+                self.server_loop.room_leaders[room_id] = self.peer_id
+                self.server_loop.drop_retained(room_id, self)
+            self.synced = True
+            self.settled = True
+            return
+        if "tick" in message or "leader_tick" in message:
+            self.sync_clock_to_leader(message.get("leader_tick", message.get("tick")))
+        # Liveness heartbeats carry no room
+        if not self.server_loop.is_valid_room(message.get("room")):
+            return
+        room = self.server_loop.get_room(message["room"])
+        if message["type"] == "room_claim":
+            self.answer_claim(room, message["have"])
+            return
+        if self.server_loop.leader.leads(room.room_id):
+            print(f"[SHARDS] Ignoring {message['type']} of room {room.room_id} from server {self.peer_id}, this node leads it", flush=True)
+            return
+        if message["type"] != "room_release":
+            self.server_loop.room_leaders[room.room_id] = self.peer_id
+
         if message["type"] == "event":
-            ack = {
-                "type": "ack",
-                "tick": message["tick"]
-            }
-            self.comms.send_to_leader(ack)
-            if not self.wait_for_commit(self.server_loop.global_tick):
-                self.process_follower_message(message)
-                return
-            for event in message["data"]:
-                self.parse_event(event["event_type"], event["data"])
-        
+            if message["seq"] > room.last_applied_seq:
+                self.pending_batches.setdefault(room.room_id, {})[message["seq"]] = (message["tick"], message["data"])
+            self.apply_committed(room, message["commit"])
+
+        elif message["type"] == "curr_state":
+            snapshot = state_transfer.decode_transfer(message["transfer"], self.base_snapshots.get(room.room_id))
+            print(f"[FOLLOWER] Loading snapshot of room {room.room_id} at seq {snapshot.seq} from server {self.peer_id}", flush=True)
+            self.server_loop.load_state([snapshot])
+            pending = self.pending_batches.get(room.room_id, {})
+            self.pending_batches[room.room_id] = {seq: batch for seq, batch in pending.items() if seq > snapshot.seq}
+            # The leader only hands the room to a node that acked everything committed in it
+            self.comms.send_to_leader({"type": "ack", "room": room.room_id, "seq": snapshot.seq, "tick": snapshot.tick})
+
         elif message["type"] == "heartbeat":
-            leader_tick = message["tick"]
-            self.sync_clock_to_leader(leader_tick)
-            self.server_loop.last_heartbeat_tick = self.server_loop.global_tick
-
-    def wait_for_commit(self, tick):
-        """Blocks to wait for commit message from leader"""
-        #TODO ADD TIMEOUT
-        while not self.comms.commit:
-            time.sleep(0.0005)
-            continue
-        if self.comms.commit:
-            self.comms.commit = False
-            return True
+            self.apply_committed(room, message["commit"])
+
+        elif message["type"] == "room_release":
+            # Everything the peer did in the room is committed, the next owner continues from here
+            self.apply_committed(room, message["commit"])
+            self.pending_batches.pop(room.room_id, None)
+            if self.server_loop.room_leaders.get(room.room_id) == self.peer_id:
+                del self.server_loop.room_leaders[room.room_id]
+            print(f"[SHARDS] Server {self.peer_id} released room {room.room_id} at seq {room.last_applied_seq}", flush=True)
+
+    def answer_claim(self, room, have):
+        """Tells a peer taking over the room how far this node got in it, with every batch it holds beyond what the peer has"""
+        leading = self.server_loop.leader.leads(room.room_id)
+        if room.room_id in self.server_loop.leader.claims:
+            # Both nodes see themselves as the owner, the one earlier on the ring keeps its claim
+            preference = self.server_loop.ring.preference(room.room_id)
+            leading = preference.index(self.server_loop.server_id) < preference.index(self.peer_id)
+        reply = {"type": "room_log", "room": room.room_id, "last_seq": room.last_applied_seq, "leading": leading, "batches": []}
+        if not leading:
+            self.server_loop.room_leaders[room.room_id] = self.peer_id
+            if room.last_applied_seq > have:
+                applied = room.event_log.since(have)
+                if applied is None:
+                    # The peer is further behind than the event log goes back, it gets the whole room
+                    transfer = state_transfer.encode_transfer(Snapshot(room.encode_snapshot(self.server_loop.global_tick)), None)
+                    self.comms.send_to_leader({"type": "curr_state", "from": self.server_loop.server_id, "room": room.room_id, "transfer": transfer}, "binary")
+                    applied = []
+                reply["batches"] += [[seq, tick, events] for seq, tick, events in applied]
+            retained = self.server_loop.retained_batches(room.room_id)
+            reply["batches"] += [[seq, tick, events] for seq, (tick, events) in sorted(retained.items()) if seq > room.last_applied_seq]
+            # The peer replays them as the new leader, the copies held for the previous one are of no use any more
+            self.server_loop.drop_retained(room.room_id, self)
+        print(f"[SHARDS] Server {self.peer_id} claims room {room.room_id}, sending {len(reply['batches'])} batches after seq {have}", flush=True)
+        self.comms.send_to_leader(reply)
+
+    def apply_committed(self, room, commit_seq):
+        """Applies the buffered batches of the room up to the commit sequence number in order"""
+        pending = self.pending_batches.get(room.room_id)
+        if not pending:
+            return
+        for seq in sorted(seq for seq in pending if seq <= commit_seq):
+            tick, events = pending.pop(seq)
+            for event in events:
+                self.parse_event(room, event["event_type"], event["data"])
+            self.server_loop.record_committed(room, seq, tick, events)
 
     def sync_clock_to_leader(self, tick):
-        """Syncs its clock to leader's"""
-        self.server_loop.global_tick = tick
+        """Moves its clock forward to the peer's. Every node leads rooms of its own, so the clock only ever catches up to the fastest"""
+        if tick > self.server_loop.global_tick:
+            self.server_loop.global_tick = tick
 
-    def parse_event(self, event_type, event_data):
+    def parse_event(self, room, event_type, event_data):
         """Calls appropriate event handler for given event type"""
         # 0 = bomb spawn,
-        #  1 = bomb explode,
         #  2 = player moves,
-        #  3 = remove explosion,
-        #  4 = player stop
+        #  4 = player stop,
+        #  5 = explosion set
         match event_type:
-            case 0: self.spawn_bomb(event_data)
-            case 1: self.explode_bomb(event_data)
-            case 2: self.move_player(event_data)
-            case 3: self.remove_explosion(event_data[0], event_data[1], event_data[2])
-            case 4: self.finish_moving(event_data)
+            case 0: self.spawn_bomb(room, event_data)
+            case 2: self.move_player(room, event_data)
+            case 4: self.finish_moving(room, event_data)
+            case 5: self.apply_blast(room, event_data)
 
-    def spawn_bomb(self, data):
+    def spawn_bomb(self, room, data):
         x, y = data[0], data[1]
-        
+
         bomb_id = data[2]
         owner = data[3]
         explode_tick = data[4]
 
-        if self.server_loop.bomb_map[y][x] == 0:
-            self.server_loop.bombs[bomb_id] = BombObject(bomb_id, x, y, owner)
-            self.server_loop.bomb_map[y][x] = bomb_id
-        
-        self.event_queue.push(explode_tick, 1, bomb_id)
-        self.server_loop.global_bomb_id = bomb_id + 1
-
-    def explode_bomb(self, data):
-        bomb_id = data
-        if self.server_loop.bombs.get(bomb_id) is None: return
-        x, y, owner = self.server_loop.bombs[bomb_id].x, self.server_loop.bombs[bomb_id].y, self.server_loop.bombs[bomb_id].owner
-        self.server_loop.bomb_map[y][x] = 0
-        del self.server_loop.bombs[bomb_id]
-
-        self.spawn_explosion(x, y, owner)
-
-        for direction in [(1,0), (-1,0), (0,1), (0,-1)]:
-            nx, ny = x + direction[0], y + direction[1]
-            if 0 <= nx < len(self.server_loop.level_map[0]) and 0 <= ny < len(self.server_loop.level_map):
-                if self.server_loop.level_map[ny][nx] == 0:
-                    self.spawn_explosion(nx, ny, owner)
-                    if self.server_loop.bomb_map[ny][nx] != 0:
-                        chain_id = self.server_loop.bomb_map[ny][nx]
-                        self.event_queue.push(self.server_loop.global_tick, 1, chain_id)
-
-    def spawn_explosion(self, x, y, owner):
-        exp_id = self.global_explosion_id
-        new_explosion = ExplosionObject(x, y, owner)
-        self.server_loop.explosion_map[y][x] += 1
-        self.server_loop.explosions[exp_id] = new_explosion
-        
-        self.event_queue.push(self.server_loop.global_tick + 90, 3, (exp_id, x, y))
-        
-        self.global_explosion_id += 1
-
-    def remove_explosion(self, id, x, y):
-        if id in self.server_loop.explosions:
-            self.server_loop.explosion_map[y][x] -= 1
-            del self.server_loop.explosions[id]
-
-    def move_player(self, data):
+        if room.grid.bomb_at(x, y) == 0:
+            room.bombs[bomb_id] = BombObject(bomb_id, x, y, owner, explode_tick)
+            room.grid.set_bomb(x, y, bomb_id)
+
+    def apply_blast(self, room, data):
+        """Removes the exploded bombs and sets the cells of an explosion set burning"""
+        expire_tick, bomb_ids, cells = data
+        grid = room.grid
+        for bomb_id in bomb_ids:
+            bomb = room.bombs.pop(bomb_id, None)
+            if bomb is not None:
+                grid.set_bomb(bomb.x, bomb.y, 0)
+
+        for offset in range(0, len(cells), 2):
+            grid.ignite(cells[offset], cells[offset + 1], expire_tick)
+
+    def move_player(self, room, data):
         player_id, x, y = data[0], data[1], data[2]
-        player_x = self.server_loop.players[player_id].x
-        player_y = self.server_loop.players[player_id].y
+        player_x = room.players[player_id].x
+        player_y = room.players[player_id].y
         new_x = player_x + x
         new_y = player_y + y
-        if self.server_loop.players[player_id].moving:
+        if room.players[player_id].moving:
             return
-        if (0 <= new_x < len(self.server_loop.level_map[0])) and (0 <= new_y < len(self.server_loop.level_map)):
-            if self.server_loop.level_map[new_y][new_x] != 0:
-                return
-            elif self.server_loop.player_map[new_y][new_x] != 0:
-                return
-            elif self.server_loop.bomb_map[new_y][new_x] != 0:
+        grid = room.grid
+        if grid.in_bounds(new_x, new_y):
+            if grid.is_blocked(new_x, new_y):
                 return
             else:
-                self.server_loop.player_map[player_y][player_x] = 0
-                self.server_loop.player_map[new_y][new_x] = player_id
-                self.server_loop.players[player_id].move(x, y)
-                self.event_queue.push(self.server_loop.global_tick + 20, 4, player_id)
+                grid.move_player(player_x, player_y, new_x, new_y, player_id)
+                room.players[player_id].move(x, y)
 
-    def finish_moving(self, data):
+    def finish_moving(self, room, data):
         player_id = data[0]
-        if player_id in self.server_loop.players:
-            self.server_loop.players[player_id].moving = False
\ No newline at end of file
+        if player_id in room.players:
+            room.players[player_id].moving = False
\ No newline at end of file
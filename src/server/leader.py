@@ -1,371 +1,601 @@
 import time
-import json
-import threading
-from queue import Queue
 from services.comms import ClientComms
 from services.queue_service import EventQueue
+from services.replication import Replicator
+from services.blast import resolve_blast
+from services.framing import encode_message
+from services.snapshot import Snapshot
+from services.interest import InterestManager
+from services import state_transfer
 from objects.bomb import BombObject
-from objects.explosion import ExplosionObject
-import socket
+from follower import Follower
 
 
+class RoomChannel:
+    """Leader side of one room: its replication window, the events of the current tick and the clients playing in it"""
+
+    def __init__(self, room, replicator, tick, bucket_size=8):
+        self.room = room
+        self.replicator = replicator
+        self.outgoing_events = []
+        self.clients = set()
+        # Opened with nothing uncommitted, so the room state is the committed state the clients are told about
+        self.interest = InterestManager(room, bucket_size)
+        # (tick, input seq) of the client inputs handled but not acked yet, per client
+        self.input_acks = {}
+        self.commit_sent = replicator.commit_index
+        self.last_frame_tick = tick
+
+
+class RoomClaim:
+    """A room this node is about to lead. Its followers are asked for the batches they hold beyond this node's first,
+    so that none the previous leader committed are lost or numbered again"""
+
+    def __init__(self, room_id, have, tick):
+        self.room_id = room_id
+        self.have = have
+        self.started_tick = tick
+        # Followers asked and not answered yet, and the last batch every one that answered applied
+        self.waiting = set()
+        self.follower_seqs = {}
+        self.batches = {}
+        # Set when a follower was ahead of what its event log still holds
+        self.snapshot = None
+        # Clients that asked for the room meanwhile, with their handshakes
+        self.clients = []
+
+
+# Room id of heartbeats that only keep the failure detectors of followers fed
+LIVENESS_ROOM = 0xFFFF
+
 
 class Leader:
+    """Leads the rooms the hash ring assigns to this node. Every node runs one, next to a Follower per peer for the rooms the peers lead"""
+
     def __init__(self, server_loop):
         self.server_loop = server_loop
 
-        self.client_queues = {}
         my_config = self.server_loop.peers_config[self.server_loop.server_id-1]
-        self.comms = ClientComms(my_config[1], my_config[2])
+        self.comms = ClientComms(my_config[1], my_config[2], self.server_loop.max_outgoing_bytes)
         
         self.follower_sockets = {}
-        self.follower_queues = {}
-
-        self.client_sockets = []
-        self.outgoing_events = []
-        self.last_tick = time.perf_counter()
+        self.follower_ids = {}
+        # Each room is replicated on its own, with its own sequence numbers and commit index
+        self.channels = {}
+        self.claims = {}
+
+        self.client_rooms = {}
+        # Followers get the commit index and leader tick on every frame, explicit heartbeats only fill idle gaps
+        self.last_follower_frame_tick = self.server_loop.global_tick
         self.comms.start_listening()
-        self.accepting_clients = True
-        accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
-        accept_thread.start()
 
-    def run(self):
-        """Runs the general clock loop of leader"""
+    def leads(self, room_id):
+        return room_id in self.channels
+
+    def open_room(self, room_id, follower_seqs=None):
+        """Returns the channel of the room, taking over its replication and timers on first use.
+        follower_seqs holds the last batch of the room every follower is known to have"""
+        channel = self.channels.get(room_id)
+        if channel is None:
+            room = self.server_loop.get_room(room_id)
+            # Followers keep no timers, build them from the replicated bombs
+            room.rearm_timers(self.server_loop.global_tick)
+            replicator = Replicator(
+                self.server_loop.max_in_flight_ticks,
+                first_seq=room.last_applied_seq + 1,
+                commit_policy=self.server_loop.commit_policy,
+                ack_timeout=self.server_loop.follower_ack_timeout
+            )
+            for follower_id in self.follower_sockets:
+                replicator.add_follower(follower_id, (follower_seqs or {}).get(follower_id, 0))
+            channel = RoomChannel(room, replicator, self.server_loop.global_tick, self.server_loop.interest_bucket_size)
+            self.channels[room_id] = channel
+            print(f"[SHARDS] Leading room {room_id} from seq {room.last_applied_seq}", flush=True)
+            # Tells the followers who leads the room now
+            self.send_heartbeat(channel)
+        return channel
+
+    def release_room(self, channel, owner):
+        """Hands a room over to the node that owns it now. Waits until everything sent in it is committed and the
+        new owner follows this node and acked all of it, then points its clients to the new owner and tells the followers the last committed batch"""
+        replicator = channel.replicator
+        if replicator.in_flight or replicator.pending_tick is not None:
+            return
+        if owner not in self.follower_sockets or replicator.follower_acked.get(owner, -1) < replicator.commit_index:
+            return
+        room_id = channel.room.room_id
+        print(f"[SHARDS] Releasing room {room_id} at seq {replicator.commit_index} to server {owner}", flush=True)
+        del self.channels[room_id]
+        for sock in channel.clients:
+            self.client_rooms.pop(sock, None)
+            self.redirect_client(sock, room_id, owner)
+        msg = {
+            "type": "room_release",
+            "leader_id": self.server_loop.server_id,
+            "room": room_id,
+            "tick": self.server_loop.global_tick,
+            "commit": replicator.commit_index
+        }
+        self.broadcast_msg(msg)
+
+    def rebalance(self):
+        """Releases the rooms another live node owns now, and claims the owned rooms nobody leads"""
+        server_id = self.server_loop.server_id
+        for channel in list(self.channels.values()):
+            owner = self.server_loop.room_owner(channel.room.room_id)
+            if owner != server_id:
+                self.release_room(channel, owner)
+
+        # Claiming waits for every peer to say what it leads, or a room could end up with two leaders
+        if not self.server_loop.links_settled():
+            return
+        for room_id in list(self.server_loop.rooms):
+            if room_id not in self.channels and room_id not in self.claims and room_id not in self.server_loop.room_leaders and self.server_loop.room_owner(room_id) == server_id:
+                self.claim_room(room_id)
+
+    def claim_room(self, room_id):
+        """Starts taking over a room by asking every follower what it has of it beyond this node"""
+        claim = self.claims.get(room_id)
+        if claim is None:
+            claim = RoomClaim(room_id, self.server_loop.get_room(room_id).last_applied_seq, self.server_loop.global_tick)
+            self.claims[room_id] = claim
+            print(f"[SHARDS] Claiming room {room_id} at seq {claim.have}, asking {len(self.follower_sockets)} followers for newer batches", flush=True)
+            for server_id, sock in self.follower_sockets.items():
+                self.ask_claim(claim, server_id, sock)
+        return claim
+
+    def ask_claim(self, claim, server_id, sock):
+        claim.waiting.add(server_id)
+        msg = {"type": "room_claim", "leader_id": self.server_loop.server_id, "room": claim.room_id, "have": claim.have}
+        self.comms.send(sock, encode_message(msg))
+
+    def claim_answered(self, server_id, msg):
+        """Keeps what a follower holds of a claimed room, or gives the claim up if the follower leads the room itself"""
+        claim = self.claims.get(msg["room"])
+        if claim is None:
+            return
+        if msg["leading"]:
+            self.abandon_claim(claim, server_id)
+            return
+        claim.follower_seqs[server_id] = msg["last_seq"]
+        for seq, tick, events in msg["batches"]:
+            claim.batches.setdefault(seq, (tick, events))
+        claim.waiting.discard(server_id)
+
+    def claim_snapshot(self, msg):
+        """Keeps the state of a claimed room from a follower that was too far ahead to send batches"""
+        claim = self.claims.get(msg["room"])
+        if claim is None:
+            return
+        snapshot = state_transfer.decode_transfer(msg["transfer"], None)
+        if claim.snapshot is None or snapshot.seq > claim.snapshot.seq:
+            claim.snapshot = snapshot
+
+    def abandon_claim(self, claim, leader_id):
+        print(f"[SHARDS] Server {leader_id} leads room {claim.room_id}, giving up the claim", flush=True)
+        del self.claims[claim.room_id]
+        self.server_loop.room_leaders[claim.room_id] = leader_id
+        for sock, _ in claim.clients:
+            self.redirect_client(sock, claim.room_id, leader_id)
+
+    def finish_claims(self):
+        """Takes over the claimed rooms every live peer answered for, or that waited long enough"""
+        followers = set(self.follower_sockets)
+        peers = self.server_loop.alive_nodes() - {self.server_loop.server_id}
+        for claim in list(self.claims.values()):
+            leader_id = self.server_loop.room_leaders.get(claim.room_id)
+            if leader_id is not None:
+                self.abandon_claim(claim, leader_id)
+                continue
+            answered = not claim.waiting and peers <= followers
+            if not answered and self.server_loop.global_tick - claim.started_tick < self.server_loop.claim_timeout_ticks:
+                continue
+            del self.claims[claim.room_id]
+            self.take_over(claim)
+
+    def take_over(self, claim):
+        """Applies what the followers had of the room beyond this node, then leads it from the highest batch found anywhere"""
+        room = self.server_loop.get_room(claim.room_id)
+        if claim.snapshot is not None and claim.snapshot.seq > room.last_applied_seq:
+            self.server_loop.load_state([claim.snapshot])
+        # Every copy of a batch comes from the same leader, so any of them will do
+        batches = self.server_loop.retained_batches(claim.room_id)
+        batches.update(claim.batches)
+        self.server_loop.drop_retained(claim.room_id)
+        replayer = Follower(self.server_loop, None)
+        seq = room.last_applied_seq + 1
+        while seq in batches:
+            tick, events = batches[seq]
+            for event in events:
+                replayer.parse_event(room, event["event_type"], event["data"])
+            self.server_loop.record_committed(room, seq, tick, events)
+            seq += 1
+        if seq - 1 > claim.have:
+            print(f"[SHARDS] Recovered batches {claim.have + 1} to {seq - 1} of room {claim.room_id} from followers", flush=True)
+
+        channel = self.open_room(claim.room_id, claim.follower_seqs)
+        for server_id, sock in self.follower_sockets.items():
+            self.catch_up_follower(sock, server_id, channel, claim.follower_seqs.get(server_id, 0))
+        for sock, handshake in claim.clients:
+            self.add_client(sock, handshake)
+
+    def tick(self):
+        """Runs one tick of every room this node leads"""
+        if self.server_loop.global_tick % 60 == 0:
+            print(f"[LEADER] Global Tick: {self.server_loop.global_tick}, leading {len(self.channels)} of {len(self.server_loop.rooms)} rooms, {len(self.client_rooms)} clients", flush=True)
+            for room_id, channel in self.channels.items():
+                if channel.clients:
+                    print(f"[REPLICATION] Room {room_id} {channel.replicator.metrics()}", flush=True)
+
+        if self.server_loop.global_tick % 50 == 0:
+            self.send_clock_sync()
+
+        for channel in self.channels.values():
+            channel.outgoing_events = []
+
+        self.leader_process_inputs()
+        self.finish_claims()
+        for channel in list(self.channels.values()):
+            self.leader_handle_events(channel)
+            self.broadcast_state(channel)
+            self.send_input_acks(channel)
+
+        for channel in self.channels.values():
+            if channel.replicator.commit_index > channel.commit_sent and self.server_loop.global_tick - channel.last_frame_tick >= self.server_loop.commit_flush_ticks:
+                # No event frame came along to carry the new commit index of the room
+                self.send_heartbeat(channel)
+        if self.server_loop.global_tick - self.last_follower_frame_tick >= self.server_loop.heartbeat_interval:
+            self.send_liveness()
+        # Everything sent this tick goes out with a single wakeup of the network loop
+        self.comms.flush()
+
+    def add_client(self, sock, handshake):
+        """Registers a connection that identified itself as a client in the room it asked for, or points it to the room's leader"""
+        room_id = handshake.get("room", self.server_loop.default_room)
+        if not self.server_loop.is_valid_room(room_id):
+            print(f"[NET] Client asked for invalid room {room_id}, closing", flush=True)
+            self.comms.close(sock)
+            return
+        if room_id not in self.channels:
+            leader_id = self.server_loop.leader_of(room_id)
+            if leader_id != self.server_loop.server_id or not self.server_loop.links_settled():
+                self.redirect_client(sock, room_id, leader_id)
+                return
+            # Joins once the followers told what they have of the room
+            self.claim_room(room_id).clients.append((sock, handshake))
+            return
+        print(f"[NET] Connection identified as CLIENT in room {room_id}", flush=True)
+        self.comms.accept_encoding(sock, handshake)
+        channel = self.open_room(room_id)
+        channel.clients.add(sock)
+        self.client_rooms[sock] = channel
+
+        if channel.room.new_player_id <= 4: 
+            channel.room.new_player_id += 1
+
+        # The client only hears about what is around the player it plays, and is told about all of that right away
+        radius = handshake.get("radius")
+        if not isinstance(radius, int):
+            radius = self.server_loop.interest_radius
+        radius = min(max(radius, 1), self.server_loop.max_interest_radius)
+        visible = channel.interest.add_client(sock, handshake.get("player"), radius)
+        if visible:
+            self.comms.broadcast([sock], "update", visible, self.server_loop.global_tick, channel.replicator.commit_index)
+
+    def add_follower(self, sock, handshake):
+        """Registers a connection that identified itself as a follower node"""
+        print(f"[NET] Connection identified as FOLLOWER SERVER", flush=True)
+        server_id = handshake.get("server_id")
+        previous = self.follower_sockets.get(server_id)
+        if previous is not None and previous is not sock:
+            self.follower_ids.pop(previous, None)
+            self.comms.close(previous)
+        self.comms.accept_encoding(sock, handshake)
+        self.follower_sockets[server_id] = sock
+        self.follower_ids[sock] = server_id
+        # The follower reports the last batch it applied and a digest of its grids for every room it has
+        known = {room_id: (last_seq, have) for room_id, last_seq, have in handshake.get("rooms", [])}
+        for room_id, channel in self.channels.items():
+            last_seq, have = known.get(room_id, (0, None))
+            channel.replicator.add_follower(server_id, min(last_seq, channel.replicator.next_seq - 1))
+            self.catch_up_follower(sock, server_id, channel, last_seq, have)
+        # Once caught up, the follower knows which rooms not to claim
+        self.comms.send(sock, encode_message({"type": "leading", "leader_id": self.server_loop.server_id, "rooms": list(self.channels)}))
+        for claim in self.claims.values():
+            self.ask_claim(claim, server_id, sock)
+
+    def redirect_client(self, sock, room_id, leader_id):
+        """Tells a client which server leads its room and closes the connection"""
+        address = self.server_loop.peer_addr(leader_id)
+        print(f"[NET] Redirecting client of room {room_id} to server {leader_id}", flush=True)
+        if address is not None:
+            self.comms.send(sock, encode_message({"type": "redirect", "room": room_id, "host": address[0], "port": address[1]}))
+        self.comms.close(sock)
+
+    def catch_up_follower(self, sock, server_id, channel, last_seq, have=None):
+        """Sends a returning follower the committed batches of the room it missed, or a snapshot if they are no longer in the event log"""
+        room_id = channel.room.room_id
+        missing = channel.room.event_log.since(last_seq)
+        if missing is None:
+            print(f"[REPLICATION] Follower {server_id} at seq {last_seq} of room {room_id} is behind the event log, sending snapshot", flush=True)
+            snapshot = Snapshot(channel.room.encode_snapshot(self.server_loop.global_tick, self.applied_seq(room_id)))
+            transfer = state_transfer.encode_transfer(snapshot, have)
+            print(f"[STATE] Sending {len(transfer)} bytes of room {room_id} to follower {server_id}, grids {state_transfer.describe(transfer)}", flush=True)
+            msg = {"type": "curr_state", "from": self.server_loop.server_id, "room": room_id, "transfer": transfer}
+            self.comms.send(sock, encode_message(msg, "binary"))
+            return
+        if missing:
+            print(f"[REPLICATION] Catching up follower {server_id} with {len(missing)} batches of room {room_id}", flush=True)
+            for seq, tick, events in missing:
+                self.send_batch(channel, seq, tick, events, [sock])
+
+        for entry in channel.replicator.in_flight.values():
+            self.send_batch(channel, entry.seq, entry.tick, entry.events, [sock])
+
+    def remove_connection(self, sock):
+        """Forgets a client or follower whose connection was closed"""
+        self.comms.encodings.pop(sock, None)
+        channel = self.client_rooms.pop(sock, None)
+        if channel is not None:
+            print(f"[NET] Client disconnected from room {channel.room.room_id}", flush=True)
+            channel.clients.discard(sock)
+            channel.interest.remove_client(sock)
+            channel.input_acks.pop(sock, None)
+        for claim in self.claims.values():
+            claim.clients = [(client, handshake) for client, handshake in claim.clients if client is not sock]
+        follower_id = self.follower_ids.pop(sock, None)
+        if follower_id is not None and self.follower_sockets.get(follower_id) is sock:
+            print(f"[NET] Follower {follower_id} disconnected", flush=True)
+            del self.follower_sockets[follower_id]
+            for channel in self.channels.values():
+                channel.replicator.forget_follower(follower_id)
+            for claim in self.claims.values():
+                claim.waiting.discard(follower_id)
+
+    def send_heartbeat(self, channel):
+        """Sends heartbeat message to let followers know it is still alive and how far the log of the room is committed"""
+        msg = {
+            "type": "heartbeat",
+            "leader_id": self.server_loop.server_id,
+            "room": channel.room.room_id,
+            "tick": self.server_loop.global_tick,
+            "commit": channel.replicator.commit_index
+        }
+        self.broadcast_msg(msg)
+        self.last_follower_frame_tick = self.server_loop.global_tick
+        channel.last_frame_tick = self.server_loop.global_tick
+        channel.commit_sent = channel.replicator.commit_index
 
-        self.last_tick = time.perf_counter()
-        
-        while True:
-            now = time.perf_counter()
-            if now - self.last_tick >= self.server_loop.tick_interval:
-                self.server_loop.global_tick += 1
-                self.last_tick += self.server_loop.tick_interval
-
-                while not self.server_loop.peer_queue.empty():
-                    msg = self.server_loop.peer_queue.get()
-                    if msg["type"] == "leader_announce":
-                        if msg["from"] < self.server_loop.server_id:
-                            self.server_loop.has_leader = True
-                            self.server_loop.leader_id = msg["from"]
-                            self.server_loop.leader_addr = (self.server_loop.peers_config[msg["from"] - 1][1], self.server_loop.peers_config[msg["from"] - 1][2])
-                            
-                            self.accepting_clients = False
-
-                            try:
-                                self.comms.server.close()
-                            except:
-                                pass
-                            self.comms.server = None
-
-                            for client_sock in self.client_sockets:
-                                try:
-                                    client_sock.shutdown(socket.SHUT_RDWR)
-                                except:
-                                    pass
-
-                                try:
-                                    client_sock.close()
-                                except:
-                                    pass
-
-                            self.client_sockets.clear()
-                            
-                            return "DEMOTION"
-                        else:
-                            self.server_loop.send_leader_announce()
-                    elif msg["type"] == "bully_ok":
-                        pass
-                    elif msg["type"] == "bully":
-                        pass
-                    elif msg["type"] == "state_request":
-                        self.server_loop.send_current_state(msg["from"])
-
-                if self.server_loop.global_tick % 60 == 0:
-                    print(f"[LEADER] Global Tick: {self.server_loop.global_tick}", flush=True)
-
-                if self.server_loop.global_tick % 50 == 0:
-                    self.send_clock_sync()
-
-                if self.server_loop.global_tick - self.server_loop.last_heartbeat_sent >= self.server_loop.heartbeat_interval:
-                    self.send_heartbeat()
-                    self.server_loop.last_heartbeat_sent = self.server_loop.global_tick
-
-                self.outgoing_events = []
-
-
-                self.leader_process_inputs()
-                self.leader_handle_events()
-                self.broadcast_state()
-
-            time.sleep(0.0005)
-
-
-    def accept_clients(self):
-        """Accepts new clients and starts a thread for them. Identifies the connections either as clients or as follower nodes"""
-        while self.accepting_clients:
-            try:
-                sock = self.comms.receive_connection()
-                if not sock:
-                    continue
-                
-                print(f"[NET] Accepted new connection", flush=True)
-
-                try:
-                    raw = sock.recv(1024).decode("utf-8")
-                    handshake = json.loads(raw)
-                except:
-                    print("[NET] Invalid handshake, closing socket", flush=True)
-                    sock.close()
-                    continue
-                
-                msg_type = handshake.get("type")
-
-                if msg_type == "client_hello":
-                    print("[NET] Connection identified as CLIENT", flush=True)
-                    self.client_sockets.append(sock)
-
-                    client_q = Queue()
-                    self.client_queues[sock] = client_q
-                    
-                    thread = threading.Thread(
-                        target=self.comms.handle,
-                        args=(sock, client_q),
-                        daemon=True
-                    )
-                    thread.start()
-                    
-                    if self.server_loop.new_player_id <= 4: 
-                        self.server_loop.new_player_id += 1
-
-                elif msg_type == "server_hello":
-                    print(f"[NET] Connection identified as FOLLOWER SERVER", flush=True)
-
-                    server_id = handshake.get("server_id")
-                    self.follower_sockets[server_id] = sock
-
-                    self.follower_queues[server_id] = Queue()
-
-                    thread = threading.Thread(
-                        target=self.comms.handle_follower,
-                        args=(sock, self.follower_queues[server_id]),
-                        daemon=True
-                    )
-                    thread.start()
-
-                else:
-                    print(f"[NET] Unknown handshake type: {msg_type}", flush=True)
-                    sock.close()
-
-            except Exception as e:
-                print(f"[NET] Accept error: {e}", flush=True)
-                break
-
-    def send_heartbeat(self):
-        """Sends heartbeat message to let followers know it is still alive"""
+    def send_liveness(self):
+        """Sends a heartbeat for no room, so followers of a node that leads nothing busy still hear from it"""
         msg = {
             "type": "heartbeat",
             "leader_id": self.server_loop.server_id,
-            "tick": self.server_loop.global_tick
+            "room": LIVENESS_ROOM,
+            "tick": self.server_loop.global_tick,
+            "commit": 0
         }
-        raw = json.dumps(msg).encode("utf-8")
-        self.broadcast_msg(raw)
+        self.broadcast_msg(msg)
+        self.last_follower_frame_tick = self.server_loop.global_tick
+
+    def send_batch(self, channel, seq, tick, events, socks=None):
+        """Sends a tick batch of a room to followers together with the commit index of the room and the leader tick"""
+        msg = {
+            "type": "event",
+            "room": channel.room.room_id,
+            "seq": seq,
+            "tick": tick,
+            "commit": channel.replicator.commit_index,
+            "leader_tick": self.server_loop.global_tick,
+            "data": events
+        }
+        self.broadcast_msg(msg, socks)
 
     def send_clock_sync(self):
         """Sends clock sync message to clients"""
         tick = self.server_loop.global_tick
         timestamp = time.perf_counter()
         print(f"[CLOCK] Syncing clients to tick {tick}", flush=True)
-        self.comms.broadcast(self.client_sockets, "clock", {"server_tick": tick, "timestamp": timestamp}, tick)
-
-    def send_event_to_followers(self, event):
-        """Sends given event to followers"""
-        msg = {"type": "event", "event": event}
-        raw = json.dumps(msg).encode()
-        for sock in self.follower_sockets.values():
-            sock.sendall(raw)
-
-    def broadcast_state(self):
-        """Broadcasts new events to followers and clients (if followers ack. Otherwise tries again)"""
-        if len(self.outgoing_events) == 0:
-            return
-        
-        for sock in self.follower_sockets.values():
-            try:
-                self.comms.broadcast([sock], "event", self.outgoing_events, self.server_loop.global_tick)
-            except:
-                print("[NET] Follower disconnected during broadcast of event", flush=True)
-                #TODO DELETE DISCONNECTED FOLLOWERS
-        if not self.wait_for_acks(self.server_loop.global_tick):
-            self.broadcast_state()
+        self.comms.broadcast(self.client_rooms.keys(), "clock", {"server_tick": tick, "timestamp": timestamp}, tick)
+
+    def applied_seq(self, room_id):
+        """Returns the sequence number that covers every event already applied to the room, sent or not"""
+        channel = self.channels.get(room_id)
+        if channel is None:
+            return self.server_loop.rooms[room_id].last_applied_seq
+        seq = channel.replicator.next_seq - 1
+        if channel.outgoing_events or channel.replicator.pending_tick is not None:
+            seq += 1
+        return seq
+
+    def broadcast_state(self, channel):
+        """Sends this tick's events of the room to followers, and updates of the ticks they acked to its clients. Never waits for acks"""
+        followers = self.follower_sockets.keys()
+        replicator = channel.replicator
+
+        entry = replicator.submit(self.server_loop.global_tick, channel.outgoing_events, followers)
+
+        for committed in replicator.advance(followers):
+            self.server_loop.record_committed(channel.room, committed.seq, committed.tick, committed.events)
+            # The index follows every committed batch, clients joining an empty room are told where things are now
+            channel.interest.apply(committed.events)
+            if channel.clients:
+                self.send_updates(channel, committed)
+
+        # One frame per follower carries the new batch and whatever was committed just now
+        if entry is not None:
+            self.send_batch(channel, entry.seq, entry.tick, entry.events)
+            self.last_follower_frame_tick = self.server_loop.global_tick
+            channel.last_frame_tick = self.server_loop.global_tick
+            channel.commit_sent = replicator.commit_index
+
+    def send_updates(self, channel, committed):
+        """Sends every client of the room the part of a committed batch around its player, the interest index already has
+        the batch applied. Clients that see the whole batch share one encoding of it"""
+        streams = channel.interest.streams(committed.events)
+        everything = [sock for sock, stream in streams.items() if stream is committed.events]
+        if everything:
+            self.comms.broadcast(everything, "update", committed.events, committed.tick, committed.seq)
+        for sock, stream in streams.items():
+            if stream is not committed.events:
+                self.comms.broadcast([sock], "update", stream, committed.tick, committed.seq)
+
+    def send_input_acks(self, channel):
+        """Tells clients the last of their inputs whose outcome they have been sent, once every tick up to it is committed.
+        Clients predict their own moves and replay the inputs after the acked one on top of the committed state"""
+        if not channel.input_acks:
             return
-        
-        for sock in self.follower_sockets.values():
-            try:
-                self.comms.broadcast([sock], "commit", [], self.server_loop.global_tick)
-            except Exception as e:
-                print(f"[NET] Follower disconnected during broadcast of commit: {e}", flush=True)
-                #TODO DELETE DISCONNECTED FOLLOWERS
-        
-        active_sockets = []
-        for sock in self.client_sockets:
-            try:
-                self.comms.broadcast([sock], "update", self.outgoing_events, self.server_loop.global_tick)
-                active_sockets.append(sock)
-            except:
-                print("[NET] Client disconnected during broadcast", flush=True)
-                if sock in self.client_queues:
-                    del self.client_queues[sock]
-        
-        self.client_sockets = active_sockets
-
-    def wait_for_acks(self, tick):
-        """Blocks to wait for acks"""
-        #TODO ADD TIMEOUT
-        while self.comms.acks < len(self.follower_sockets):
-            time.sleep(0.0005)
-            continue
-        if self.comms.acks == len(self.follower_sockets):
-            self.comms.acks = 0
-            return True
+        oldest = channel.replicator.oldest_uncommitted_tick()
+        for sock, acks in list(channel.input_acks.items()):
+            released = [seq for tick, seq in acks if oldest is None or tick < oldest]
+            if not released:
+                continue
+            remaining = acks[len(released):]
+            if remaining:
+                channel.input_acks[sock] = remaining
+            else:
+                del channel.input_acks[sock]
+            msg = {"type": "input_ack", "seq": max(released), "tick": self.server_loop.global_tick}
+            self.comms.send(sock, self.comms.frame_for(sock, msg, {}))
 
     def leader_process_inputs(self):
-        """Processes input from clients"""
-        for client, q in self.client_queues.items():
-            while not q.empty():
-                msg = q.get()
-                print(f"[INPUT] Received {msg['event_type']} from client", flush=True)
-                self.leader_handle_input(client, msg)
+        """Processes connection changes and input from clients received since the last tick"""
+        for kind, sock, msg in self.comms.receive_batch():
+            match kind:
+                case "client":
+                    self.add_client(sock, msg)
+                case "follower":
+                    self.add_follower(sock, msg)
+                case "closed":
+                    self.remove_connection(sock)
+                case "message":
+                    if sock in self.client_rooms:
+                        print(f"[INPUT] Received {msg['event_type']} from client", flush=True)
+                        self.leader_handle_input(sock, msg)
+                    elif sock in self.follower_ids:
+                        self.leader_handle_follower(self.follower_ids[sock], msg)
+
+    def leader_handle_follower(self, server_id, msg):
+        """Handles acks of replicated batches and answers to room claims from a follower"""
+        match msg.get("type"):
+            case "ack":
+                channel = self.channels.get(msg.get("room", self.server_loop.default_room))
+                if channel is not None:
+                    channel.replicator.record_ack(server_id, msg["seq"])
+            case "room_log":
+                self.claim_answered(server_id, msg)
+            case "curr_state":
+                self.claim_snapshot(msg)
 
     def leader_handle_input(self, client, msg):
-        self.leader_parse_event(msg["event_type"], msg["data"])
-
-    def leader_handle_events(self):
-        """Handles timed events from event queue"""
-        ready = self.server_loop.event_queue.pop_ready(self.server_loop.global_tick)
+        channel = self.client_rooms[client]
+        self.leader_parse_event(channel, msg["event_type"], msg["data"])
+        if "seq" in msg:
+            channel.input_acks.setdefault(client, []).append((self.server_loop.global_tick, msg["seq"]))
+
+    def leader_handle_events(self, channel):
+        """Handles timed events from the event queue of the room"""
+        ready = channel.room.event_queue.pop_ready(self.server_loop.global_tick)
+        if not ready:
+            return
+        exploding = []
         for event in ready:
-            self.leader_parse_event(event[1], event[2])
+            if event[1] == 1:
+                exploding.append(event[2])
+            else:
+                self.leader_parse_event(channel, event[1], event[2])
+        # All bombs due this tick go off together, chains included
+        if exploding:
+            self.leader_explode_bombs(channel, exploding)
 
 
-    def leader_parse_event(self, event_type, event_data):
+    def leader_parse_event(self, channel, event_type, event_data):
         """Calls appropriate event handler according to event type"""
         # 0 = bomb spawn
         # 1 = bomb explode
         # 2 = player moves
-        # 3 = remove explosion
+        # 3 = unused, explosions burn out by the expire tick in the explosion grid
         # 4 = player stops moving
+        # 5 = explosion set, sent to followers and clients instead of 1
         match event_type:
             case 0:
-                self.leader_spawn_bomb(event_data)
+                self.leader_spawn_bomb(channel, event_data)
             case 1:
-                self.leader_explode_bomb(event_data)
+                self.leader_explode_bombs(channel, [event_data])
             case 2:
-                self.leader_move_player(event_data)
-            case 3:
-                self.leader_remove_explosion(event_data[0], event_data[1], event_data[2])
+                self.leader_move_player(channel, event_data)
             case 4:
-                self.leader_finish_moving(event_data)
+                self.leader_finish_moving(channel, event_data)
 
-    def leader_spawn_bomb(self, data):
+    def leader_spawn_bomb(self, channel, data):
         """Spawns a new bomb object"""
+        room = channel.room
         x, y = data[0], data[1]
         print(x,y)
-        if self.server_loop.bomb_map[y][x] != 0:
+        if room.grid.bomb_at(x, y) != 0:
             return
-        bomb_id = self.server_loop.global_bomb_id
+        bomb_id = room.bombs.allocate()
         owner = data[2]
-        self.server_loop.bombs[bomb_id] = BombObject(bomb_id, x, y, owner)
-        self.server_loop.bomb_map[y][x] = bomb_id
         explode_tick = self.server_loop.global_tick + 120
-        self.server_loop.event_queue.push(explode_tick, 1, bomb_id)
-        self.outgoing_events.append({"event_type": 0, "data": [x, y, bomb_id, owner, explode_tick]})
-        self.server_loop.global_bomb_id += 1
-
-    def leader_explode_bomb(self, data):
-        """Explodes given bomb"""
-        bomb_id = data
-        if self.server_loop.bombs.get(bomb_id) is None:
+        bomb = BombObject(bomb_id, x, y, owner, explode_tick)
+        room.bombs[bomb_id] = bomb
+        room.grid.set_bomb(x, y, bomb_id)
+        bomb.timer = room.event_queue.push(explode_tick, 1, bomb_id)
+        channel.outgoing_events.append({"event_type": 0, "data": [x, y, bomb_id, owner, explode_tick]})
+
+    def leader_explode_bombs(self, channel, bomb_ids):
+        """Explodes the given bombs and every bomb caught in their blasts, and sends the whole blast as one explosion set event"""
+        room = channel.room
+        grid = room.grid
+        exploded, cells = resolve_blast(grid, room.bombs, bomb_ids, self.server_loop.blast_radius)
+        if not exploded:
             #already exploded
             return
-        x, y, owner = self.server_loop.bombs[bomb_id].x, self.server_loop.bombs[bomb_id].y, self.server_loop.bombs[bomb_id].owner
-        self.server_loop.bomb_map[y][x] = 0
-        del self.server_loop.bombs[bomb_id]
-        self.leader_spawn_explosion(x, y, owner)
-        for direction in [(1,0), (-1,0), (0,1), (0,-1)]:
-            nx = x + direction[0]
-            ny = y + direction[1]
-            if nx < 0 or nx > len(self.server_loop.level_map[0]) - 1 or ny < 0 or ny > len(self.server_loop.level_map) - 1:
-                continue
-            if self.server_loop.level_map[ny][nx] != 0:
-                continue
-            self.leader_spawn_explosion(nx, ny, owner)
-            if self.server_loop.bomb_map[ny][nx] != 0:
-                chain_bomb_id = self.server_loop.bomb_map[ny][nx]
-                self.server_loop.event_queue.push(self.server_loop.global_tick, 1, chain_bomb_id)
-                self.outgoing_events.append({"event_type": 0, "data": [nx, ny, chain_bomb_id, self.server_loop.bombs[chain_bomb_id].owner, self.server_loop.global_tick]})
-                continue
-
-    def leader_spawn_explosion(self, x, y, owner):
-        """Spawns explosion objects with give coordinates"""
-        new_explosion = ExplosionObject(x, y, owner)
-        self.server_loop.explosion_map[y][x] += 1
-        self.server_loop.explosions[self.server_loop.global_explosion_id] = new_explosion
-        self.server_loop.event_queue.push(self.server_loop.global_tick + 90, 3, (self.server_loop.global_explosion_id, x, y))
-        self.server_loop.global_explosion_id += 1
-
-    def leader_remove_explosion(self, id, x, y):
-        """removes given explosion object"""
-        self.server_loop.explosion_map[y][x] -= 1
-        del self.server_loop.explosions[id]
-
-    def leader_move_player(self, data):
+        for bomb_id in exploded:
+            bomb = room.bombs.pop(bomb_id)
+            grid.set_bomb(bomb.x, bomb.y, 0)
+            # Chained bombs go off early, drop their own explode timers
+            room.event_queue.cancel(bomb.timer)
+
+        # Burning cells need no timers or removal events, they expire by tick
+        expire_tick = self.server_loop.global_tick + 90
+        flat_cells = []
+        for index in cells:
+            x, y = index % grid.width, index // grid.width
+            grid.ignite(x, y, expire_tick)
+            flat_cells += [x, y]
+        channel.outgoing_events.append({"event_type": 5, "data": [expire_tick, exploded, flat_cells]})
+
+    def leader_move_player(self, channel, data):
         """Checks collisions and moves player if possible"""
+        room = channel.room
         player_id, x, y = data[0], data[1], data[2]
-        player_x = self.server_loop.players[player_id].x
-        player_y = self.server_loop.players[player_id].y
+        player_x = room.players[player_id].x
+        player_y = room.players[player_id].y
         new_x = player_x + x
         new_y = player_y + y
-        if self.server_loop.players[player_id].moving:
+        if room.players[player_id].moving:
             return
-        if (0 <= new_x < len(self.server_loop.level_map[0])) and (0 <= new_y < len(self.server_loop.level_map)):
-            if self.server_loop.level_map[new_y][new_x] != 0:
-                return
-            elif self.server_loop.player_map[new_y][new_x] != 0:
-                return
-            elif self.server_loop.bomb_map[new_y][new_x] != 0:
+        grid = room.grid
+        if grid.in_bounds(new_x, new_y):
+            if grid.is_blocked(new_x, new_y):
                 return
             else:
-                self.server_loop.player_map[player_y][player_x] = 0
-                self.server_loop.player_map[new_y][new_x] = player_id
-                self.server_loop.players[player_id].move(x, y)
-                self.outgoing_events.append({"event_type": 2, "data": [player_id, x, y, new_x, new_y]})
-                self.server_loop.event_queue.push(self.server_loop.global_tick + 20, 4, player_id)
+                grid.move_player(player_x, player_y, new_x, new_y, player_id)
+                room.players[player_id].move(x, y)
+                channel.outgoing_events.append({"event_type": 2, "data": [player_id, x, y, new_x, new_y]})
+                room.event_queue.push(self.server_loop.global_tick + 20, 4, player_id)
         else:
             return
 
-    def leader_finish_moving(self, data):
+    def leader_finish_moving(self, channel, data):
         """Finishes moving and sets player to be able to move again"""
         player_id = data
-        self.server_loop.players[player_id].moving = False
-        self.outgoing_events.append({"event_type": 4, "data": [player_id]})
+        channel.room.players[player_id].moving = False
+        channel.outgoing_events.append({"event_type": 4, "data": [player_id]})
 
-    def broadcast_msg(self, msg):
+    def broadcast_msg(self, msg, socks=None):
         """Broadcasts message to followers"""
-        dropped = []
-        for follower_id, follower_sock in self.follower_sockets.items():
-            try:
-                follower_sock.sendall(msg)
-            except:
-                print("[LEADER] Lost follower during broadcast!", flush=True)
-                try:
-                    follower_sock.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-
-                try:
-                    follower_sock.close()
-                except:
-                    pass
-
-                dropped.append(follower_id)
-        if dropped:
-            for follower_id in dropped:
-                del self.follower_sockets[follower_id]
\ No newline at end of file
+        cache = {}
+        for follower_sock in (self.follower_sockets.values() if socks is None else socks):
+            self.comms.send(follower_sock, self.comms.frame_for(follower_sock, msg, cache))
@@ -1,6 +1,9 @@
+import os
 import sys
 from server_loop import ServerLoop
 
+WAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
 PEERS_CONFIG = [
     (1, "127.0.0.1", 55533),
     (2, "127.0.0.1", 55534),
@@ -50,7 +53,7 @@ def main():
         return
 
     print(f"Initializing Server {server_id}...")
-    server = ServerLoop(server_id, PEERS_CONFIG, PEER_COMMS_CONFIG, LEVEL_MAP, PLAYER_MAP, BOMB_MAP, EXPLOSION_MAP)
+    server = ServerLoop(server_id, PEERS_CONFIG, PEER_COMMS_CONFIG, LEVEL_MAP, PLAYER_MAP, BOMB_MAP, EXPLOSION_MAP, wal_dir=WAL_DIR)
     server.start()
 
 if __name__ == "__main__":
@@ -1,6 +1,11 @@
 class BombObject:
-    def __init__(self, id, x, y, owner):
+    __slots__ = ("id", "x", "y", "owner", "explode_tick", "timer")
+
+    def __init__(self, id, x, y, owner, explode_tick=None):
         self.id = id
         self.x = x
         self.y = y
-        self.owner = owner
\ No newline at end of file
+        self.owner = owner
+        self.explode_tick = explode_tick
+        # Handle of the pending explode timer on the leader
+        self.timer = None
@@ -1,5 +0,0 @@
-class ExplosionObject:
-    def __init__(self, x, y, owner):
-        self.x = x
-        self.y = y
-        self.owner = owner
\ No newline at end of file
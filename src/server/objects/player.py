@@ -1,4 +1,6 @@
 class PlayerObject:
+    __slots__ = ("id", "x", "y", "moving", "alive")
+
     def __init__(self, id, x, y):
         self.id = id
         self.x = x
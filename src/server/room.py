@@ -0,0 +1,60 @@
+from objects.player import PlayerObject
+from objects.bomb import BombObject
+from services.queue_service import EventQueue
+from services.entity_store import EntityStore
+from services.event_log import EventLog
+from services.snapshot import encode_snapshot, GRID_COUNT
+from services.grid import Grid, GridState
+
+
+class Room:
+    """One match with its own grids, entities, timers and log of committed batches. Every room of a server runs on the same tick"""
+
+    def __init__(self, room_id, maps, event_log_capacity=3600, tick=0):
+        self.room_id = room_id
+        self.grid = GridState.from_rows(*maps)
+        self.players = EntityStore()
+        self.bombs = EntityStore()
+        self.event_queue = EventQueue(tick)
+        self.event_log = EventLog(event_log_capacity)
+        self.last_applied_seq = 0
+        self.new_player_id = 1
+
+        self.initialize_players()
+
+    def initialize_players(self):
+        """Creates player objects from player map"""
+        for y in range(self.grid.height):
+            for x in range(self.grid.width):
+                cell = self.grid.player_at(x, y)
+                if cell != 0:
+                    self.players[cell] = PlayerObject(cell, x, y)
+
+    def encode_snapshot(self, tick, seq=None):
+        """Encodes the room as a snapshot, by default labelled with the last applied batch"""
+        return encode_snapshot(self, self.last_applied_seq if seq is None else seq, tick)
+
+    def apply_snapshot(self, snapshot):
+        """Replaces the state of the room with the given snapshot"""
+        self.grid = GridState(*(Grid.frombytes(snapshot.width, snapshot.height, snapshot.grid_bytes(index)) for index in range(GRID_COUNT)))
+
+        self.players.clear()
+        for player_id, x, y, moving, alive in snapshot.players():
+            self.players[player_id] = PlayerObject(player_id, x, y)
+            self.players[player_id].alive = bool(alive)
+        self.bombs.clear()
+        for bomb_id, x, y, owner, explode_tick in snapshot.bombs():
+            self.bombs[bomb_id] = BombObject(bomb_id, x, y, owner, explode_tick if explode_tick >= 0 else None)
+
+        self.last_applied_seq = snapshot.seq
+        self.event_log.reset(snapshot.seq)
+
+    def rearm_timers(self, tick):
+        """Rebuilds the event queue from the explode ticks of the bombs. Explosions carry their expire ticks in the grid"""
+        self.event_queue = EventQueue(tick)
+        for bomb in self.bombs.values():
+            if bomb.explode_tick is None:
+                bomb.explode_tick = tick + 120
+            bomb.timer = self.event_queue.push(bomb.explode_tick, 1, bomb.id)
+        for player in self.players.values():
+            player.moving = False
@@ -1,233 +1,340 @@
+import os
+import threading
 import time
 from queue import Queue
-from objects.player import PlayerObject
-from objects.bomb import BombObject
-from objects.explosion import ExplosionObject
 from leader import Leader
 from follower import Follower
+from room import Room
 from services.peer_comms import PeerComms
-from services.queue_service import EventQueue
+from services.hash_ring import HashRing
+from services.scheduler import TickScheduler
+from services.wal import WriteAheadLog
+from services.snapshot import Snapshot
+from services import state_transfer
 
 class ServerLoop:
-    def __init__(self, server_id, peers_config, peer_comms_config, level_map, player_map, bomb_map, explosion_map, tick_rate=60):
+    def __init__(self, server_id, peers_config, peer_comms_config, level_map, player_map, bomb_map, explosion_map, tick_rate=60, wal_dir=None, max_rooms=1024):
+        self.created_at = time.perf_counter()
         self.server_id = server_id
         self.peers_config = peers_config
         self.peer_comms_config = peer_comms_config
         self.tick_rate = tick_rate
         self.tick_interval = 1.0 / tick_rate
+        # Ticks run back to back after a stall before the rest are skipped
+        self.max_catch_up_ticks = 5
 
-        self.heartbeat_interval = 30
-        self.last_heartbeat_sent = 0
+        # Ticks of silence towards followers before an explicit heartbeat, and before one is sent just to carry a commit
+        self.heartbeat_interval = 6
+        self.commit_flush_ticks = 3
 
-        self.last_heartbeat_tick = 0
-        self.heartbeat_timeout = 120
+        # Phi accrual failure detection of the leader, see services/failure_detector.py
+        self.failure_threshold = 8.0
+        self.failure_min_std_ms = 20
+        self.failure_acceptable_pause_ms = 50
+
+        self.max_in_flight_ticks = 8
+        self.commit_policy = "majority"
+        self.follower_ack_timeout = 0.25
+
+        self.event_log_capacity = 3600
+
+        self.wal_fsync_every_ticks = 30
+        self.wal_fsync_interval_ms = 50
+        self.snapshot_interval_ticks = 600
+        self.last_snapshot_tick = 0
+        # Set when a batch was committed in any room since the last snapshot
+        self.unsnapshotted = False
+        self.transfer_id = 0
+        self.wal = None
+        if wal_dir:
+            self.wal = WriteAheadLog(
+                os.path.join(wal_dir, f"server_{server_id}"),
+                self.wal_fsync_every_ticks,
+                self.wal_fsync_interval_ms
+            )
         
         self.global_tick = 0
-        self.level_map = level_map
-        self.player_map = player_map
-        self.bomb_map = bomb_map
-        self.explosion_map = explosion_map
-        self.players = {}
-        self.bombs = {}
-        self.explosions = {}
-        
-        self.global_bomb_id = 1
-        self.global_explosion_id = 1
-        self.new_player_id = 1
-        self.event_queue = EventQueue()
-
-        self.role_obj = Follower(self)
-        self.leader_addr = None
-        self.leader_id = None
-        self.has_leader = False
+        # Every room starts from the same maps, rooms are created on first use and all step on global_tick
+        self.room_maps = (level_map, bomb_map, player_map, explosion_map)
+        self.max_rooms = max_rooms
+        self.default_room = 0
+        self.rooms = {}
+        self.get_room(self.default_room)
+
+        # Every node leads the rooms the ring assigns to it among the live nodes and follows the rest
+        self.ring = HashRing([peer_id for (peer_id, _, _) in peers_config])
+        # Rooms led by a peer as far as its frames tell, rooms of failed peers are dropped from here
+        self.room_leaders = {}
+        self.leader = None
+        self.links = {}
+        self.scheduler = TickScheduler(self.tick_interval, self.max_catch_up_ticks)
+
         self.peer_queue = Queue()
         self.peer_comms = PeerComms(self.server_id, self.peer_comms_config, self.peer_comms_config[server_id-1][2], self.peer_queue)
 
-        self.election_in_progress = False
-        self.waiting_for_leader = False
-        self.election_start_time = None
-        self.election_timeout = 0.2
-
-        self.initialize_players()
-
-    def initialize_players(self):
-        """Creates player objects from player map"""
-        height = len(self.level_map)
-        width = len(self.level_map[0])
-        for y in range(height):
-            for x in range(width):
-                cell = self.player_map[y][x]
-                if cell != 0:
-                    self.players[cell] = PlayerObject(cell, x, y)
-
-    def create_from_state(self):
-        """Creates bomb and explosion objects from maps"""
-        height = len(self.level_map)
-        width = len(self.level_map[0])
-        for y in range(height):
-            for x in range(width):
-                if self.bomb_map[y][x] != 0:
-                    bomb_id = self.bomb_map[y][x]
-                    self.bombs[bomb_id] = BombObject(bomb_id, x, y, 1)
-                    self.bomb_map[y][x] = bomb_id
-                    explode_tick = self.global_tick + 120
-                    self.event_queue.push(explode_tick, 1, bomb_id)
-                    self.global_bomb_id = max(self.global_bomb_id, bomb_id + 1)
-                if self.explosion_map[y][x] != 0:
-                    self.explosions[self.global_explosion_id] = ExplosionObject(x, y, 1)
-                    self.global_explosion_id += 1
+        self.blast_radius = 1
+        # Clients get the events within this many cells of their player, in buckets of the spatial index this big
+        self.interest_radius = 8
+        self.max_interest_radius = 32
+        self.interest_bucket_size = 8
+        self.discovery_timeout = 2.0
+        # A node taking over a room waits this long at most for its followers to say what they have of it
+        self.claim_timeout_ticks = 60
+        # Clients and followers that fall this far behind on what they are sent are disconnected
+        self.max_outgoing_bytes = 4 * 1024 * 1024
+
+    def get_room(self, room_id):
+        """Returns the room, creating it from the room maps the first time it is used"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = Room(room_id, self.room_maps, self.event_log_capacity, self.global_tick)
+            self.rooms[room_id] = room
+        return room
+
+    def is_valid_room(self, room_id):
+        return isinstance(room_id, int) and 0 <= room_id < self.max_rooms
 
     def start(self):
-        """Starts the server loop, runs bully if necessary, and runs appropriate role (follower or leader)"""
+        """Recovers, fetches the latest state from a peer and runs the tick loop of this node's rooms and of its links to the peers"""
         print(f"Server {self.server_id} starting...", flush=True)
+        timings = {"init": time.perf_counter() - self.created_at}
 
-        self.leader_id = self.collect_leader_info()
-        if self.leader_id != self.server_id:
-            self.get_current_state()
-            self.players = {}
-            self.initialize_players()
-            self.create_from_state()
+        start = time.perf_counter()
+        self.recover_from_log()
+        timings["recover"] = time.perf_counter() - start
 
+        # Listens for clients and followers before the peers start dialing in
+        self.leader = Leader(self)
 
-        if self.leader_id >= self.server_id:
-            self.become_leader()
-        else:
-            self.has_leader = True
-            self.leader_addr = (self.peers_config[self.leader_id-1][1], self.peers_config[self.leader_id-1][2])
-            self.peer_comms.current_leader = self.leader_id
-        
-        while True:
-            if not self.has_leader:
-                self.run_bully()
-            self.waiting_for_leader = False
-            result = self.role_obj.run()
-
-            match result:
-                case "NEED_ELECTION":
-                    self.has_leader = False
-                    continue
-                case "DEMOTION":
-                    self.role_obj = Follower(self)
-                    continue
-                case "LEADER_SWITCH":
-                    continue
-            
-
-    def run_bully(self):
-        """Starts the election algorithm to find a new leader with lowest id"""
-        print("Starting election", flush=True)
-
-        self.start_election()
-        self.election_in_progress = True
+        start = time.perf_counter()
+        reachable = self.discover_peers(self.discovery_timeout)
+        timings["discovery"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if reachable:
+            self.get_current_state(min(reachable))
+        timings["state"] = time.perf_counter() - start
+
+        self.links = {peer_id: Follower(self, peer_id) for (peer_id, _, _) in self.peers_config if peer_id != self.server_id}
+
+        ready = time.perf_counter() - self.created_at
+        breakdown = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in timings.items())
+        print(f"[STARTUP] Ready in {ready * 1000:.1f} ms ({breakdown}), peers up {sorted(reachable)}", flush=True)
+
+        self.run()
+
+    def run(self):
+        """Runs the clock loop shared by every room on this node"""
+        self.scheduler.reset()
 
         while True:
-            while not self.peer_queue.empty():
-                msg = self.peer_queue.get()
-                if msg["type"] == "leader_announce":
-                    self.has_leader = True
-                    self.role = Follower(self)
-                    self.leader_id = msg["from"]
-                    self.peer_comms.current_leader = self.leader_id
-                    self.leader_addr = (self.peers_config[msg["from"] - 1][1], self.peers_config[msg["from"] - 1][2])
-                    return
-                elif msg["type"] == "bully_ok":
-                    if msg["from"] < self.server_id:
-                        self.waiting_for_leader = True
-                    pass
-                elif msg["type"] == "bully":
-                    self.handle_bully(msg["from"])
-                
-            if not self.waiting_for_leader and self.election_timeout_expired():
-                self.become_leader()
-                return
-            
-            time.sleep(0.001)
-
-    def start_election(self):
-        """Sends election messages to all peers (higher ids ignore this)"""
-        msg = {
-            "type": "bully",
-            "from": self.server_id
-        }
-
-        self.peer_comms.broadcast(msg)
-        print("Bully sent", flush=True)
-        self.election_start_time = time.perf_counter()
-
-    def handle_bully(self, from_id):
-        """Sends response to the election message to let know that this node is candidate for leader"""
-        msg = {
-            "type": "bully_ok",
-            "from": self.server_id
-        }
-        self.peer_comms.send_to_peer(from_id, msg)
-
-    def become_leader(self):
-        """Sets role to leader and announces itself as leader to other nodes"""
-        self.has_leader = True
-        self.leader_id = self.server_id
-        self.peer_comms.current_leader = self.server_id
-        self.role_obj = Leader(self)
-        self.send_leader_announce()
-
-    def send_leader_announce(self):
-        """Sends leader announcement to other nodes"""
-        msg = {
-            "type": "leader_announce",
-            "from": self.server_id
-        }
-        self.peer_comms.broadcast(msg)
-
-    def election_timeout_expired(self):
-        if self.election_start_time is None:
-            return False
-        now = time.perf_counter()
-        return (now - self.election_start_time) >= self.election_timeout
-    
-    def collect_leader_info(self, timeout=2.0):
-        """Queries other nodes for current leader"""
-        leader_ids = []
+            for _ in self.scheduler.run_ticks():
+                self.global_tick += 1
+
+                while not self.peer_queue.empty():
+                    msg = self.peer_queue.get()
+                    if msg["type"] == "state_request":
+                        self.send_current_state(msg["from"], msg.get("have"), self.leader.applied_seq)
+
+                for link in self.links.values():
+                    link.step()
+                self.leader.rebalance()
+                self.leader.tick()
+                self.maybe_snapshot(self.leader.applied_seq)
+
+                if self.global_tick % 600 == 0:
+                    print(f"[SCHEDULER] {self.scheduler.metrics()}", flush=True)
+                    owned = {}
+                    for room_id in self.rooms:
+                        leader_id = self.leader_of(room_id)
+                        owned[leader_id] = owned.get(leader_id, 0) + 1
+                    print(f"[SHARDS] Alive {sorted(self.alive_nodes())}, rooms per leader {owned}", flush=True)
+
+    def peer_addr(self, peer_id):
+        """Returns the client address of a server, where clients and followers connect"""
+        for (config_id, host, port) in self.peers_config:
+            if config_id == peer_id:
+                return (host, port)
+        return None
+
+    def alive_nodes(self):
+        """Returns this node and every peer it currently has a working link to"""
+        return {self.server_id} | {peer_id for peer_id, link in self.links.items() if link.alive}
+
+    def links_settled(self):
+        """Checks that every peer either told us which rooms it leads or could not be reached"""
+        return all(link.settled for link in self.links.values())
+
+    def room_owner(self, room_id):
+        """Returns the live node the hash ring assigns the room to"""
+        return self.ring.owner(room_id, self.alive_nodes())
+
+    def leader_of(self, room_id):
+        """Returns the node leading the room right now, or the one about to take it over"""
+        if self.leader.leads(room_id):
+            return self.server_id
+        return self.room_leaders.get(room_id, self.room_owner(room_id))
+
+    def retained_batches(self, room_id):
+        """Returns the batches of the room received from its leaders and not known to be committed yet, by sequence number"""
+        batches = {}
+        for link in self.links.values():
+            batches.update(link.pending_batches.get(room_id, {}))
+        return batches
+
+    def drop_retained(self, room_id, keep=None):
+        """Forgets the uncommitted batches of the room held for every leader link but the given one"""
+        for link in self.links.values():
+            if link is not keep:
+                link.pending_batches.pop(room_id, None)
+
+    def forget_leader(self, peer_id):
+        """Drops a failed peer as the leader of its rooms, so that the next live node on the ring takes them over"""
+        rooms = [room_id for room_id, leader_id in self.room_leaders.items() if leader_id == peer_id]
+        for room_id in rooms:
+            del self.room_leaders[room_id]
+        if rooms:
+            print(f"[SHARDS] Server {peer_id} is down, its {len(rooms)} rooms move to the next live nodes", flush=True)
+
+    def discover_peers(self, timeout=2.0):
+        """Waits until every peer either said hello or turned out unreachable. Returns the ids of the peers that are up"""
+        answers = set()
+        peer_ids = [peer_id for (peer_id, _, _) in self.peer_comms_config if peer_id != self.server_id]
         start = time.perf_counter()
+        reason = "timeout"
 
         while time.perf_counter() - start < timeout:
             while not self.peer_queue.empty():
                 msg = self.peer_queue.get()
-                if msg["type"] == "curr_leader":
-                    leader_ids.append(msg["leader"])
-            time.sleep(0.01)
+                if msg["type"] == "peer_up":
+                    answers.add(msg["from"])
+            if all(peer_id in answers or peer_id in self.peer_comms.unreachable for peer_id in peer_ids):
+                reason = "all reachable peers answered"
+                break
+            time.sleep(0.005)
 
-        if leader_ids:
-            return min(leader_ids)
-        return self.server_id
+        print(f"[STARTUP] Peer discovery finished ({reason}), up {sorted(answers)}, unreachable {sorted(self.peer_comms.unreachable)}", flush=True)
+        return answers
     
-    def get_current_state(self, timeout=2.0):
-        """Retrieves the current state from the leader"""
+    def get_current_state(self, peer_id, timeout=2.0):
+        """Retrieves the state of every room from a peer, which only sends the grid rows that differ from ours"""
+        bases = {room_id: Snapshot(room.encode_snapshot(self.global_tick)) for room_id, room in self.rooms.items()}
         self.peer_comms.send_to_peer(
-            self.leader_id,
-            {"type": "state_request", "from": self.server_id}
+            peer_id,
+            {"type": "state_request", "from": self.server_id, "have": [[room_id, state_transfer.digest(base)] for room_id, base in bases.items()]}
         )
 
+        assembler = state_transfer.TransferAssembler()
         start = time.perf_counter()
 
         while time.perf_counter() - start < timeout:
             while not self.peer_queue.empty():
                 msg = self.peer_queue.get()
-                if msg["type"] == "curr_state":
-                    self.level_map = msg["level_map"]
-                    self.bomb_map = msg["bomb_map"]
-                    self.player_map = msg["player_map"]
-                    self.explosion_map = msg["explosion_map"]
-                    return
+                if msg["type"] == "state_chunk":
+                    # Keep waiting as long as chunks are arriving
+                    start = time.perf_counter()
+                    payload = assembler.add(msg)
+                    if payload is not None:
+                        transfers = state_transfer.unbundle(payload)
+                        snapshots = [state_transfer.decode_transfer(transfer, bases.get(state_transfer.room_of(transfer))) for transfer in transfers]
+                        print(f"[STATE] Received state of {len(snapshots)} rooms in {msg['total']} chunks, {len(payload)} bytes", flush=True)
+                        self.load_state(snapshots)
+                        return
             time.sleep(0.01)
 
-    def send_current_state(self, peer_id):
-        """Sends the current state to querying node"""
-        msg = {
-            "type": "curr_state",
-            "level_map": self.level_map,
-            "bomb_map": self.bomb_map,
-            "player_map": self.player_map,
-            "explosion_map": self.explosion_map,
-            "from": self.server_id
-        }
-        self.peer_comms.send_to_peer(peer_id, msg)
+    def encode_checkpoint(self, seq_of=None):
+        """Encodes the snapshots of every room back to back. seq_of gives the sequence number to label a room with, by default its last applied batch"""
+        return b"".join(room.encode_snapshot(self.global_tick, seq_of(room_id) if seq_of else None) for room_id, room in self.rooms.items())
+
+    def maybe_snapshot(self, seq_of=None):
+        """Writes a snapshot of all rooms every snapshot_interval_ticks if batches were applied since the last one"""
+        if not self.wal or not self.unsnapshotted:
+            return
+        if self.global_tick - self.last_snapshot_tick < self.snapshot_interval_ticks:
+            return
+        self.wal.checkpoint(self.global_tick, self.encode_checkpoint(seq_of))
+        self.last_snapshot_tick = self.global_tick
+        self.unsnapshotted = False
+
+    def load_state(self, snapshots):
+        """Replaces the state of the rooms with snapshots received from another node and persists it"""
+        for snapshot in snapshots:
+            self.apply_snapshot(snapshot)
+        if self.wal:
+            self.wal.checkpoint(self.global_tick, self.encode_checkpoint())
+            self.last_snapshot_tick = self.global_tick
+            self.unsnapshotted = False
+
+    def apply_snapshot(self, snapshot):
+        """Replaces the state of the snapshot's room and moves the clock forward to the snapshot tick"""
+        room = self.get_room(snapshot.room_id)
+        room.apply_snapshot(snapshot)
+        self.global_tick = max(self.global_tick, snapshot.tick)
+        room.rearm_timers(self.global_tick)
+
+    def rearm_timers(self):
+        """Rebuilds the timers of every room from its bombs"""
+        for room in self.rooms.values():
+            room.rearm_timers(self.global_tick)
+
+    def record_committed(self, room, seq, tick, events):
+        """Appends a committed batch to the event log of its room"""
+        room.event_log.append(seq, tick, events)
+        room.last_applied_seq = seq
+        self.unsnapshotted = True
+        if self.wal:
+            self.wal.append(room.room_id, seq, tick, events)
+
+    def recover_from_log(self):
+        """Rebuilds the state from the latest snapshot on disk and the logged batches after it"""
+        if not self.wal:
+            return
+        snapshots, batches = self.wal.recover()
+        if not snapshots and not batches:
+            return
+
+        for snapshot in snapshots:
+            self.apply_snapshot(snapshot)
+        replayer = Follower(self, None)
+        for room_id, seq, tick, events in batches:
+            room = self.get_room(room_id)
+            self.global_tick = tick
+            for event in events:
+                replayer.parse_event(room, event["event_type"], event["data"])
+            room.event_log.append(seq, tick, events)
+            room.last_applied_seq = seq
+
+        # Timers are not logged, re-arm bombs with their original ticks
+        self.rearm_timers()
+        self.last_snapshot_tick = self.global_tick
+        print(f"[WAL] Recovered {len(snapshots)} room snapshots and {len(batches)} batches in {len(self.rooms)} rooms at tick {self.global_tick}", flush=True)
+
+    def send_current_state(self, peer_id, have=None, seq_of=None):
+        """Streams the state of every room to the querying node in compressed chunks, leaving out the grid rows it already has.
+        have holds [room id, digest] pairs, seq_of gives the sequence number to label a room with"""
+        have = dict(have or [])
+        transfers = []
+        for room_id, room in self.rooms.items():
+            snapshot = Snapshot(room.encode_snapshot(self.global_tick, seq_of(room_id) if seq_of else None))
+            transfers.append(state_transfer.encode_transfer(snapshot, have.get(room_id)))
+        payload = state_transfer.bundle(transfers)
+        chunks = state_transfer.split(payload)
+        self.transfer_id += 1
+        print(f"[STATE] Sending state of {len(transfers)} rooms to {peer_id}: {len(payload)} bytes in {len(chunks)} chunks", flush=True)
+
+        thread = threading.Thread(target=self._stream_state, args=(peer_id, self.transfer_id, chunks), daemon=True)
+        thread.start()
+
+    def _stream_state(self, peer_id, transfer_id, chunks):
+        """Sends the chunks of a state transfer off the tick thread"""
+        for index, chunk in enumerate(chunks):
+            msg = {
+                "type": "state_chunk",
+                "from": self.server_id,
+                "transfer_id": transfer_id,
+                "index": index,
+                "total": len(chunks),
+                "data": chunk
+            }
+            if not self.peer_comms.send_to_peer(peer_id, msg):
+                return
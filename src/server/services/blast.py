@@ -0,0 +1,50 @@
+from collections import deque
+from services.grid import WALL, BOMB
+
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+def resolve_blast(grid, bombs, bomb_ids, radius=1):
+    """Resolves the given bombs and every bomb their blasts reach in one breadth-first pass over the occupancy mask.
+    Returns the ids of the exploded bombs and the flat grid indexes of the burning cells, both in blast order"""
+    width, height = grid.width, grid.height
+    occupancy = grid.occupancy
+    bomb_cells = grid.bombs.cells
+
+    queue = deque()
+    seen = set()
+    for bomb_id in bomb_ids:
+        if bomb_id in bombs and bomb_id not in seen:
+            seen.add(bomb_id)
+            queue.append(bomb_id)
+
+    exploded = []
+    # Dict as an ordered set of cell indexes
+    cells = {}
+    while queue:
+        bomb = bombs[queue.popleft()]
+        exploded.append(bomb.id)
+        origin = bomb.y * width + bomb.x
+        cells[origin] = None
+
+        for dx, dy in DIRECTIONS:
+            x, y, index = bomb.x, bomb.y, origin
+            step = dx + dy * width
+            for _ in range(radius):
+                x += dx
+                y += dy
+                if not (0 <= x < width and 0 <= y < height):
+                    break
+                index += step
+                cell = occupancy[index]
+                if cell & WALL:
+                    break
+                cells[index] = None
+                if cell & BOMB:
+                    # The blast stops at the bomb it sets off
+                    chained = bomb_cells[index]
+                    if chained not in seen and chained in bombs:
+                        seen.add(chained)
+                        queue.append(chained)
+                    break
+    return exploded, list(cells)
@@ -1,88 +1,70 @@
-import socket
-import json
+from services.framing import encode_message
+from services.codec import negotiate
+from services.network_loop import NetworkLoop
 
 class ClientComms():
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_outgoing=4 * 1024 * 1024):
         self.host = host
         self.port = port
-        self.server = None
-        self.acks = 0
+        self.max_outgoing = max_outgoing
+        self.network = None
+        self.encodings = {}
 
     def start_listening(self):
-        """Starts the socket listening - called when becoming Leader"""
-        if self.server:
-            try:
-                self.server.close()
-            except:
-                pass
-        
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((self.host, self.port))
-        self.server.listen()
+        """Starts the network loop listening - called when becoming Leader"""
+        if self.network:
+            self.network.stop()
+
+        self.network = NetworkLoop(self.host, self.port, self.max_outgoing)
+        self.network.start()
         print(f"[COMMS] Listening on {self.host}:{self.port}", flush=True)
 
-    def receive_connection(self):
-        if not self.server:
-            return None
-        client, address = self.server.accept()
-        print(f"[COMMS] Connected with {address}", flush=True)
-        return client
+    def stop(self):
+        """Stops the network loop and closes all connections - called when demoted"""
+        if self.network:
+            self.network.stop()
+            self.network = None
+        self.encodings.clear()
 
-    def handle(self, client, queue):
-        """Pushes the messages from client to a queue"""
-        while True:
-            try:
-                data = client.recv(1024).decode("utf-8")
-                if not data:
-                    break
-                if "}{" in data:
-                    parts = data.replace("}{", "}|{").split("|")
-                    for part in parts:
-                        message = json.loads(part)
-                        queue.put(message)
-                else:
-                    message = json.loads(data)
-                    queue.put(message)
-            except Exception as error:
-                print(f"[COMMS] Connection closed or error: {error}", flush=True)
-                break
-        
-        try:
-            client.close()
-        except:
-            pass
+    def receive_batch(self):
+        """Returns the connection events and messages received since the last tick"""
+        if not self.network:
+            return ()
+        return self.network.drain()
 
-    def handle_follower(self, client, queue):
-        """Pushes the messages from follower to a queue"""
-        while True:
-            try:
-                data = client.recv(1024).decode("utf-8")
-                if not data:
-                    break
-                if "}{" in data:
-                    parts = data.replace("}{", "}|{").split("|")
-                    for part in parts:
-                        message = json.loads(part)
-                        queue.put(message)
-                else:
-                    message = json.loads(data)
-                    if message["type"] == "ack":
-                        self.acks += 1
-                    else:
-                        queue.put(message)
-            except Exception as error:
-                print(f"[COMMS] Connection closed or error: {error}", flush=True)
-                break
-        
-        try:
-            client.close()
-        except:
-            pass
+    def send(self, sock, data):
+        """Queues framed data to be sent by the network loop"""
+        if self.network:
+            self.network.send(sock, data)
+
+    def flush(self):
+        """Has the network loop write out everything queued so far"""
+        if self.network:
+            self.network.flush()
+
+    def close(self, sock):
+        """Closes the given connection"""
+        self.encodings.pop(sock, None)
+        if self.network:
+            self.network.close(sock)
+
+    def accept_encoding(self, sock, handshake):
+        """Picks the encoding for the connection from the ones offered in its handshake and confirms it"""
+        encoding = negotiate(handshake.get("encodings"))
+        self.encodings[sock] = encoding
+        self.send(sock, encode_message({"type": "hello_ack", "encoding": encoding}))
+        print(f"[COMMS] Using {encoding} encoding for connection", flush=True)
+
+    def frame_for(self, sock, message, cache):
+        """Returns the framed message in the encoding of the socket, encoding it at most once per encoding"""
+        encoding = self.encodings.get(sock, "json")
+        if encoding not in cache:
+            cache[encoding] = encode_message(message, encoding)
+        return cache[encoding]
 
-    def broadcast(self, clients, msg_type, data, tick):
+    def broadcast(self, clients, msg_type, data, tick, seq=0):
         """Sends message to given clients"""
-        message = {"type": msg_type, "tick": tick, "data": data}
+        message = {"type": msg_type, "seq": seq, "tick": tick, "data": data}
         
         if msg_type == "update":
             print(f"[COMMS] Broadcasting 'update' ({len(data)} events) at tick {tick}", flush=True)
@@ -90,11 +72,8 @@ class ClientComms():
             print(f"[COMMS] Broadcasting 'clock' sync at tick {tick}", flush=True)
 
         try:
-            msg_bytes = json.dumps(message).encode("utf-8")
+            cache = {}
             for client in clients:
-                try:
-                    client.send(msg_bytes)
-                except:
-                    pass
+                self.send(client, self.frame_for(client, message, cache))
         except Exception as e:
             print(f"[COMMS] Broadcast error: {e}", flush=True)
@@ -0,0 +1,77 @@
+import heapq
+
+
+class EntityStore:
+    """Entities of one type kept in a list indexed by id. Freed ids go to a free list and are handed out again lowest first,
+    so ids and the list stay as small as the most entities alive at once. Supports the dict operations the game uses"""
+
+    def __init__(self, first_id=1):
+        self.first_id = first_id
+        self.slots = []
+        # Heap of free ids, entries whose slot has been filled since are skipped when popped
+        self.free = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, entity_id):
+        index = entity_id - self.first_id
+        return 0 <= index < len(self.slots) and self.slots[index] is not None
+
+    def __getitem__(self, entity_id):
+        index = entity_id - self.first_id
+        if index < 0 or index >= len(self.slots) or self.slots[index] is None:
+            raise KeyError(entity_id)
+        return self.slots[index]
+
+    def __setitem__(self, entity_id, entity):
+        index = entity_id - self.first_id
+        if index < 0:
+            raise KeyError(entity_id)
+        if index >= len(self.slots):
+            # Ids skipped over become free
+            for gap in range(len(self.slots), index):
+                heapq.heappush(self.free, gap + self.first_id)
+            self.slots.extend([None] * (index + 1 - len(self.slots)))
+        if self.slots[index] is None:
+            self.count += 1
+        self.slots[index] = entity
+
+    def __delitem__(self, entity_id):
+        self[entity_id]
+        self.slots[entity_id - self.first_id] = None
+        heapq.heappush(self.free, entity_id)
+        self.count -= 1
+
+    def __iter__(self):
+        return (index + self.first_id for index, entity in enumerate(self.slots) if entity is not None)
+
+    def get(self, entity_id, default=None):
+        return self[entity_id] if entity_id in self else default
+
+    def pop(self, entity_id, *default):
+        if entity_id not in self:
+            if default:
+                return default[0]
+            raise KeyError(entity_id)
+        entity = self.slots[entity_id - self.first_id]
+        del self[entity_id]
+        return entity
+
+    def values(self):
+        return (entity for entity in self.slots if entity is not None)
+
+    def items(self):
+        return ((index + self.first_id, entity) for index, entity in enumerate(self.slots) if entity is not None)
+
+    def clear(self):
+        self.slots = []
+        self.free = []
+        self.count = 0
+
+    def allocate(self):
+        """Returns the lowest free id. It stays free until an entity is stored under it"""
+        while self.free and self.free[0] in self:
+            heapq.heappop(self.free)
+        return self.free[0] if self.free else len(self.slots) + self.first_id
@@ -0,0 +1,33 @@
+from collections import deque
+from itertools import islice
+
+
+class EventLog:
+    """Ring buffer of committed tick batches indexed by their consecutive sequence numbers"""
+
+    def __init__(self, capacity=3600):
+        self.entries = deque(maxlen=capacity)
+        self.base_seq = 0
+
+    def append(self, seq, tick, events):
+        """Appends a committed batch, evicting the oldest one when full"""
+        if seq != self.last_seq() + 1:
+            # A gap means the history before seq is unknown here
+            self.reset(seq - 1)
+        if len(self.entries) == self.entries.maxlen:
+            self.base_seq = self.entries[0][0]
+        self.entries.append((seq, tick, events))
+
+    def last_seq(self):
+        return self.entries[-1][0] if self.entries else self.base_seq
+
+    def reset(self, seq):
+        """Empties the log so that it continues after the given sequence number, used after loading a snapshot"""
+        self.entries.clear()
+        self.base_seq = seq
+
+    def since(self, seq):
+        """Returns the batches after the given sequence number, or None if some of them were already evicted"""
+        if seq < self.base_seq or seq > self.last_seq():
+            return None
+        return list(islice(self.entries, seq - self.base_seq, None))
@@ -0,0 +1,53 @@
+import math
+import threading
+import time
+from collections import deque
+
+
+class PhiAccrualDetector:
+    """Phi accrual failure detector. Suspicion grows with the time since the last heartbeat, measured against the observed inter-arrival times"""
+
+    def __init__(self, threshold=8.0, expected_interval=0.1, window=100, min_std=0.02, acceptable_pause=0.05, min_interval=0.0):
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.intervals = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+        # Seed the history so the detector works before real heartbeats arrive
+        self.intervals.append(expected_interval - expected_interval / 4)
+        self.intervals.append(expected_interval + expected_interval / 4)
+        self.last_arrival = time.perf_counter()
+
+    def heartbeat(self, now=None):
+        """Records the arrival of a heartbeat. Intervals shorter than min_interval are recorded as min_interval, so bursts of traffic do not shrink the expected gap"""
+        now = time.perf_counter() if now is None else now
+        with self.lock:
+            self.intervals.append(max(now - self.last_arrival, self.min_interval))
+            self.last_arrival = now
+
+    def phi(self, now=None):
+        """Returns the suspicion level, phi = -log10 of the probability that a heartbeat is still to come"""
+        now = time.perf_counter() if now is None else now
+        with self.lock:
+            elapsed = now - self.last_arrival
+            count = len(self.intervals)
+            mean = sum(self.intervals) / count
+            variance = sum((interval - mean) ** 2 for interval in self.intervals) / count
+        std = max(math.sqrt(variance), self.min_std)
+
+        # Logistic approximation of the normal distribution, as in the Akka implementation
+        y = min(max((elapsed - mean - self.acceptable_pause) / std, -20.0), 20.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean + self.acceptable_pause:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def is_suspected(self, now=None):
+        return self.phi(now) >= self.threshold
+
+    def silence(self, now=None):
+        """Returns the seconds since the last heartbeat"""
+        now = time.perf_counter() if now is None else now
+        return now - self.last_arrival
@@ -1,15 +1,21 @@
 import socket
-import json
 import threading
+from services.framing import FrameReader, encode_message
+from services.codec import SUPPORTED_ENCODINGS
 
 
 class FollowerComms:
-    def __init__(self, leader, id, queue):
+    def __init__(self, leader, id, queue, rooms=None, detector=None):
         self.leader_addr = leader
         self.server_id = id
+        # [room id, last applied seq, grid digest] for every room this node has
+        self.rooms = rooms or []
+        self.detector = detector
+        self.connected = True
         self.socket = None
         self.queue = queue
-        self.commit = False
+        self.encoding = "json"
+        self.send_lock = threading.Lock()
         self.connect_to_leader()
 
     def connect_to_leader(self):
@@ -21,10 +27,12 @@ class FollowerComms:
 
         handshake = {
             "type": "server_hello",
-            "server_id": self.server_id
+            "server_id": self.server_id,
+            "rooms": self.rooms,
+            "encodings": SUPPORTED_ENCODINGS
         }
 
-        sock.sendall((json.dumps(handshake)).encode("utf-8"))
+        sock.sendall(encode_message(handshake))
         self.socket = sock
 
         thread = threading.Thread(
@@ -35,30 +43,32 @@ class FollowerComms:
 
     def _recv_loop(self):
         """Loop to receive messages and add them to message queue"""
+        reader = FrameReader()
         try:
             while True:
-                data = self.socket.recv(4096).decode("utf-8")
-                if not data:
+                if reader.recv_from(self.socket) == 0:
                     raise Exception("Leader closed connection")
                 try:
-                    if "}{" in data:
-                        parts = data.replace("}{", "}|{").split("|")
-                        for part in parts:
-                            self.queue.put(json.loads(part))
-                    else:
-                        msg = json.loads(data)
-                        if msg["type"] == "commit":
-                            self.commit = True
-                        else:
-                            self.queue.put(msg)
+                    for msg in reader.messages():
+                        if msg["type"] == "hello_ack":
+                            self.encoding = msg["encoding"]
+                            continue
+                        if self.detector:
+                            # Every leader frame is a sign of life, timed on arrival so that tick loop jitter does not distort it
+                            self.detector.heartbeat()
+                        if msg["type"] == "event":
+                            self.send_to_leader({"type": "ack", "room": msg["room"], "seq": msg["seq"], "tick": msg["tick"]})
+                        self.queue.put(msg)
                 except Exception as e:
                     print(f"[FOLLOWER] message error: {e}", flush=True)
         except Exception as e:
             print(f"[FOLLOWER] _recv_loop error: {e}", flush=True)
+        self.connected = False
 
-    def send_to_leader(self, msg):
+    def send_to_leader(self, msg, encoding="json"):
         """Sends message to leader"""
-        self.socket.send(json.dumps(msg).encode())
+        with self.send_lock:
+            self.socket.sendall(encode_message(msg, encoding))
 
     def close_socket(self):
         """Closes socket to leader"""
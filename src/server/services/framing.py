@@ -0,0 +1,100 @@
+import json
+import struct
+from services import codec
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+MIN_FREE_SPACE = 1024
+
+
+def encode_frame(payload):
+    """Prefixes the payload with its length"""
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_message(msg, encoding="json"):
+    """Serializes the message with the given encoding and frames it. Falls back to JSON for types without a binary layout"""
+    if encoding == "binary":
+        payload = codec.encode_message(msg)
+        if payload is not None:
+            return encode_frame(payload)
+    return encode_frame(json.dumps(msg).encode("utf-8"))
+
+
+def decode_message(payload):
+    """Parses the payload of a single frame, either binary or JSON"""
+    if codec.is_binary(payload):
+        return codec.decode_message(payload)
+    return json.loads(bytes(payload))
+
+
+class FrameReader:
+    """Incremental parser for length-prefixed frames. The receive buffer is reused between reads and grows when a frame does not fit"""
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def recv_from(self, sock):
+        """Receives available bytes from the socket into the buffer. Returns the byte count, 0 means the peer closed"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end < MIN_FREE_SPACE or self._pending_frame_size() > len(self.buffer) - self.start:
+            self._make_room()
+        received = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """Appends already received bytes to the buffer"""
+        if len(self.buffer) - self.end < len(data):
+            self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """Yields the payload of every complete frame as a memoryview. A view is only valid until the next read"""
+        view = memoryview(self.buffer)
+        while self.end - self.start >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds limit")
+            payload_start = self.start + HEADER.size
+            payload_end = payload_start + length
+            if payload_end > self.end:
+                return
+            self.start = payload_end
+            yield view[payload_start:payload_end]
+
+    def messages(self):
+        """Yields every complete message in the buffer"""
+        for payload in self.frames():
+            yield decode_message(payload)
+
+    def recv_message(self, sock):
+        """Blocks until one complete message is available and returns it. Bytes after it stay buffered"""
+        while True:
+            for message in self.messages():
+                return message
+            if self.recv_from(sock) == 0:
+                raise ConnectionError("Connection closed during read")
+
+    def _pending_frame_size(self):
+        """Returns the size of the partially received frame at the head of the buffer"""
+        if self.end - self.start < HEADER.size:
+            return 0
+        return HEADER.size + HEADER.unpack_from(self.buffer, self.start)[0]
+
+    def _make_room(self, extra=MIN_FREE_SPACE):
+        """Moves unread bytes to the front of the buffer, growing it if the pending frame does not fit"""
+        pending = self.end - self.start
+        needed = max(pending + extra, self._pending_frame_size() + MIN_FREE_SPACE)
+        if needed > len(self.buffer):
+            grown = bytearray(max(needed, len(self.buffer) * 2))
+            grown[:pending] = self.buffer[self.start:self.end]
+            self.buffer = grown
+        elif self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
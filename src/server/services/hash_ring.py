@@ -0,0 +1,45 @@
+import bisect
+import hashlib
+
+
+def ring_hash(key):
+    """Maps a key to a point on the ring, stable across processes unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring over node ids. Every node is placed at several virtual points so that rooms spread evenly,
+    and a room falls through to the next live node clockwise when its owner is down, leaving every other room in place"""
+
+    def __init__(self, node_ids, replicas=64):
+        self.node_ids = sorted(node_ids)
+        self.points = []
+        self.owners = []
+        # Preference lists never change for a ring, rooms ask for theirs every tick
+        self.preferences = {}
+        for point, node_id in sorted((ring_hash(f"{node_id}:{replica}"), node_id) for node_id in self.node_ids for replica in range(replicas)):
+            self.points.append(point)
+            self.owners.append(node_id)
+
+    def preference(self, key):
+        """Returns every node id in the order they take over the key"""
+        order = self.preferences.get(key)
+        if order is not None:
+            return order
+        start = bisect.bisect(self.points, ring_hash(key))
+        order = []
+        for offset in range(len(self.points)):
+            node_id = self.owners[(start + offset) % len(self.points)]
+            if node_id not in order:
+                order.append(node_id)
+                if len(order) == len(self.node_ids):
+                    break
+        self.preferences[key] = order
+        return order
+
+    def owner(self, key, alive=None):
+        """Returns the first node of the key's preference list that is alive, or None if none is"""
+        for node_id in self.preference(key):
+            if alive is None or node_id in alive:
+                return node_id
+        return None
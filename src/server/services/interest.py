@@ -0,0 +1,159 @@
+from services.codec import BLAST_EVENT
+
+# Notifications for entities entering or leaving what a client sees. A bomb entering is sent as its spawn event
+PLAYER_ENTER = 6
+PLAYER_LEAVE = 7
+BOMB_LEAVE = 8
+
+
+class SpatialIndex:
+    """Uniform grid of buckets over entity positions. Finding the entities around a point only looks at the buckets the square touches"""
+
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.positions
+
+    def position(self, entity_id):
+        return self.positions.get(entity_id)
+
+    def insert(self, entity_id, x, y):
+        if entity_id in self.positions:
+            self.remove(entity_id)
+        self.positions[entity_id] = (x, y)
+        self.buckets.setdefault((x // self.bucket_size, y // self.bucket_size), set()).add(entity_id)
+
+    def remove(self, entity_id):
+        position = self.positions.pop(entity_id, None)
+        if position is None:
+            return
+        key = (position[0] // self.bucket_size, position[1] // self.bucket_size)
+        bucket = self.buckets[key]
+        bucket.discard(entity_id)
+        if not bucket:
+            del self.buckets[key]
+
+    def near(self, x, y, radius):
+        """Returns the ids of the entities at most radius cells away from (x, y) on both axes"""
+        size = self.bucket_size
+        found = set()
+        for bucket_x in range((x - radius) // size, (x + radius) // size + 1):
+            for bucket_y in range((y - radius) // size, (y + radius) // size + 1):
+                for entity_id in self.buckets.get((bucket_x, bucket_y), ()):
+                    entity_x, entity_y = self.positions[entity_id]
+                    if abs(entity_x - x) <= radius and abs(entity_y - y) <= radius:
+                        found.add(entity_id)
+        return found
+
+
+class ClientView:
+    """What one client sees: the player it follows, how far around it, and the entities it was last told about"""
+    __slots__ = ("player_id", "radius", "players", "bombs")
+
+    def __init__(self, player_id, radius):
+        self.player_id = player_id
+        self.radius = radius
+        self.players = set()
+        self.bombs = set()
+
+
+class InterestManager:
+    """Positions of the players and bombs of one room as of the batches committed so far, and what each of its clients sees.
+    Turns every committed batch into one update stream per client with only the events around its player"""
+
+    def __init__(self, room, bucket_size=8):
+        self.players = SpatialIndex(bucket_size)
+        self.bombs = SpatialIndex(bucket_size)
+        # Spawn event data of every bomb, sent again to clients the bomb comes into view of
+        self.bomb_spawns = {}
+        self.views = {}
+        for player in room.players.values():
+            self.players.insert(player.id, player.x, player.y)
+        for bomb in room.bombs.values():
+            self.bombs.insert(bomb.id, bomb.x, bomb.y)
+            self.bomb_spawns[bomb.id] = [bomb.x, bomb.y, bomb.id, bomb.owner, bomb.explode_tick]
+
+    def add_client(self, sock, player_id, radius):
+        """Starts following a client, returns the enter events of everything it sees right away"""
+        self.views[sock] = ClientView(player_id, radius)
+        if player_id not in self.players:
+            return []
+        return self.update_view(self.views[sock], [])
+
+    def remove_client(self, sock):
+        self.views.pop(sock, None)
+
+    def streams(self, events):
+        """Returns the events of a committed batch, already applied, to send to every client, enter and leave events included.
+        Clients whose player is not in the room see everything and share the batch list itself"""
+        streams = {}
+        for sock, view in self.views.items():
+            if view.player_id not in self.players:
+                streams[sock] = events
+                continue
+            stream = self.update_view(view, events)
+            if stream:
+                streams[sock] = stream
+        return streams
+
+    def apply(self, events):
+        """Moves the indexed entities the way the batch does"""
+        for event in events:
+            event_type, data = event["event_type"], event["data"]
+            if event_type == 0:
+                self.bombs.insert(data[2], data[0], data[1])
+                self.bomb_spawns[data[2]] = data
+            elif event_type == 2:
+                self.players.insert(data[0], data[3], data[4])
+            elif event_type == BLAST_EVENT:
+                for bomb_id in data[1]:
+                    self.bombs.remove(bomb_id)
+                    self.bomb_spawns.pop(bomb_id, None)
+
+    def update_view(self, view, events):
+        """Works out what the client sees after the batch and returns the events that take it there"""
+        x, y = self.players.position(view.player_id)
+        radius = view.radius
+        players = self.players.near(x, y, radius)
+        bombs = self.bombs.near(x, y, radius)
+
+        stream = [{"event_type": PLAYER_LEAVE, "data": [player_id]} for player_id in view.players - players]
+        # Bombs the client saw go away with the blasts it is sent, the others it is told to drop
+        removed = set()
+        for event in events:
+            event_type, data = event["event_type"], event["data"]
+            if event_type == 0:
+                relevant = data[2] in bombs
+            elif event_type == 2 or event_type == 4:
+                # Players coming into view are sent where they are now instead
+                relevant = data[0] in view.players and data[0] in players
+            elif event_type == BLAST_EVENT:
+                cells = data[2]
+                relevant = any(bomb_id in view.bombs for bomb_id in data[1]) or any(
+                    abs(cells[offset] - x) <= radius and abs(cells[offset + 1] - y) <= radius
+                    for offset in range(0, len(cells), 2)
+                )
+                if relevant:
+                    removed.update(data[1])
+            else:
+                relevant = True
+            if relevant:
+                stream.append(event)
+
+        stream += [{"event_type": BOMB_LEAVE, "data": [bomb_id]} for bomb_id in view.bombs - bombs - removed]
+        for player_id in players - view.players:
+            player_x, player_y = self.players.position(player_id)
+            stream.append({"event_type": PLAYER_ENTER, "data": [player_id, player_x, player_y]})
+        spawned = {event["data"][2] for event in events if event["event_type"] == 0}
+        for bomb_id in bombs - view.bombs - spawned:
+            stream.append({"event_type": 0, "data": self.bomb_spawns[bomb_id]})
+
+        view.players = players
+        view.bombs = bombs
+        return stream
@@ -0,0 +1,216 @@
+import selectors
+import socket
+import threading
+from collections import deque
+from services.framing import FrameReader
+
+HANDSHAKE_KINDS = {
+    "client_hello": "client",
+    "server_hello": "follower",
+}
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.outgoing = bytearray()
+        self.kind = None
+
+
+class NetworkLoop:
+    """Single thread that owns the listening socket, all connections and their buffers, and batches decoded messages into one inbox"""
+
+    def __init__(self, host, port, max_outgoing=4 * 1024 * 1024):
+        self.host = host
+        self.port = port
+        # Connections with more unsent bytes than this are not keeping up and get dropped
+        self.max_outgoing = max_outgoing
+        self.selector = selectors.DefaultSelector()
+        self.server = None
+        self.connections = {}
+        self.running = False
+        self.thread = None
+
+        self.inbox = deque()
+        self.inbox_lock = threading.Lock()
+        self.pending_writes = deque()
+        self.pending_closes = deque()
+        self.waker, self.wake_sock = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_sock.setblocking(False)
+
+    def start(self):
+        """Binds the listening socket and starts the loop thread"""
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+        self.selector.register(self.waker, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the loop and closes every socket it owns"""
+        self.running = False
+        self._wake()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=1.0)
+
+    def drain(self):
+        """Returns every (kind, sock, message) received since the last call, kind being client, follower, message or closed"""
+        with self.inbox_lock:
+            if not self.inbox:
+                return ()
+            batch = self.inbox
+            self.inbox = deque()
+        return batch
+
+    def send(self, sock, data):
+        """Queues framed data for the socket. Safe to call from any thread, nothing is written before the next flush"""
+        self.pending_writes.append((sock, data))
+
+    def flush(self):
+        """Wakes the loop once to write everything queued since the last flush"""
+        if self.pending_writes:
+            self._wake()
+
+    def close(self, sock):
+        """Closes the connection from any thread"""
+        self.pending_closes.append(sock)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_sock.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        """Selects over the listener and all connections until stopped"""
+        try:
+            while self.running:
+                for key, mask in self.selector.select():
+                    if key.fileobj is self.server:
+                        self._accept()
+                    elif key.fileobj is self.waker:
+                        self._drain_waker()
+                    else:
+                        conn = key.data
+                        if mask & selectors.EVENT_READ:
+                            self._read(conn)
+                        if mask & selectors.EVENT_WRITE and conn.sock in self.connections:
+                            self._flush(conn)
+                self._process_pending()
+        finally:
+            self._shutdown()
+
+    def _accept(self):
+        try:
+            sock, address = self.server.accept()
+        except BlockingIOError:
+            return
+        print(f"[COMMS] Connected with {address}", flush=True)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock)
+        self.connections[sock] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _drain_waker(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _read(self, conn):
+        """Reads what is available and parses every complete message in one pass"""
+        try:
+            if conn.reader.recv_from(conn.sock) == 0:
+                self._close(conn)
+                return
+            batch = []
+            for msg in conn.reader.messages():
+                if conn.kind is None:
+                    conn.kind = HANDSHAKE_KINDS.get(msg.get("type"))
+                    if conn.kind is None:
+                        print(f"[NET] Unknown handshake type: {msg.get('type')}", flush=True)
+                        self._close(conn, notify=False)
+                        return
+                    batch.append((conn.kind, conn.sock, msg))
+                else:
+                    batch.append(("message", conn.sock, msg))
+        except BlockingIOError:
+            return
+        except Exception as error:
+            print(f"[COMMS] Connection closed or error: {error}", flush=True)
+            self._close(conn)
+            return
+        if batch:
+            with self.inbox_lock:
+                self.inbox.extend(batch)
+
+    def _process_pending(self):
+        """Moves data queued by other threads into connection buffers and handles close requests"""
+        while self.pending_writes:
+            sock, data = self.pending_writes.popleft()
+            conn = self.connections.get(sock)
+            if conn is None:
+                continue
+            was_empty = not conn.outgoing
+            conn.outgoing += data
+            if len(conn.outgoing) > self.max_outgoing:
+                print(f"[COMMS] Dropping connection with {len(conn.outgoing)} unsent bytes", flush=True)
+                self._close(conn)
+                continue
+            if was_empty:
+                self._flush(conn)
+        while self.pending_closes:
+            conn = self.connections.get(self.pending_closes.popleft())
+            if conn is not None:
+                self._close(conn)
+
+    def _flush(self, conn):
+        """Writes as much of the outgoing buffer as the socket accepts"""
+        try:
+            sent = conn.sock.send(conn.outgoing)
+            del conn.outgoing[:sent]
+        except BlockingIOError:
+            pass
+        except Exception as error:
+            print(f"[COMMS] Send failed: {error}", flush=True)
+            self._close(conn)
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.outgoing else selectors.EVENT_READ
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events, conn)
+
+    def _close(self, conn, notify=True):
+        if self.connections.pop(conn.sock, None) is None:
+            return
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+        if notify and conn.kind is not None:
+            with self.inbox_lock:
+                self.inbox.append(("closed", conn.sock, None))
+
+    def _shutdown(self):
+        """Closes every connection and the listener"""
+        for conn in list(self.connections.values()):
+            self._close(conn, notify=False)
+        for sock in (self.server, self.waker, self.wake_sock):
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self.selector.close()
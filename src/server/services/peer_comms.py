@@ -1,18 +1,25 @@
+import random
 import socket
 import threading
-import json
 import time
+from services.framing import FrameReader, encode_message
 
 class PeerComms:
-    def __init__(self, server_id, peers, port, msg_queue):
+    def __init__(self, server_id, peers, port, msg_queue, connect_timeout=0.5, retry_min=0.05, retry_max=2.0):
         self.server_id = server_id
         self.peers = peers
         self.msg_queue = msg_queue
-        self.current_leader = 99
 
         self.listener = None
         self.peer_sockets = {}
         self.peer_recv_threads = {}
+        self.send_locks = {}
+
+        self.connect_timeout = connect_timeout
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        # Peers whose last connection attempt failed
+        self.unreachable = set()
 
         self._start_listener(port)
         self._connect_to_peers()
@@ -33,41 +40,38 @@ class PeerComms:
         """Loop to accept new peers"""
         while True:
             conn, addr = self.listener.accept()
-            raw = conn.recv(1024).decode("utf-8")
-            msg = json.loads(raw)
+            reader = FrameReader()
+            try:
+                msg = reader.recv_message(conn)
+            except Exception:
+                conn.close()
+                continue
             if msg["type"] == "peer_hello":
-                new_msg = {
-                    "type": "curr_leader",
-                    "leader": self.current_leader,
-                    "from": self.server_id
-                }
-                conn.send(json.dumps(new_msg).encode("utf-8"))
+                conn.sendall(encode_message({"type": "peer_up", "from": self.server_id}))
                 peer_id = msg["server_id"]
                 self.peer_sockets[peer_id] = conn
-                self._start_recv_thread(conn)
+                self.unreachable.discard(peer_id)
+                # Discovery hears from the connecting peer either way
+                self.msg_queue.put({"type": "peer_up", "from": peer_id})
+                self._start_recv_thread(conn, reader)
     
-    def _start_recv_thread(self, conn):
+    def _start_recv_thread(self, conn, reader=None):
         """Starts the thread to receive messages"""
         t = threading.Thread(
             target=self._recv_loop,
-            args=(conn,),
+            args=(conn, reader or FrameReader()),
             daemon=True
         )
         t.start()
 
-    def _recv_loop(self, conn):
+    def _recv_loop(self, conn, reader):
         """Loop to add messages to message queue"""
         while True:
             try:
-                data = conn.recv(4096)
-                if not data:
+                if reader.recv_from(conn) == 0:
                     return
-                
-                text = data.decode("utf-8")
-                parts = text.replace("}{", "}|{").split("|")
 
-                for chunk in parts:
-                    msg = json.loads(chunk)
+                for msg in reader.messages():
                     self.msg_queue.put(msg)
 
             except:
@@ -83,37 +87,49 @@ class PeerComms:
             thread.start()
 
     def _try_connect_peer(self, peer_id, ip, port):
-        """Attempts to connect to peers"""
+        """Attempts to connect to peers, backing off exponentially with jitter between attempts"""
+        delay = self.retry_min
         while peer_id not in self.peer_sockets:
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((ip, port))
+                sock = socket.create_connection((ip, port), timeout=self.connect_timeout)
+                sock.settimeout(None)
+                handshake = {"type": "peer_hello", "server_id": self.server_id}
+                sock.sendall(encode_message(handshake))
                 self.peer_sockets[peer_id] = sock
+                self.unreachable.discard(peer_id)
                 self._start_recv_thread(sock)
-
-                handshake = {"type": "peer_hello", "server_id": self.server_id}
-                sock.send(json.dumps(handshake).encode("utf-8"))
             except Exception as e:
-                print(f"Couldn't connect to server {peer_id}", flush=True)
-                time.sleep(1)
+                if peer_id not in self.unreachable:
+                    print(f"Couldn't connect to server {peer_id}, retrying with backoff", flush=True)
+                self.unreachable.add(peer_id)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.retry_max)
+
+    def _send(self, peer_id, sock, raw):
+        """Sends a whole frame, frames sent from different threads never interleave"""
+        with self.send_locks.setdefault(peer_id, threading.Lock()):
+            sock.sendall(raw)
 
     def send_to_peer(self, peer_id, msg):
         """Sends message to single peer"""
-        if peer_id not in self.peer_sockets:
-            return
-        raw = json.dumps(msg).encode("utf-8")
+        sock = self.peer_sockets.get(peer_id)
+        if sock is None:
+            return False
+        raw = encode_message(msg, "binary")
         try:
-            self.peer_sockets[peer_id].send(raw)
+            self._send(peer_id, sock, raw)
+            return True
         except:
-            self._drop_socket(self.peer_sockets[peer_id], peer_id)
+            self._drop_socket(sock, peer_id)
+            return False
 
     def broadcast(self, msg):
         """Sends message to all peers"""
-        raw = json.dumps(msg).encode("utf-8")
+        raw = encode_message(msg, "binary")
         dropped = []
-        for peer_id, sock in self.peer_sockets.items():
+        for peer_id, sock in list(self.peer_sockets.items()):
             try:
-                sock.send(raw)
+                self._send(peer_id, sock, raw)
             except:
                 dropped.append((peer_id, sock))
         if dropped:
@@ -132,5 +148,5 @@ class PeerComms:
         except:
             pass
 
-        if key is not None:
+        if key is not None and self.peer_sockets.get(key) is sock:
             del self.peer_sockets[key]
\ No newline at end of file
@@ -0,0 +1,149 @@
+import time
+from collections import OrderedDict, deque
+
+
+class InFlightTick:
+    def __init__(self, seq, tick, events, targets, first_tick=None):
+        self.seq = seq
+        self.tick = tick
+        # Tick of the oldest events of a coalesced batch, the batch itself carries the latest
+        self.first_tick = tick if first_tick is None else first_tick
+        self.events = events
+        self.targets = targets
+        self.acked = set()
+        self.sent_at = time.perf_counter()
+
+
+COMMIT_POLICIES = ("all", "majority", "leader")
+
+
+class Replicator:
+    """Tracks ticks sent to followers by sequence number and commits them in order once acked, without blocking the tick loop"""
+
+    def __init__(self, max_in_flight=8, first_seq=1, commit_policy="all", ack_timeout=0.25):
+        if commit_policy not in COMMIT_POLICIES:
+            raise ValueError(f"Unknown commit policy {commit_policy}, expected one of {COMMIT_POLICIES}")
+        self.max_in_flight = max_in_flight
+        self.commit_policy = commit_policy
+        self.ack_timeout = ack_timeout
+        self.next_seq = first_seq
+        self.commit_index = first_seq - 1
+        self.in_flight = OrderedDict()
+
+        self.pending_events = []
+        self.pending_tick = None
+        # Coalesced batches are sent with their latest tick, but their oldest events are uncommitted since the first
+        self.pending_first_tick = None
+
+        self.follower_acked = {}
+        self.lagging = set()
+        self.commit_latencies = deque(maxlen=512)
+        self.coalesced_ticks = 0
+
+    def has_room(self):
+        return len(self.in_flight) < self.max_in_flight
+
+    def submit(self, tick, events, followers):
+        """Assigns the next sequence number to the events of this tick. Returns None when the window is full and the events were held back"""
+        if events:
+            if self.pending_tick is not None:
+                self.coalesced_ticks += 1
+            else:
+                self.pending_first_tick = tick
+            self.pending_events.extend(events)
+            self.pending_tick = tick
+        if self.pending_tick is None or not self.has_room():
+            return None
+
+        entry = InFlightTick(self.next_seq, self.pending_tick, self.pending_events, set(followers), self.pending_first_tick)
+        self.in_flight[entry.seq] = entry
+        self.next_seq += 1
+        self.pending_events = []
+        self.pending_tick = None
+        self.pending_first_tick = None
+        return entry
+
+    def oldest_uncommitted_tick(self):
+        """Returns the tick of the oldest events not committed yet, None when everything submitted is committed"""
+        if self.in_flight:
+            return next(iter(self.in_flight.values())).first_tick
+        return self.pending_first_tick
+
+    def record_ack(self, follower_id, seq):
+        """Marks the tick with the given sequence number as acked by the follower"""
+        entry = self.in_flight.get(seq)
+        if entry is not None:
+            entry.acked.add(follower_id)
+        if seq > self.follower_acked.get(follower_id, 0):
+            self.follower_acked[follower_id] = seq
+
+    def add_follower(self, follower_id, acked_seq=None):
+        """Starts tracking a follower from the last batch it has, by default the latest. Ticks sent before it connected do not wait for it"""
+        self.follower_acked[follower_id] = self.next_seq - 1 if acked_seq is None else acked_seq
+        for entry in self.in_flight.values():
+            entry.targets.discard(follower_id)
+
+    def forget_follower(self, follower_id):
+        """Stops waiting for a follower that disconnected"""
+        self.follower_acked.pop(follower_id, None)
+        self.lagging.discard(follower_id)
+
+    def required_acks(self, voters):
+        """Returns how many follower acks the commit policy needs from the given voting followers"""
+        if self.commit_policy == "all":
+            return len(voters)
+        if self.commit_policy == "majority":
+            # The leader counts towards the majority of the leader and its voters
+            return (len(voters) + 1) // 2
+        return 0
+
+    def is_committable(self, entry, followers):
+        voters = [follower_id for follower_id in entry.targets if follower_id in followers and follower_id not in self.lagging]
+        acks = sum(1 for follower_id in entry.acked if follower_id in followers)
+        return acks >= self.required_acks(voters)
+
+    def update_lagging(self, followers, now):
+        """Drops followers from the quorum when their oldest unacked tick is older than the timeout, and readmits them once caught up"""
+        for follower_id in followers:
+            acked = self.follower_acked.get(follower_id, 0)
+            if follower_id in self.lagging:
+                if acked >= self.commit_index:
+                    self.lagging.discard(follower_id)
+                    print(f"[REPLICATION] Follower {follower_id} caught up, back in quorum", flush=True)
+                continue
+            for entry in self.in_flight.values():
+                if entry.seq <= acked or follower_id not in entry.targets:
+                    continue
+                if now - entry.sent_at > self.ack_timeout:
+                    self.lagging.add(follower_id)
+                    print(f"[REPLICATION] Follower {follower_id} lagging at seq {acked}, dropped from quorum", flush=True)
+                break
+
+    def advance(self, followers):
+        """Commits the in-flight ticks at the head of the window that satisfy the commit policy"""
+        committed = []
+        now = time.perf_counter()
+        self.update_lagging(followers, now)
+        while self.in_flight:
+            entry = next(iter(self.in_flight.values()))
+            if not self.is_committable(entry, followers):
+                break
+            del self.in_flight[entry.seq]
+            self.commit_index = entry.seq
+            self.commit_latencies.append(now - entry.sent_at)
+            committed.append(entry)
+        return committed
+
+    def metrics(self):
+        """Returns replication lag and commit latency figures"""
+        latest = self.next_seq - 1
+        latencies = sorted(self.commit_latencies)
+        return {
+            "in_flight": len(self.in_flight),
+            "commit_index": self.commit_index,
+            "lag": {follower_id: latest - acked for follower_id, acked in self.follower_acked.items()},
+            "lagging": sorted(self.lagging),
+            "commit_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else 0.0,
+            "commit_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else 0.0,
+            "coalesced_ticks": self.coalesced_ticks,
+        }
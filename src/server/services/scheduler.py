@@ -0,0 +1,86 @@
+import bisect
+import time
+from collections import deque
+
+# Upper bounds in milliseconds of the tick duration histogram buckets, the last bucket takes everything slower
+HISTOGRAM_BOUNDS_MS = (0.25, 0.5, 1, 2, 4, 8, 16, 33)
+
+
+class TickScheduler:
+    """Fixed-timestep scheduler. Sleeps until the next tick deadline, runs a bounded number of catch-up ticks when late and keeps timing statistics"""
+
+    def __init__(self, tick_interval, max_catch_up=5, spin=0.0005):
+        self.tick_interval = tick_interval
+        self.max_catch_up = max_catch_up
+        self.spin = spin
+
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.durations = deque(maxlen=512)
+        self.lateness = deque(maxlen=512)
+        self.reset()
+
+    def reset(self):
+        """Starts a fresh schedule with the first tick one interval from now"""
+        self.started = time.perf_counter()
+        self.next_deadline = self.started + self.tick_interval
+        self.ticks = 0
+        self.overruns = 0
+        self.catch_up_ticks = 0
+        self.skipped = 0
+
+    def sleep_until(self, deadline):
+        """Sleeps until the deadline, yielding the last stretch instead of oversleeping it"""
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            if remaining > self.spin:
+                time.sleep(remaining - self.spin)
+            else:
+                time.sleep(0)
+
+    def ticks_due(self):
+        """Sleeps until the next deadline, returns how many ticks are due now. Ticks beyond max_catch_up are skipped"""
+        self.sleep_until(self.next_deadline)
+        late = time.perf_counter() - self.next_deadline
+        due = int(late // self.tick_interval) + 1
+        if due > self.max_catch_up:
+            self.skipped += due - self.max_catch_up
+            self.next_deadline += (due - self.max_catch_up) * self.tick_interval
+            due = self.max_catch_up
+        self.catch_up_ticks += due - 1
+        return due
+
+    def run_ticks(self):
+        """Yields once per due tick and times the work the caller does for it"""
+        for _ in range(self.ticks_due()):
+            start = time.perf_counter()
+            self.lateness.append(start - self.next_deadline)
+            self.next_deadline += self.tick_interval
+            yield
+            self.record(time.perf_counter() - start)
+
+    def record(self, duration):
+        """Adds the duration of a finished tick to the statistics"""
+        self.ticks += 1
+        self.durations.append(duration)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, duration * 1000)] += 1
+        if duration > self.tick_interval:
+            self.overruns += 1
+
+    def metrics(self):
+        """Returns tick timing figures. Drift is how far the ticks run so far lag behind wall-clock time"""
+        durations = sorted(self.durations)
+        lateness = sorted(self.lateness)
+        elapsed = time.perf_counter() - self.started
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "catch_up_ticks": self.catch_up_ticks,
+            "skipped": self.skipped,
+            "tick_p50_ms": round(durations[len(durations) // 2] * 1000, 3) if durations else 0.0,
+            "tick_p99_ms": round(durations[int(len(durations) * 0.99)] * 1000, 3) if durations else 0.0,
+            "late_p99_ms": round(lateness[int(len(lateness) * 0.99)] * 1000, 3) if lateness else 0.0,
+            "drift_ms": round((elapsed - self.ticks * self.tick_interval) * 1000, 1),
+            "histogram": dict(zip([f"<{bound}ms" for bound in HISTOGRAM_BOUNDS_MS] + ["slower"], self.histogram)),
+        }
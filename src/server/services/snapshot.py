@@ -0,0 +1,111 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"BMSN"
+VERSION = 3
+
+# magic, version, room id, seq, tick, width, height, players, bombs, next bomb id, reserved
+HEADER = struct.Struct("<4sHHQqIIIIII")
+PLAYER = struct.Struct("<iiiBB2x")   # id, x, y, moving, alive
+BOMB = struct.Struct("<iiiii")       # id, x, y, owner, explode tick
+
+LEVEL, BOMBS, PLAYERS, EXPLOSIONS = range(4)
+GRID_COUNT = 4
+
+
+def encode_snapshot(room, seq, tick):
+    """Encodes the grids and entity tables of a room into the fixed snapshot layout"""
+    grid = room.grid
+    parts = [HEADER.pack(
+        MAGIC, VERSION, room.room_id, seq, tick, grid.width, grid.height,
+        len(room.players), len(room.bombs), room.bombs.allocate(), 0
+    )]
+    for cells in grid.grids():
+        parts.append(cells.tobytes())
+    for player in room.players.values():
+        parts.append(PLAYER.pack(player.id, player.x, player.y, player.moving, player.alive))
+    for bomb in room.bombs.values():
+        explode_tick = bomb.explode_tick if bomb.explode_tick is not None else -1
+        parts.append(BOMB.pack(bomb.id, bomb.x, bomb.y, bomb.owner, explode_tick))
+    return b"".join(parts)
+
+
+class Snapshot:
+    """Read-only view over an encoded snapshot. Grids and tables are read in place from the buffer, which may be a memory map"""
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        (magic, version, self.room_id, self.seq, self.tick, self.width, self.height,
+         self.player_count, self.bomb_count, self.next_bomb_id, _) = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a snapshot or unsupported snapshot version")
+
+        self.grid_size = self.width * self.height * 4
+        self.players_offset = HEADER.size + GRID_COUNT * self.grid_size
+        self.bombs_offset = self.players_offset + self.player_count * PLAYER.size
+        self.end = self.bombs_offset + self.bomb_count * BOMB.size
+        if len(self.buffer) < self.end:
+            raise ValueError("Truncated snapshot")
+
+    def grid_bytes(self, index):
+        """Returns the raw little-endian bytes of one grid"""
+        start = HEADER.size + index * self.grid_size
+        return self.buffer[start:start + self.grid_size]
+
+    def grid(self, index):
+        """Returns the cells of one grid as a flat int view, row by row"""
+        cells = self.grid_bytes(index)
+        if sys.byteorder == "big":
+            swapped = array("i", cells.tobytes())
+            swapped.byteswap()
+            return memoryview(swapped)
+        return cells.cast("i")
+
+    def rows(self, index):
+        """Returns one grid as a list of rows"""
+        cells = self.grid(index).tolist()
+        return [cells[y * self.width:(y + 1) * self.width] for y in range(self.height)]
+
+    def players(self):
+        return PLAYER.iter_unpack(self.buffer[self.players_offset:self.bombs_offset])
+
+    def bombs(self):
+        return BOMB.iter_unpack(self.buffer[self.bombs_offset:self.end])
+
+    def tables_bytes(self):
+        """Returns the raw player and bomb tables"""
+        return self.buffer[self.players_offset:self.end]
+
+    def tobytes(self):
+        return self.buffer[:self.end].tobytes()
+
+
+def read_snapshots(buffer):
+    """Returns the snapshots stored back to back in the buffer, one per room"""
+    snapshots = []
+    view = memoryview(buffer)
+    offset = 0
+    while offset < len(view):
+        snapshot = Snapshot(view[offset:])
+        snapshots.append(snapshot)
+        offset += snapshot.end
+    return snapshots
+
+
+def open_snapshots(path):
+    """Memory-maps a snapshot file and returns the room snapshots in it"""
+    with open(path, "rb") as snapshot_file:
+        return read_snapshots(mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def write_snapshot(path, data):
+    """Writes the snapshot atomically next to the previous one and replaces it"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, path)
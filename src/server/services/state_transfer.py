@@ -0,0 +1,151 @@
+import base64
+import struct
+import zlib
+from array import array
+from services.snapshot import HEADER, GRID_COUNT, Snapshot
+
+# How a grid is carried in a transfer
+UNCHANGED, FULL, ROWS = range(3)
+
+SECTION = struct.Struct("!BI")  # mode, compressed length
+ROW_COUNT = struct.Struct("!I")
+ROOM_LENGTH = struct.Struct("!I")  # length of one room transfer in a bundle
+CHUNK_SIZE = 64 * 1024
+
+
+def row_hashes(snapshot, index):
+    """Returns the crc32 of every row of one grid"""
+    grid = snapshot.grid_bytes(index)
+    row_size = snapshot.width * 4
+    return array("I", (zlib.crc32(grid[y * row_size:(y + 1) * row_size]) for y in range(snapshot.height)))
+
+
+def digest(snapshot):
+    """Describes the grids a node already has so that a state transfer can skip them"""
+    return {
+        "width": snapshot.width,
+        "height": snapshot.height,
+        "grids": [base64.b64encode(row_hashes(snapshot, index).tobytes()).decode("ascii") for index in range(GRID_COUNT)]
+    }
+
+
+def _changed_rows(snapshot, index, have):
+    """Returns the rows of the grid that differ from the digest, or None if the digest does not match the shape"""
+    if not have or have.get("width") != snapshot.width or have.get("height") != snapshot.height:
+        return None
+    theirs = array("I", base64.b64decode(have["grids"][index]))
+    if len(theirs) != snapshot.height:
+        return None
+    ours = row_hashes(snapshot, index)
+    return [y for y in range(snapshot.height) if ours[y] != theirs[y]]
+
+
+def encode_transfer(snapshot, have=None):
+    """Encodes a snapshot for another node. Grids are zlib compressed, and with a digest only the rows that differ are sent"""
+    out = bytearray(snapshot.buffer[:HEADER.size])
+    row_size = snapshot.width * 4
+    for index in range(GRID_COUNT):
+        grid = snapshot.grid_bytes(index)
+        changed = _changed_rows(snapshot, index, have)
+        if changed is not None and not changed:
+            out += SECTION.pack(UNCHANGED, 0)
+            continue
+        if changed is not None and len(changed) < snapshot.height // 2:
+            body = ROW_COUNT.pack(len(changed)) + struct.pack(f"!{len(changed)}I", *changed)
+            body += b"".join(grid[y * row_size:(y + 1) * row_size] for y in changed)
+            mode = ROWS
+        else:
+            body = grid
+            mode = FULL
+        body = zlib.compress(body)
+        out += SECTION.pack(mode, len(body))
+        out += body
+
+    tables = zlib.compress(snapshot.tables_bytes())
+    out += SECTION.pack(FULL, len(tables))
+    out += tables
+    return bytes(out)
+
+
+def decode_transfer(payload, base=None):
+    """Rebuilds the full snapshot from a transfer, taking grids and rows that were not sent from the base snapshot"""
+    payload = memoryview(payload)
+    width, height = HEADER.unpack_from(payload, 0)[5:7]
+    row_size = width * 4
+    parts = [payload[:HEADER.size].tobytes()]
+    offset = HEADER.size
+    for index in range(GRID_COUNT + 1):
+        mode, length = SECTION.unpack_from(payload, offset)
+        offset += SECTION.size
+        body = payload[offset:offset + length]
+        offset += length
+
+        if mode == FULL:
+            parts.append(zlib.decompress(body))
+        elif mode == UNCHANGED:
+            parts.append(base.grid_bytes(index).tobytes())
+        else:
+            data = zlib.decompress(body)
+            (count,) = ROW_COUNT.unpack_from(data, 0)
+            rows = struct.unpack_from(f"!{count}I", data, ROW_COUNT.size)
+            grid = bytearray(base.grid_bytes(index))
+            start = ROW_COUNT.size + count * 4
+            for i, y in enumerate(rows):
+                grid[y * row_size:(y + 1) * row_size] = data[start + i * row_size:start + (i + 1) * row_size]
+            parts.append(bytes(grid))
+    return Snapshot(b"".join(parts))
+
+
+def describe(payload):
+    """Returns the mode of each grid in a transfer, for logging"""
+    names = []
+    offset = HEADER.size
+    for _ in range(GRID_COUNT):
+        mode, length = SECTION.unpack_from(payload, offset)
+        names.append(("unchanged", "full", "rows")[mode])
+        offset += SECTION.size + length
+    return names
+
+
+def bundle(transfers):
+    """Joins the transfers of several rooms into one payload, each one knows its room from its snapshot header"""
+    return b"".join(ROOM_LENGTH.pack(len(transfer)) + transfer for transfer in transfers)
+
+
+def unbundle(payload):
+    """Splits a bundle back into the room transfers"""
+    payload = memoryview(payload)
+    transfers = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = ROOM_LENGTH.unpack_from(payload, offset)
+        offset += ROOM_LENGTH.size
+        transfers.append(payload[offset:offset + length])
+        offset += length
+    return transfers
+
+
+def room_of(transfer):
+    """Returns the room id in the snapshot header of a transfer"""
+    return HEADER.unpack_from(transfer, 0)[2]
+
+
+def split(payload, size=CHUNK_SIZE):
+    """Splits a transfer into chunks of at most size bytes"""
+    return [payload[start:start + size] for start in range(0, len(payload), size)] or [b""]
+
+
+class TransferAssembler:
+    """Collects the chunks of state transfers until one is complete"""
+
+    def __init__(self):
+        self.transfers = {}
+
+    def add(self, msg):
+        """Stores a chunk, returns the whole transfer once its last chunk arrived"""
+        chunks = self.transfers.setdefault((msg["from"], msg["transfer_id"]), {})
+        chunks[msg["index"]] = msg["data"]
+        if len(chunks) < msg["total"]:
+            return None
+        del self.transfers[(msg["from"], msg["transfer_id"])]
+        return b"".join(chunks[index] for index in range(msg["total"]))
@@ -0,0 +1,131 @@
+import os
+import struct
+import threading
+import time
+from services import codec
+from services.framing import FrameReader, encode_frame
+from services.snapshot import open_snapshots, write_snapshot
+
+BATCH_HEADER = struct.Struct("!HQIH")  # room id, seq, tick, event count
+
+SNAPSHOT_FILE = "snapshot.bin"
+SEGMENT_PREFIX = "wal-"
+SEGMENT_SUFFIX = ".log"
+
+
+def encode_batch(room_id, seq, tick, events):
+    out = bytearray(BATCH_HEADER.pack(room_id, seq, tick, len(events)))
+    codec.encode_events(events, out)
+    return encode_frame(bytes(out))
+
+
+class Checkpoint:
+    def __init__(self, tick, data):
+        self.tick = tick
+        self.data = data
+
+
+class WriteAheadLog:
+    """Append-only log of the committed tick batches of every room with periodic snapshots of all rooms.
+    A writer thread does the disk I/O and fsyncs once per group of records"""
+
+    def __init__(self, directory, fsync_every_ticks=30, fsync_interval_ms=50):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.fsync_every_ticks = fsync_every_ticks
+        self.fsync_interval = fsync_interval_ms / 1000
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        self.segment = segments[-1] + 1 if segments else 1
+        self.file = open(self._segment_path(self.segment), "ab")
+        self.pending = []
+        self.condition = threading.Condition()
+
+        thread = threading.Thread(target=self._write_loop, daemon=True)
+        thread.start()
+
+    def append(self, room_id, seq, tick, events):
+        """Queues a committed batch of a room, returns without touching the disk"""
+        with self.condition:
+            self.pending.append(encode_batch(room_id, seq, tick, events))
+            self.condition.notify()
+
+    def checkpoint(self, tick, data):
+        """Queues the snapshots of every room taken at the given tick. Once they are on disk the log segments before them are deleted"""
+        with self.condition:
+            self.pending.append(Checkpoint(tick, data))
+            self.condition.notify()
+
+    def _write_loop(self):
+        """Writes queued records and fsyncs every fsync_every_ticks records or fsync_interval, whichever comes first"""
+        unsynced = 0
+        last_sync = time.perf_counter()
+        while True:
+            with self.condition:
+                if not self.pending:
+                    timeout = max(0.0, last_sync + self.fsync_interval - time.perf_counter()) if unsynced else None
+                    self.condition.wait(timeout)
+                records = self.pending
+                self.pending = []
+
+            for record in records:
+                if isinstance(record, Checkpoint):
+                    self._write_checkpoint(record)
+                    unsynced = 0
+                    last_sync = time.perf_counter()
+                else:
+                    self.file.write(record)
+                    unsynced += 1
+
+            now = time.perf_counter()
+            if unsynced and (unsynced >= self.fsync_every_ticks or now - last_sync >= self.fsync_interval):
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                unsynced = 0
+                last_sync = now
+
+    def _write_checkpoint(self, checkpoint):
+        """Writes the snapshot, then starts a new segment and deletes the ones it covers"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        write_snapshot(self.snapshot_path, checkpoint.data)
+
+        self.file.close()
+        for segment in self._segments():
+            os.remove(self._segment_path(segment))
+        self.segment += 1
+        self.file = open(self._segment_path(self.segment), "ab")
+        print(f"[WAL] Snapshot at tick {checkpoint.tick} written, log compacted", flush=True)
+
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+    def recover(self):
+        """Returns the latest room snapshots and the logged (room id, seq, tick, events) batches after them in order. A torn last record is cut off"""
+        snapshots = open_snapshots(self.snapshot_path) if os.path.exists(self.snapshot_path) else []
+        base_seqs = {snapshot.room_id: snapshot.seq for snapshot in snapshots}
+
+        batches = []
+        for segment in self._segments():
+            path = self._segment_path(segment)
+            reader = FrameReader()
+            with open(path, "rb") as log_file:
+                reader.feed(log_file.read())
+            for payload in reader.frames():
+                room_id, seq, tick, count = BATCH_HEADER.unpack_from(payload, 0)
+                if seq <= base_seqs.get(room_id, 0):
+                    continue
+                events, _ = codec.decode_events(payload, BATCH_HEADER.size, count)
+                batches.append((room_id, seq, tick, events))
+            if reader.end > reader.start:
+                print(f"[WAL] Dropping torn record of {reader.end - reader.start} bytes", flush=True)
+                os.truncate(path, reader.start)
+        return snapshots, batches
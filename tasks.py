@@ -1,9 +1,13 @@
 from invoke import task
 
-@task
-def start_client(ctx):
-    ctx.run("python3 src/client/main.py")
+@task(help={'room': "The room (match) to join, rooms are created on first use"})
+def start_client(ctx, room=0):
+    ctx.run(f"python3 src/client/main.py {room}")
 
 @task(help={'id': "The unique ID of the server (1, 2, or 3)"})
 def start_server(ctx, id=1):
-    ctx.run(f"python3 src/server/main.py {id}")
\ No newline at end of file
+    ctx.run(f"python3 src/server/main.py {id}")
+
+@task
+def benchmark(ctx):
+    ctx.run("python3 benchmarks/timer_queue.py")
\ No newline at end of file
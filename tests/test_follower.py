@@ -0,0 +1,92 @@
+from follower import Follower
+from room import Room
+from server_loop import ServerLoop
+from services.hash_ring import HashRing
+
+
+class FakeLeader:
+    def __init__(self):
+        self.claims = {}
+
+    def leads(self, room_id):
+        return False
+
+
+class FakeFollowerComms:
+    def __init__(self):
+        self.sent = []
+        self.connected = True
+
+    def send_to_leader(self, msg, encoding="json"):
+        self.sent.append(msg)
+
+    def close_socket(self):
+        pass
+
+
+class FakeServerLoop:
+    server_id = 3
+    retained_batches = ServerLoop.retained_batches
+    drop_retained = ServerLoop.drop_retained
+    forget_leader = ServerLoop.forget_leader
+
+    def __init__(self):
+        empty = [[0] * 5 for _ in range(5)]
+        players = [row[:] for row in empty]
+        players[0][0] = 1
+        self.rooms = {0: Room(0, (empty, empty, players, empty))}
+        self.global_tick = 0
+        self.room_leaders = {}
+        self.leader = FakeLeader()
+        self.ring = HashRing([1, 2, 3])
+        self.links = {}
+
+    def is_valid_room(self, room_id):
+        return room_id in self.rooms
+
+    def get_room(self, room_id):
+        return self.rooms[room_id]
+
+    def record_committed(self, room, seq, tick, events):
+        room.event_log.append(seq, tick, events)
+        room.last_applied_seq = seq
+
+
+def link(server_loop, peer_id):
+    follower = Follower(server_loop, peer_id)
+    follower.comms = FakeFollowerComms()
+    server_loop.links[peer_id] = follower
+    return follower
+
+
+def test_batches_of_a_failed_leader_are_handed_to_the_next_one():
+    server_loop = FakeServerLoop()
+    old_leader = link(server_loop, 1)
+    new_leader = link(server_loop, 2)
+    move = {"event_type": 2, "data": [1, 1, 0, 1, 0]}
+    stop = {"event_type": 4, "data": [1]}
+    old_leader.process_follower_message({"type": "event", "room": 0, "seq": 1, "tick": 5, "commit": 0, "leader_tick": 5, "data": [move]})
+    old_leader.process_follower_message({"type": "event", "room": 0, "seq": 2, "tick": 6, "commit": 1, "leader_tick": 6, "data": [stop]})
+    old_leader.disconnect("test")
+    assert server_loop.rooms[0].last_applied_seq == 1
+
+    new_leader.process_follower_message({"type": "room_claim", "leader_id": 2, "room": 0, "have": 0})
+
+    reply = new_leader.comms.sent[-1]
+    assert reply["type"] == "room_log"
+    assert not reply["leading"]
+    assert reply["last_seq"] == 1
+    assert reply["batches"] == [[1, 5, [move]], [2, 6, [stop]]]
+    assert server_loop.room_leaders[0] == 2
+    assert not server_loop.retained_batches(0)
+
+
+def test_claim_of_a_room_this_node_leads_is_refused():
+    server_loop = FakeServerLoop()
+    server_loop.leader.leads = lambda room_id: True
+    claimant = link(server_loop, 2)
+
+    claimant.process_follower_message({"type": "room_claim", "leader_id": 2, "room": 0, "have": 0})
+
+    assert claimant.comms.sent[-1]["leading"]
+    assert 0 not in server_loop.room_leaders
@@ -0,0 +1,223 @@
+from leader import Leader, RoomChannel
+from room import Room
+from server_loop import ServerLoop
+from services.framing import decode_message
+from services.replication import Replicator
+
+
+class FakeComms:
+    def __init__(self):
+        self.sent = []
+        self.encodings = {}
+
+    def accept_encoding(self, sock, handshake):
+        pass
+
+    def broadcast(self, socks, msg_type, data, tick, seq):
+        for sock in socks:
+            self.sent.append((sock, msg_type, data))
+
+    def frame_for(self, sock, msg, cache):
+        return msg
+
+    def send(self, sock, frame):
+        if isinstance(frame, bytes):
+            frame = decode_message(frame[4:])
+        self.sent.append((sock, frame["type"], frame))
+
+
+class FakeServerLoop:
+    server_id = 1
+    default_room = 0
+    interest_radius = 8
+    max_interest_radius = 32
+    interest_bucket_size = 8
+    max_in_flight_ticks = 8
+    commit_policy = "majority"
+    follower_ack_timeout = 0.25
+    claim_timeout_ticks = 60
+    retained_batches = ServerLoop.retained_batches
+    drop_retained = ServerLoop.drop_retained
+
+    def __init__(self):
+        self.global_tick = 0
+        self.rooms = {}
+        self.room_leaders = {}
+        self.links = {}
+        self.alive = {1}
+
+    def get_room(self, room_id):
+        return self.rooms[room_id]
+
+    def alive_nodes(self):
+        return self.alive
+
+    def leader_of(self, room_id):
+        return self.room_leaders.get(room_id, self.server_id)
+
+    def links_settled(self):
+        return True
+
+    def load_state(self, snapshots):
+        pass
+
+    def is_valid_room(self, room_id):
+        return room_id == 0
+
+    def record_committed(self, room, seq, tick, events):
+        room.event_log.append(seq, tick, events)
+        room.last_applied_seq = seq
+
+
+def make_leader():
+    empty = [[0] * 5 for _ in range(5)]
+    players = [row[:] for row in empty]
+    players[0][0] = 1
+    room = Room(0, (empty, empty, players, empty))
+
+    leader = Leader.__new__(Leader)
+    leader.server_loop = FakeServerLoop()
+    leader.server_loop.rooms[0] = room
+    leader.comms = FakeComms()
+    leader.follower_sockets = {}
+    leader.follower_ids = {}
+    leader.client_rooms = {}
+    leader.claims = {}
+    channel = RoomChannel(room, Replicator(commit_policy="leader"), 0)
+    leader.channels = {0: channel}
+    return leader, channel
+
+
+def commit_tick(leader, channel, events):
+    leader.server_loop.global_tick += 1
+    channel.outgoing_events = events
+    leader.broadcast_state(channel)
+
+
+def test_client_joining_after_blast_is_not_sent_the_exploded_bomb():
+    leader, channel = make_leader()
+    leader.add_client("first", {"room": 0, "player": 1})
+    commit_tick(leader, channel, [{"event_type": 0, "data": [0, 0, 1, 1, 410]}])
+    leader.remove_connection("first")
+    commit_tick(leader, channel, [{"event_type": 5, "data": [440, [1], [0, 0, 1, 0]]}])
+
+    leader.add_client("second", {"room": 0, "player": 1})
+
+    sent = [data for sock, msg_type, data in leader.comms.sent if sock == "second" and msg_type == "update"]
+    assert sent == [[{"event_type": 6, "data": [1, 0, 0]}]]
+
+
+def test_client_joining_an_empty_room_sees_players_where_they_moved():
+    leader, channel = make_leader()
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 1, 0, 1, 0]}])
+
+    assert channel.interest.players.position(1) == (1, 0)
+
+
+def test_inputs_of_coalesced_batches_are_acked_once_committed():
+    leader, channel = make_leader()
+    channel.replicator = Replicator(max_in_flight=1)
+    leader.follower_sockets = {2: "follower"}
+    channel.replicator.add_follower(2)
+    channel.input_acks["client"] = [(1, 1)]
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 1, 0, 1, 0]}])
+    channel.input_acks["client"].append((2, 2))
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 0, 1, 1, 1]}])
+    commit_tick(leader, channel, [{"event_type": 4, "data": [1]}])
+
+    channel.replicator.record_ack(2, 1)
+    commit_tick(leader, channel, [])
+    leader.send_input_acks(channel)
+
+    acks = [frame["seq"] for sock, msg_type, frame in leader.comms.sent if msg_type == "input_ack"]
+    assert acks == [1]
+    assert channel.input_acks["client"] == [(2, 2)]
+
+
+def test_inputs_of_an_in_flight_coalesced_batch_wait_for_its_commit():
+    leader, channel = make_leader()
+    channel.replicator = Replicator(max_in_flight=1)
+    leader.follower_sockets = {2: "follower"}
+    channel.replicator.add_follower(2)
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 1, 0, 1, 0]}])
+    channel.input_acks["client"] = [(2, 1)]
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 0, 1, 1, 1]}])
+    commit_tick(leader, channel, [{"event_type": 4, "data": [1]}])
+
+    # The first batch commits and the coalesced one covering ticks 2 and 3 goes out
+    channel.replicator.record_ack(2, 1)
+    commit_tick(leader, channel, [])
+    commit_tick(leader, channel, [])
+    assert channel.replicator.in_flight[2].first_tick == 2
+    leader.send_input_acks(channel)
+    assert not [frame for sock, msg_type, frame in leader.comms.sent if msg_type == "input_ack"]
+
+    channel.replicator.record_ack(2, 2)
+    commit_tick(leader, channel, [])
+    leader.send_input_acks(channel)
+    assert [frame["seq"] for sock, msg_type, frame in leader.comms.sent if msg_type == "input_ack"] == [1]
+
+
+def test_takeover_continues_after_the_batches_followers_hold():
+    leader, channel = make_leader()
+    del leader.channels[0]
+    room = channel.room
+    leader.follower_sockets = {2: "follower 2", 3: "follower 3"}
+    leader.follower_ids = {"follower 2": 2, "follower 3": 3}
+    leader.server_loop.alive = {1, 2, 3}
+
+    leader.claim_room(0)
+    leader.add_client("client", {"room": 0, "player": 1})
+    claims = [frame for sock, msg_type, frame in leader.comms.sent if msg_type == "room_claim"]
+    assert [frame["have"] for frame in claims] == [0, 0]
+    assert 0 not in leader.channels
+
+    # Follower 2 applied the first batch, follower 3 also got the second one before the old leader failed
+    move = {"event_type": 2, "data": [1, 1, 0, 1, 0]}
+    stop = {"event_type": 4, "data": [1]}
+    leader.claim_answered(2, {"room": 0, "leading": False, "last_seq": 1, "batches": [[1, 5, [move]]]})
+    leader.finish_claims()
+    assert 0 not in leader.channels
+    leader.claim_answered(3, {"room": 0, "leading": False, "last_seq": 0, "batches": [[1, 5, [move]], [2, 6, [stop]]]})
+    leader.finish_claims()
+
+    channel = leader.channels[0]
+    assert room.last_applied_seq == 2
+    assert (room.players[1].x, room.players[1].y) == (1, 0)
+    assert channel.replicator.next_seq == 3
+    assert "client" in channel.clients
+    caught_up = [(sock, frame["seq"]) for sock, msg_type, frame in leader.comms.sent if msg_type == "event"]
+    assert caught_up == [("follower 2", 2), ("follower 3", 1), ("follower 3", 2)]
+
+
+def test_claim_is_given_up_for_a_follower_leading_the_room():
+    leader, channel = make_leader()
+    del leader.channels[0]
+    leader.follower_sockets = {2: "follower 2"}
+    leader.follower_ids = {"follower 2": 2}
+
+    leader.claim_room(0)
+    leader.claim_answered(2, {"room": 0, "leading": True, "last_seq": 4, "batches": []})
+
+    assert not leader.claims
+    assert leader.server_loop.room_leaders[0] == 2
+
+
+def test_room_is_released_once_the_new_owner_acked_everything():
+    leader, channel = make_leader()
+    commit_tick(leader, channel, [{"event_type": 2, "data": [1, 1, 0, 1, 0]}])
+    assert channel.replicator.commit_index == 1
+
+    leader.release_room(channel, 2)
+    assert 0 in leader.channels
+
+    leader.follower_sockets = {2: "follower 2"}
+    channel.replicator.add_follower(2, 0)
+    leader.release_room(channel, 2)
+    assert 0 in leader.channels
+
+    channel.replicator.record_ack(2, 1)
+    leader.release_room(channel, 2)
+    assert 0 not in leader.channels
+    releases = [frame for sock, msg_type, frame in leader.comms.sent if msg_type == "room_release"]
+    assert releases == [{"type": "room_release", "leader_id": 1, "room": 0, "tick": 1, "commit": 1}]
@@ -0,0 +1,58 @@
+import socket
+import time
+from services.framing import FrameReader, encode_message
+from services.network_loop import NetworkLoop
+
+
+def connect(network):
+    client = socket.create_connection(("127.0.0.1", network.server.getsockname()[1]))
+    client.sendall(encode_message({"type": "client_hello"}))
+    deadline = time.perf_counter() + 2.0
+    while time.perf_counter() < deadline:
+        for kind, sock, msg in network.drain():
+            return client, sock
+        time.sleep(0.01)
+    raise AssertionError("no handshake")
+
+
+def test_queued_frames_are_written_on_flush():
+    network = NetworkLoop("127.0.0.1", 0)
+    network.start()
+    try:
+        client, sock = connect(network)
+        client.settimeout(0.2)
+        network.send(sock, encode_message({"type": "redirect", "room": 1}))
+        network.send(sock, encode_message({"type": "redirect", "room": 2}))
+        try:
+            assert client.recv(4096) == b""
+        except socket.timeout:
+            pass
+
+        network.flush()
+        client.settimeout(2.0)
+        reader = FrameReader()
+        messages = []
+        while len(messages) < 2:
+            reader.recv_from(client)
+            messages += reader.messages()
+        assert [msg["room"] for msg in messages] == [1, 2]
+    finally:
+        network.stop()
+
+
+def test_connections_past_the_outgoing_limit_are_dropped():
+    network = NetworkLoop("127.0.0.1", 0, max_outgoing=1024)
+    network.start()
+    try:
+        client, sock = connect(network)
+        network.send(sock, b"\0" * 2048)
+        network.flush()
+        deadline = time.perf_counter() + 2.0
+        closed = []
+        while not closed and time.perf_counter() < deadline:
+            closed = [kind for kind, _, _ in network.drain() if kind == "closed"]
+            time.sleep(0.01)
+        assert closed == ["closed"]
+        assert sock not in network.connections
+    finally:
+        network.stop()
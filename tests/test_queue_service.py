@@ -0,0 +1,29 @@
+from services.queue_service import EventQueue
+
+
+def test_timers_fire_by_their_tick_after_the_clock_goes_back():
+    queue = EventQueue()
+    assert queue.pop_ready(5000) == []
+    queue.push(220, 9, [1])
+    queue.push(100, 3, 7)
+    queue.push(70000, 3, 8)
+
+    fired = []
+    for tick in range(200, 400):
+        fired += queue.pop_ready(tick)
+
+    assert fired == [(100, 3, 7), (220, 9, [1])]
+    assert len(queue) == 1
+    assert queue.pop_ready(70000) == [(70000, 3, 8)]
+
+
+def test_timers_pushed_before_the_clock_goes_back_keep_their_ticks():
+    queue = EventQueue()
+    queue.pop_ready(1000)
+    handle = queue.push(1100, 1, 1)
+    queue.push(1200, 1, 2)
+
+    assert queue.pop_ready(500) == []
+    assert queue.cancel(handle)
+    assert queue.pop_ready(1199) == []
+    assert queue.pop_ready(1200) == [(1200, 1, 2)]
@@ -0,0 +1,22 @@
+from services.replication import Replicator
+
+
+def test_oldest_uncommitted_tick_of_batches_coalesced_while_the_window_is_full():
+    replicator = Replicator(max_in_flight=1)
+    replicator.add_follower(2)
+    entry = replicator.submit(10, [{"event_type": 2, "data": [1, 1, 0, 1, 0]}], [2])
+
+    assert replicator.submit(11, [{"event_type": 4, "data": [1]}], [2]) is None
+    assert replicator.submit(12, [{"event_type": 0, "data": [1, 0, 1, 1, 132]}], [2]) is None
+    assert replicator.coalesced_ticks == 1
+
+    replicator.record_ack(2, entry.seq)
+    assert [committed.seq for committed in replicator.advance([2])] == [entry.seq]
+    assert replicator.oldest_uncommitted_tick() == 11
+
+    entry = replicator.submit(13, [], [2])
+    assert entry.tick == 12
+    assert replicator.oldest_uncommitted_tick() == 11
+    replicator.record_ack(2, entry.seq)
+    replicator.advance([2])
+    assert replicator.oldest_uncommitted_tick() is None